@@ -1,12 +1,160 @@
+import collections
+import math
 import os.path
 
 try:
     from PyQt5.QtCore import Qt, QRectF, pyqtSignal, QT_VERSION_STR, QPoint, QRect, QSize
-    from PyQt5.QtGui import QImage, QPixmap, QPainterPath
-    from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QFileDialog, QRubberBand
+    from PyQt5.QtGui import QImage, QPixmap, QPainterPath, QPainter, QColor
+    from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QFileDialog, QRubberBand, QInputDialog, QLineEdit, \
+        QMenu, QGraphicsItem
 except ImportError:
     raise ImportError("ImportError: Requires PyQt5")
 
+# edge length of the tiles an image is displayed with
+TILE_SIZE = 256
+# maximum number of tile pixmaps that are kept for redrawing (256 tiles of 256x256 px are 64 MB)
+TILE_CACHE_SIZE = 256
+# color of the tiles that changed since the previous screenshot
+CHANGED_TILE_COLOR = QColor(255, 0, 0, 80)
+
+
+def buildPyramid(image: QImage, count=None):
+    """ Returns the downscaled levels 1, 2, ... of an image for TiledImageItem. QImage can be scaled outside of the
+    GUI thread, so this can be called by a worker thread to keep the GUI responsive for huge images.
+    """
+    if count is None:
+        count = pyramidDepth(image.size())
+    levels = []
+    previous = image
+    for _ in range(count):
+        previous = previous.scaled(max(1, previous.width() // 2), max(1, previous.height() // 2),
+                                   Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        levels.append(previous)
+    return levels
+
+
+def pyramidDepth(size: QSize):
+    """ Number of downscaled levels until the whole image fits into a few tiles """
+    longest = max(size.width(), size.height())
+    return max(0, int(math.ceil(math.log2(max(1, longest / (2 * TILE_SIZE))))))
+
+
+class TiledImageItem(QGraphicsItem):
+    """ Displays a possibly huge QImage as tiles of a resolution pyramid.
+
+    Level 0 is the image itself, every further level has half the resolution of the previous one. Only the tiles
+    that are exposed are converted to pixmaps, from the level that matches the current zoom, so the whole image never
+    has to exist as one giant QPixmap. The item always covers the full resolution image in scene coordinates,
+    so scene coordinates are image pixel coordinates regardless of the level that is displayed.
+
+    If size is given, the image is a preview of an image of that size and is stretched to it.
+    """
+
+    def __init__(self, image: QImage, levels=None, size=None):
+        super(TiledImageItem, self).__init__()
+        self.levels = [image] + list(levels or [])
+        self.size = size or image.size()
+        self.tiles = collections.OrderedDict()  # (level, column, row) -> QPixmap, least recently used first
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)  # so that option.exposedRect is set
+
+    def image(self):
+        return self.levels[0]
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.size.width(), self.size.height())
+
+    def level(self, index):
+        """ Returns the image of a pyramid level, downscaled levels are created when they are needed first """
+        while len(self.levels) <= index:
+            previous = self.levels[-1]
+            self.levels.append(previous.scaled(max(1, previous.width() // 2), max(1, previous.height() // 2),
+                                               Qt.IgnoreAspectRatio, Qt.SmoothTransformation))
+        return self.levels[index]
+
+    def maxLevel(self):
+        """ Coarsest useful level: the whole image fits into a few tiles """
+        return pyramidDepth(self.levels[0].size())
+
+    def tile(self, level, column, row):
+        key = (level, column, row)
+        pixmap = self.tiles.pop(key, None)
+        if pixmap is None:
+            image = self.level(level)
+            # tiles at the right and bottom edge are smaller, copy would fill the rest with black
+            pixmap = QPixmap.fromImage(image.copy(QRect(column * TILE_SIZE, row * TILE_SIZE, TILE_SIZE, TILE_SIZE)
+                                                  .intersected(image.rect())))
+            if len(self.tiles) >= TILE_CACHE_SIZE:
+                self.tiles.popitem(last=False)
+        self.tiles[key] = pixmap
+        return pixmap
+
+    def paint(self, painter, option, widget=None):
+        # screen pixels per level 0 pixel; choose the level with the lowest resolution that is still sharp
+        scale = option.levelOfDetailFromTransform(painter.worldTransform())
+        scale *= self.size.width() / self.levels[0].width()
+        level_index = 0
+        if scale < 1:
+            level_index = min(int(math.floor(math.log2(1 / scale))), self.maxLevel())
+        level = self.level(level_index)
+        if scale < 1:
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+
+        # scene pixels per level pixel
+        factor_x = self.size.width() / level.width()
+        factor_y = self.size.height() / level.height()
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        first_column = int(exposed.left() / factor_x) // TILE_SIZE
+        last_column = min(int(math.ceil(exposed.right() / factor_x)), level.width() - 1) // TILE_SIZE
+        first_row = int(exposed.top() / factor_y) // TILE_SIZE
+        last_row = min(int(math.ceil(exposed.bottom() / factor_y)), level.height() - 1) // TILE_SIZE
+
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                pixmap = self.tile(level_index, column, row)
+                target = QRectF(column * TILE_SIZE * factor_x, row * TILE_SIZE * factor_y,
+                                pixmap.width() * factor_x, pixmap.height() * factor_y)
+                painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+
+    def pixmap(self):
+        return QPixmap.fromImage(self.levels[0])
+
+
+class TileOverlayItem(QGraphicsItem):
+    """ Highlights rectangles of the image (in scene coordinates), e.g. the tiles that changed since the previous
+    screenshot, without changing the image itself.
+    """
+
+    def __init__(self, rects, color=CHANGED_TILE_COLOR):
+        super(TileOverlayItem, self).__init__()
+        self.rects = [QRectF(rect) for rect in rects]
+        self.color = color
+        self.bounds = QRectF()
+        for rect in self.rects:
+            self.bounds = self.bounds.united(rect)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)  # so that option.exposedRect is set
+
+    def boundingRect(self):
+        return self.bounds
+
+    def paint(self, painter, option, widget=None):
+        for rect in self.rects:
+            if rect.intersects(option.exposedRect):
+                painter.fillRect(rect, self.color)
+
+
+class Selection:
+    """ A named area of interest, displayed as rubber band """
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.rubberBand = QRubberBand(QRubberBand.Rectangle, parent)
+        self.rubberBand.setToolTip(name)
+        self.scenePos = None  # so it can be restored after resizing
+
+    def rect(self):
+        """ Selected area in image coordinates """
+        return self.scenePos.boundingRect().toAlignedRect()
+
 
 class QtImagePartSelector(QGraphicsView):
     """
@@ -14,24 +162,29 @@ class QtImagePartSelector(QGraphicsView):
     by Marcel Goldschen-Ohm, MIT license
     """
 
+    # emitted with the area that was just selected
     rectSet = pyqtSignal(QRect)
+    # emitted whenever an area is added, changed, renamed or removed
+    selectionsChanged = pyqtSignal()
 
     def __init__(self):
         QGraphicsView.__init__(self)
 
-        # Image is displayed as a QPixmap in a QGraphicsScene attached to this QGraphicsView.
+        # Image is displayed as a TiledImageItem in a QGraphicsScene attached to this QGraphicsView.
         self.scene = QGraphicsScene()
         self.setScene(self.scene)
 
-        # Store a local handle to the scene's current image pixmap.
-        self._pixmapHandle = None
+        # Store a local handle to the scene's current image item.
+        self._imageItem = None
+        # tiles that changed since the previous screenshot, drawn above the image
+        self._changedTilesItem = None
 
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAsNeeded)
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
 
-        # rubber band for area selection
-        self.rubberBand = QRubberBand(QRubberBand.Rectangle, self)
-        self.rubberBandScenePos = None # so it can be restored after resizing
+        # named areas of interest; dragging with shift held adds another area instead of replacing them
+        self.selections = []
+        self.selectionCounter = 0
         self.setMouseTracking(True)
         self.origin = QPoint()
         self.changeRubberBand = False
@@ -42,31 +195,87 @@ class QtImagePartSelector(QGraphicsView):
         self.setCursor(Qt.CrossCursor)
 
     def hasImage(self):
-        """ Returns whether or not the scene contains an image pixmap.
+        """ Returns whether or not the scene contains an image.
         """
-        return self._pixmapHandle is not None
+        return self._imageItem is not None
 
     def clearImage(self):
-        """ Removes the current image pixmap from the scene if it exists.
+        """ Removes the current image from the scene if it exists.
         """
         if self.hasImage():
-            self.scene.removeItem(self._pixmapHandle)
-            self._pixmapHandle = None
+            self.scene.removeItem(self._imageItem)
+            self._imageItem = None
+
+    def setChangedTiles(self, rects):
+        """ Highlight tiles (QRects in image coordinates) that changed since the previous screenshot. They stay
+        when the image is replaced, until clearChangedTiles is called.
+        """
+        self.clearChangedTiles()
+        self._changedTilesItem = TileOverlayItem(rects)
+        self._changedTilesItem.setZValue(1)  # above the image
+        self.scene.addItem(self._changedTilesItem)
+
+    def clearChangedTiles(self):
+        if self._changedTilesItem is not None:
+            self.scene.removeItem(self._changedTilesItem)
+            self._changedTilesItem = None
+
+    def changedTiles(self):
+        """ Returns the highlighted tiles as list of QRectF """
+        if self._changedTilesItem is not None:
+            return self._changedTilesItem.rects
+        return []
 
     def pixmap(self):
-        """ Returns the scene's current image pixmap as a QPixmap, or else None if no image exists.
+        """ Returns the scene's current image as a QPixmap, or else None if no image exists.
+        Note that this creates a pixmap of the full image, which can be huge.
         :rtype: QPixmap | None
         """
         if self.hasImage():
-            return self._pixmapHandle.pixmap()
+            return self._imageItem.pixmap()
         return None
 
     def image(self):
-        """ Returns the scene's current image pixmap as a QImage, or else None if no image exists.
+        """ Returns the scene's current image as a QImage, or else None if no image exists.
         :rtype: QImage | None
         """
         if self.hasImage():
-            return self._pixmapHandle.pixmap().toImage()
+            return self._imageItem.image()
+        return None
+
+    def selectedAreas(self):
+        """ Returns the names and rectangles (in image coordinates) of all selected areas as list of tuples.
+        :rtype: list[(str, QRect)]
+        """
+        areas = []
+        for selection in self.selections:
+            rect = selection.rect()
+            if rect.width() > 1 and rect.height() > 1:
+                areas.append((selection.name, rect))
+        return areas
+
+    def clearSelections(self):
+        """ Removes all selected areas """
+        for selection in self.selections:
+            selection.rubberBand.hide()
+            selection.rubberBand.deleteLater()
+        self.selections = []
+        self.selectionCounter = 0
+        self.selectionsChanged.emit()
+
+    def _nextSelectionName(self):
+        names = [selection.name for selection in self.selections]
+        while True:
+            self.selectionCounter += 1
+            name = "area{}".format(self.selectionCounter)
+            if name not in names:
+                return name
+
+    def selectionAt(self, pos):
+        """ Returns the topmost selection at a position in view coordinates or None """
+        for selection in reversed(self.selections):
+            if selection.rubberBand.geometry().contains(pos):
+                return selection
         return None
 
     def resizeEvent(self, event):
@@ -77,22 +286,22 @@ class QtImagePartSelector(QGraphicsView):
     def showEvent(self, event):
         self.old_center = self.mapToScene(self.rect().center())
 
-    def setImage(self, image):
-        """ Set the scene's current image pixmap to the input QImage or QPixmap.
+    def setImage(self, image, levels=None, size=None):
+        """ Set the scene's current image to the input QImage or QPixmap.
         Raises a RuntimeError if the input image has type other than QImage or QPixmap.
+        Downscaled levels (see buildPyramid) can be passed if they were already created in another thread.
+        If size is given, image is a preview of an image with that size; selections still use the coordinates
+        of the full size image.
         :type image: QImage | QPixmap
         """
         if type(image) is QPixmap:
-            pixmap = image
-        elif type(image) is QImage:
-            pixmap = QPixmap.fromImage(image)
-        else:
+            image = image.toImage()
+        elif type(image) is not QImage:
             raise RuntimeError("ImageViewer.setImage: Argument must be a QImage or QPixmap.")
-        if self.hasImage():
-            self._pixmapHandle.setPixmap(pixmap)
-        else:
-            self._pixmapHandle = self.scene.addPixmap(pixmap)
-        self.setSceneRect(QRectF(pixmap.rect()))  # Set scene size to image size.
+        self.clearImage()
+        self._imageItem = TiledImageItem(image, levels, size)
+        self.scene.addItem(self._imageItem)
+        self.setSceneRect(self._imageItem.boundingRect())  # Set scene size to image size.
 
 
 
@@ -111,11 +320,16 @@ class QtImagePartSelector(QGraphicsView):
         """ Start creation of rubber band
         """
         if event.button() == Qt.LeftButton:
+            if not event.modifiers() & Qt.ShiftModifier:
+                self.clearSelections()
+            selection = Selection(self._nextSelectionName(), self)
+            self.selections.append(selection)
+
             self.origin = event.pos()
-            self.rubberBand.setGeometry(QRect(self.origin, QSize()))
-            self.rubberBandScenePos = self.mapToScene(self.rubberBand.geometry())
+            selection.rubberBand.setGeometry(QRect(self.origin, QSize()))
+            selection.scenePos = self.mapToScene(selection.rubberBand.geometry())
 
-            self.rubberBand.show()
+            selection.rubberBand.show()
             self.changeRubberBand = True
         elif event.button() == Qt.MidButton:
             self.setCursor(Qt.ClosedHandCursor)
@@ -125,9 +339,10 @@ class QtImagePartSelector(QGraphicsView):
 
     def mouseMoveEvent(self, event):
         if self.changeRubberBand:
-            # update rubber
-            self.rubberBand.setGeometry(QRect(self.origin, event.pos()).normalized())
-            self.rubberBandScenePos = self.mapToScene(self.rubberBand.geometry())
+            # update rubber band of the area that is being selected
+            selection = self.selections[-1]
+            selection.rubberBand.setGeometry(QRect(self.origin, event.pos()).normalized())
+            selection.scenePos = self.mapToScene(selection.rubberBand.geometry())
         if event.buttons() & Qt.MidButton:
             # drag image
             offset = self.dragPrevMousePos - event.pos()
@@ -140,18 +355,52 @@ class QtImagePartSelector(QGraphicsView):
         QGraphicsView.mouseMoveEvent(self, event)
 
     def mouseReleaseEvent(self, event):
-        if event.button() == Qt.LeftButton:
+        if event.button() == Qt.LeftButton and self.changeRubberBand:
             # Emit rubber band size
             self.changeRubberBand = False
-            self.rectSet.emit(self.rubberBandScenePos.boundingRect().toAlignedRect())
+            selection = self.selections[-1]
+            if selection.rect().width() <= 1 or selection.rect().height() <= 1:
+                # a click without dragging does not select anything
+                selection.rubberBand.hide()
+                selection.rubberBand.deleteLater()
+                self.selections.pop()
+            else:
+                self.rectSet.emit(selection.rect())
+            self.selectionsChanged.emit()
         elif event.button() == Qt.MiddleButton:
             self.setCursor(Qt.CrossCursor)
 
         QGraphicsView.mouseReleaseEvent(self, event)
 
+    def contextMenuEvent(self, event):
+        """ Rename or remove the area below the cursor """
+        selection = self.selectionAt(event.pos())
+        if selection is None:
+            return
+
+        menu = QMenu(self)
+        rename_action = menu.addAction("Rename {}".format(selection.name))
+        remove_action = menu.addAction("Remove {}".format(selection.name))
+        action = menu.exec_(event.globalPos())
+
+        if action == rename_action:
+            name, ok = QInputDialog.getText(self, "Rename area", "Name of area (without spaces)",
+                                            QLineEdit.Normal, selection.name)
+            name = "".join(name.split())
+            if ok and name and name not in [other.name for other in self.selections]:
+                selection.name = name
+                selection.rubberBand.setToolTip(name)
+                self.selectionsChanged.emit()
+        elif action == remove_action:
+            selection.rubberBand.hide()
+            selection.rubberBand.deleteLater()
+            self.selections.remove(selection)
+            self.selectionsChanged.emit()
+
     def updateRubberBandDisplay(self):
-        if self.rubberBandScenePos is not None:
-            self.rubberBand.setGeometry(self.mapFromScene(self.rubberBandScenePos).boundingRect())
+        for selection in self.selections:
+            if selection.scenePos is not None:
+                selection.rubberBand.setGeometry(self.mapFromScene(selection.scenePos).boundingRect())
 
     def wheelEvent(self, event):
         # Zoom Factor
@@ -0,0 +1,778 @@
+#!/usr/bin/env python3
+"""
+Backend checker for urlwatch. Renders a web page with wkhtmltoimage on a display leased from a pool of
+persistent Xvfb servers and prints a hash of the pixels in the area of interest.
+
+It is a drop-in replacement for pyvisualcompare-md5.sh and accepts exactly the same parameters:
+the --crop-* options generated by the frontend followed by any other wkhtmltoimage parameters and the URL.
+Instead of --crop-*, several named areas can be given with --region NAME=X,Y,W,H. The page is then rendered
+only once and one hash per area is printed.
+
+Pages are rendered by wkhtmltoimage on Xvfb displays, or with PYVISUALCOMPARE_RENDERER=webengine by long-lived
+Qt WebEngine workers without Xvfb (see webrenderer.py).
+The Xvfb pool (see XvfbPool.fromEnvironment) and the checker itself (see Settings.fromEnvironment) are configured
+with environment variables so that no option can clash with a wkhtmltoimage parameter.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import resource
+import selectors
+import signal
+import subprocess
+import sys
+import time
+import urllib.parse
+
+from cache import DEFAULT_CACHE_SIZE, DEFAULT_REF_AGE, FrameCache
+from frames import boundingRect, decodeImage, encodePpm, hashFrame
+from metrics import CheckMetrics
+from tools import WKHTMLTOIMAGE, requireTool
+from xvfbpool import XvfbPool
+
+CROP_OPTIONS = ("--crop-x", "--crop-y", "--crop-w", "--crop-h")
+REGION_OPTION = "--region"
+HEIGHT_OPTION = "--height"
+FORMAT_OPTIONS = ("--format", "-f")
+# formats of wkhtmltoimage that frames.decodeImage can read; bmp is not compressed, so it is the cheapest to write
+IMAGE_FORMATS = ("bmp", "png")
+READ_SIZE = 1024 * 1024
+RENDERERS = ("wkhtmltoimage", "webengine")
+DELAY_OPTION = "--javascript-delay"
+WINDOW_STATUS_OPTION = "--window-status"
+# JavaScript delay of wkhtmltoimage if the parameters do not set one [ms]
+DEFAULT_DELAY = 200
+# longest time a page may take to load when waiting for its readiness signal [s]
+READY_LOAD_TIMEOUT = 60.0
+# messages of wkhtmltoimage (or Qt) about a failed allocation, e.g. because of the address space limit
+OUT_OF_MEMORY_MARKERS = (b"bad_alloc", b"out of memory", b"cannot allocate memory")
+# a SIGKILL of a wkhtmltoimage whose peak memory (resident set) was at least this large is attributed to the OOM
+# killer of the kernel [bytes]
+OOM_KILL_RSS = 1024 ** 3
+# exit codes of the checker for renders that were stopped by the watchdog, 124 like timeout(1)
+EXIT_TIMEOUT = 124
+EXIT_OUT_OF_MEMORY = 125
+
+
+def defaultStateDir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pyvisualcompare")
+
+
+def renderPool():
+    """ Pool of the renderer chosen by PYVISUALCOMPARE_RENDERER, see RENDERERS """
+    renderer = os.environ.get("PYVISUALCOMPARE_RENDERER") or RENDERERS[0]
+    if renderer == "webengine":
+        import webrenderer  # only needed for this renderer
+        return webrenderer.WebRendererPool.fromEnvironment()
+    if renderer != "wkhtmltoimage":
+        raise ValueError("Unknown renderer {}, expected one of {}".format(renderer, ", ".join(RENDERERS)))
+    return XvfbPool.fromEnvironment()
+
+
+class RenderError(Exception):
+    """ wkhtmltoimage failed; carries its exit code and output so they can be passed on to urlwatch """
+    # how the render ended, reported as status of batch results and (with "render-" prefix) as exit in the metrics
+    reason = "error"
+    # whether the display the render ran on may be stuck and is restarted (see XvfbPool.lease)
+    restart_display = False
+
+    def __init__(self, returncode, output, message=None):
+        super(RenderError, self).__init__(message or "wkhtmltoimage exited with code {}".format(returncode))
+        self.returncode = returncode
+        self.output = output
+
+    def exitCode(self):
+        """ Exit code of the checker, like pyvisualcompare-md5.sh the one of wkhtmltoimage """
+        return self.returncode
+
+
+class RenderTimeout(RenderError):
+    """ wkhtmltoimage was stopped because it took too long """
+    reason = "timeout"
+    restart_display = True
+
+    def __init__(self, seconds, output, message=None):
+        super(RenderTimeout, self).__init__(-signal.SIGKILL, output, message or
+                                            "wkhtmltoimage did not finish within {:.1f} s".format(seconds))
+        self.seconds = seconds
+
+    def exitCode(self):
+        return EXIT_TIMEOUT
+
+
+class ReadyTimeout(RenderTimeout):
+    """ The page did not signal that it is ready within the JavaScript delay (see renderWhenReady) """
+    restart_display = False
+
+
+class RenderOutOfMemory(RenderError):
+    """ wkhtmltoimage ran out of memory, e.g. because it reached the address space limit """
+    reason = "oom"
+
+    def __init__(self, returncode, output, limit=None):
+        message = "wkhtmltoimage ran out of memory"
+        if limit:
+            message += " (limit: {} MiB)".format(limit // 1024 ** 2)
+        super(RenderOutOfMemory, self).__init__(returncode, output, message)
+        self.limit = limit
+
+    def exitCode(self):
+        return EXIT_OUT_OF_MEMORY
+
+
+class Settings:
+    """ Options of the checker that are not wkhtmltoimage parameters """
+
+    def __init__(self, algorithm="md5", tolerance=None, block_size=32, diff_method="mad", state_dir=None,
+                 cache_size=DEFAULT_CACHE_SIZE, keep_frames=False, metrics_path=None, precheck=False,
+                 precheck_max_age=86400, track=False, track_margin=256, track_min_score=0.7, image_format="bmp",
+                 limit_height=True, history_path=None, history_days=90, ready=None, coalesce=None,
+                 render_timeout=120.0, memory_limit=4096 * 1024 ** 2, cpu_limit=60.0,
+                 cache_ref_age=DEFAULT_REF_AGE):
+        # hash algorithm for the pixels of the area of interest, see frames.HASH_ALGORITHMS
+        self.algorithm = algorithm
+        # None for exact comparison, otherwise the threshold of the tolerant comparison (see diffengine)
+        self.tolerance = tolerance
+        self.block_size = block_size
+        self.diff_method = diff_method
+        # directory for state that is kept between checks, e.g. the cache with the baselines
+        self.state_dir = state_dir or defaultStateDir()
+        # byte budget of the cache, and how long the baselines of a job that is no longer checked are kept [s]
+        self.cache_size = cache_size
+        self.cache_ref_age = cache_ref_age
+        # whether the last rendered image of every job is kept in the cache
+        self.keep_frames = keep_frames
+        # file the metrics of every check are written to (JSON lines, or Prometheus text format for *.prom)
+        self.metrics_path = metrics_path
+        # whether rendering is skipped if the HTML and resources of the page did not change (see precheck.py),
+        # and the maximum time between two renders in that case [s]
+        self.precheck = precheck
+        self.precheck_max_age = precheck_max_age
+        # whether areas are searched again on every check (see tracking.py), how far from their last position
+        # [pixels] and how similar to the template they must be (NCC, up to 1)
+        self.track = track
+        self.track_margin = track_margin
+        self.track_min_score = track_min_score
+        # format wkhtmltoimage writes, see IMAGE_FORMATS
+        self.image_format = image_format
+        # whether the page is only rendered down to the lowest area of interest (see Job.renderHeight)
+        self.limit_height = limit_height
+        # SQLite database every check is added to (see history.py) and how long checks are kept there [days]
+        self.history_path = history_path
+        self.history_days = history_days
+        # capture as soon as the page is ready instead of after the JavaScript delay, which becomes the upper
+        # bound: "status:VALUE" once window.status is VALUE, "stable" once the rendering stops changing (web
+        # renderer only); None always waits for the delay
+        self.ready = ready
+        # jobs of the same page share its render (see coalesce.py) if it is at most this old [s]; None renders
+        # every job by itself
+        self.coalesce = coalesce
+        # limits of every render: wall-clock time in addition to the JavaScript delay [s], address space [bytes]
+        # and CPU time [s] of wkhtmltoimage; None for no limit
+        self.render_timeout = render_timeout
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+
+    @classmethod
+    def fromEnvironment(cls):
+        """ Create settings configured by the PYVISUALCOMPARE_* environment variables """
+        env = os.environ
+        tolerance = env.get("PYVISUALCOMPARE_TOLERANCE")
+        memory_limit = float(env.get("PYVISUALCOMPARE_RENDER_MEMORY", 4096))
+        return cls(algorithm=env.get("PYVISUALCOMPARE_HASH", "md5"),
+                   tolerance=float(tolerance) if tolerance else None,
+                   block_size=int(env.get("PYVISUALCOMPARE_BLOCK_SIZE", 32)),
+                   diff_method=env.get("PYVISUALCOMPARE_DIFF_METHOD", "mad"),
+                   state_dir=env.get("PYVISUALCOMPARE_STATE_DIR") or None,
+                   cache_size=int(env.get("PYVISUALCOMPARE_CACHE_SIZE", DEFAULT_CACHE_SIZE)),
+                   keep_frames=env.get("PYVISUALCOMPARE_KEEP_FRAMES", "") not in ("", "0"),
+                   metrics_path=env.get("PYVISUALCOMPARE_METRICS") or None,
+                   precheck=env.get("PYVISUALCOMPARE_PRECHECK", "") not in ("", "0"),
+                   precheck_max_age=float(env.get("PYVISUALCOMPARE_PRECHECK_MAX_AGE", 86400)),
+                   track=env.get("PYVISUALCOMPARE_TRACK", "") not in ("", "0"),
+                   track_margin=int(env.get("PYVISUALCOMPARE_TRACK_MARGIN", 256)),
+                   track_min_score=float(env.get("PYVISUALCOMPARE_TRACK_MIN_SCORE", 0.7)),
+                   image_format=env.get("PYVISUALCOMPARE_FORMAT", "bmp"),
+                   limit_height=env.get("PYVISUALCOMPARE_LIMIT_HEIGHT", "1") not in ("", "0"),
+                   history_path=env.get("PYVISUALCOMPARE_HISTORY") or None,
+                   history_days=float(env.get("PYVISUALCOMPARE_HISTORY_DAYS", 90)),
+                   ready=env.get("PYVISUALCOMPARE_READY") or None,
+                   coalesce=float(env["PYVISUALCOMPARE_COALESCE"]) if env.get("PYVISUALCOMPARE_COALESCE") else None,
+                   render_timeout=float(env.get("PYVISUALCOMPARE_RENDER_TIMEOUT", 120)) or None,
+                   memory_limit=int(memory_limit * 1024 ** 2) or None,
+                   cpu_limit=float(env.get("PYVISUALCOMPARE_RENDER_CPU", 60)) or None,
+                   cache_ref_age=float(env.get("PYVISUALCOMPARE_CACHE_REF_DAYS", DEFAULT_REF_AGE / 86400)) * 86400)
+
+    def usesCache(self):
+        return self.tolerance is not None or self.keep_frames or self.track or self.coalesce is not None
+
+    def frameCache(self):
+        return FrameCache(os.path.join(self.state_dir, "cache"), self.cache_size, self.cache_ref_age)
+
+    def cacheRefs(self, job):
+        """ References a job keeps in the cache with these settings, see FrameCache.pruneRefs """
+        refs = {"frame"} if self.keep_frames else set()
+        # without areas, the whole image is compared as "crop"
+        for name, _ in job.regions or [(None, None)]:
+            if self.track and job.regions:
+                refs.update(("template-{}".format(name or "crop"), "position-{}".format(name or "crop")))
+            if self.tolerance is not None:
+                refs.add("baseline-{}".format(name or "crop"))
+        return refs
+
+
+class CheckResult:
+    def __init__(self, digest, boxes=None, name=None):
+        # hash reported to urlwatch
+        self.digest = digest
+        # bounding boxes (x, y, w, h) of changed blocks if the tolerant comparison found a change, otherwise None
+        self.boxes = boxes
+        # name of the area, None for the area given by --crop-* or the whole page
+        self.name = name
+
+
+class Job:
+    """ A single watch job: the wkhtmltoimage parameters of a page and the areas of interest on it """
+
+    def __init__(self, wkhtml_args, regions=None, name=None):
+        # parameters passed to wkhtmltoimage (except --crop-* and the destination filename)
+        self.wkhtml_args = list(wkhtml_args)
+        # areas of interest as list of (name, (x, y, w, h)); the name is None for the area given by --crop-*.
+        # An empty list stands for the whole page.
+        self.regions = list(regions or [])
+        self.name = name
+
+    def url(self):
+        """ The URL is the last parameter, as generated by MyMainWindow.getWkhtmlParameters """
+        return self.wkhtml_args[-1]
+
+    def host(self):
+        url = self.url()
+        if "://" not in url:
+            url = "http://" + url  # wkhtmltoimage accepts URLs without scheme
+        return urllib.parse.urlsplit(url).hostname or url
+
+    def key(self):
+        """ Identifies the job by its parameters, e.g. for state that is kept between checks """
+        return hashlib.sha1(repr((self.wkhtml_args, self.regions)).encode()).hexdigest()
+
+    def renderHeight(self, margin=0, regions=None):
+        """ Smallest screen height that contains all areas of interest plus margin, which is all of the page
+        that needs to be rendered. None if the whole page is needed or the parameters set a height.
+        regions are the areas at the positions they are expected at (see trackedRegions), default the job's.
+        """
+        regions = regions or self.regions
+        if not regions or HEIGHT_OPTION in self.wkhtml_args:
+            return None
+        return max(y + h for _, (_, y, _, h) in regions) + margin
+
+    def renderArguments(self, crop=True, image_format=None, height=None):
+        """ Parameters for wkhtmltoimage. A single area is cropped by wkhtmltoimage itself (unless crop is False),
+        like pyvisualcompare-md5.sh does; several areas are cut out of one render of the full page.
+        image_format is used unless the parameters choose a format; height limits the screen height.
+        """
+        arguments = []
+        if crop and len(self.regions) == 1:
+            for option, value in zip(CROP_OPTIONS, self.regions[0][1]):
+                arguments += [option, str(value)]
+        if height is not None:
+            arguments += [HEIGHT_OPTION, str(height)]
+        if image_format and not any(option in self.wkhtml_args for option in FORMAT_OPTIONS):
+            arguments += [FORMAT_OPTIONS[0], image_format]
+        return arguments + self.wkhtml_args
+
+
+def parseRegion(value):
+    """ Parse the value of --region, NAME=X,Y,W,H """
+    name, _, rect = value.partition("=")
+    try:
+        rect = tuple(int(v) for v in rect.split(","))
+    except ValueError:
+        rect = ()
+    if not name or len(rect) != 4:
+        raise ValueError("Invalid area {}, expected NAME=X,Y,W,H".format(value))
+    return name, rect
+
+
+def parseJobArguments(argv):
+    """ Split the command line of pyvisualcompare-md5.sh (plus --region options) into a Job """
+    crop = {}
+    regions = []
+    wkhtml_args = []
+    i = 0
+    while i < len(argv):
+        if argv[i] in CROP_OPTIONS and i + 1 < len(argv):
+            crop[argv[i]] = int(argv[i + 1])
+            i += 2
+        elif argv[i] == REGION_OPTION and i + 1 < len(argv):
+            regions.append(parseRegion(argv[i + 1]))
+            i += 2
+        else:
+            wkhtml_args.append(argv[i])
+            i += 1
+
+    if crop:
+        if len(crop) != len(CROP_OPTIONS):
+            raise ValueError("Either all or none of {} must be given".format(", ".join(CROP_OPTIONS)))
+        if regions:
+            raise ValueError("{} cannot be combined with {}".format(REGION_OPTION, CROP_OPTIONS[0]))
+        regions.append((None, tuple(crop[option] for option in CROP_OPTIONS)))
+    return Job(wkhtml_args, regions)
+
+
+def _exitCode(status):
+    """ Exit code from a wait status like subprocess reports it: negative signal number if killed by a signal """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def javascriptDelay(arguments):
+    """ JavaScript delay of wkhtmltoimage parameters (the URL is the last one) [ms] """
+    if DELAY_OPTION in arguments[:-1]:
+        return int(arguments[arguments.index(DELAY_OPTION) + 1])
+    return DEFAULT_DELAY
+
+
+def limitResources(pid, settings):
+    """ Apply the address space and CPU time limits of settings to a process that has just been started. Unlike a
+    preexec_fn, this is safe in the threads of batch mode and the scheduler. The CPU limit is soft: the process
+    gets SIGXCPU and is killed a few seconds later.
+    """
+    if settings.memory_limit:
+        resource.prlimit(pid, resource.RLIMIT_AS, (settings.memory_limit, settings.memory_limit))
+    if settings.cpu_limit:
+        seconds = int(-(-settings.cpu_limit // 1))
+        resource.prlimit(pid, resource.RLIMIT_CPU, (seconds, seconds + 5))
+
+
+def renderFailure(returncode, output, usage, settings):
+    """ RenderError that describes how wkhtmltoimage failed, from its exit code, output and resource usage (from
+    os.wait4). Timeouts of the watchdog itself are raised by render.
+    """
+    text = output.decode(errors="replace")
+    cpu_time = usage.ru_utime + usage.ru_stime
+    # SIGXCPU at the soft CPU limit, or SIGKILL by the kernel at the hard limit if SIGXCPU was ignored
+    if returncode == -signal.SIGXCPU or \
+            (returncode == -signal.SIGKILL and settings.cpu_limit and cpu_time >= settings.cpu_limit):
+        return RenderTimeout(settings.cpu_limit, text,
+                             "wkhtmltoimage used more than {:.0f} s of CPU time".format(settings.cpu_limit))
+    if any(marker in output.lower() for marker in OUT_OF_MEMORY_MARKERS):
+        return RenderOutOfMemory(returncode, text, settings.memory_limit)
+    # any other SIGKILL is the OOM killer of the kernel if wkhtmltoimage took a lot of memory
+    if returncode == -signal.SIGKILL and usage.ru_maxrss * 1024 >= OOM_KILL_RSS:
+        return RenderOutOfMemory(returncode, text, settings.memory_limit)
+    return RenderError(returncode, text)
+
+
+def render(arguments, display, metrics, settings=None, wait_limit=None):
+    """ Run wkhtmltoimage on the given X display and return the image it writes to its standard output; no file
+    is written. The arguments must choose the image format since there is no file name extension.
+    The time until wkhtmltoimage reports that the page is loaded (including the JavaScript delay) is recorded as
+    stage "load", the rest (rendering, encoding and transferring the image) as stage "render".
+    wkhtmltoimage runs in a process group of its own under the limits of settings (see Settings.render_timeout);
+    if it takes longer than the JavaScript delay plus render_timeout, the group is killed and a RenderTimeout
+    raised. A render that runs out of memory raises a RenderOutOfMemory.
+    With wait_limit, wkhtmltoimage is stopped with a ReadyTimeout if it still runs wait_limit seconds after the
+    page has been loaded (or READY_LOAD_TIMEOUT seconds after its start if it never reports that).
+    """
+    settings = settings or Settings()
+    env = dict(os.environ, DISPLAY=display)
+    start = time.perf_counter()
+    process = subprocess.Popen([requireTool(WKHTMLTOIMAGE)] + arguments + ["-"], env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    try:
+        limitResources(process.pid, settings)
+    except (OSError, ValueError):
+        os.killpg(process.pid, signal.SIGKILL)
+        process.communicate()
+        raise
+    image = bytearray()
+    output = bytearray()
+    loaded = None
+    hard_deadline = None
+    if settings.render_timeout:
+        hard_deadline = start + settings.render_timeout + javascriptDelay(arguments) / 1000
+    ready_deadline = None if wait_limit is None else start + READY_LOAD_TIMEOUT
+    waiting = wait_limit is not None
+    # read both pipes as data arrives, a full pipe would block wkhtmltoimage
+    with selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ, image)
+        selector.register(process.stderr, selectors.EVENT_READ, output)
+        while selector.get_map():
+            deadline = min((d for d in (hard_deadline, ready_deadline) if d is not None), default=None)
+            # checked before every select, so that a render that keeps writing output is stopped, too
+            if deadline is not None and time.perf_counter() >= deadline:
+                # the whole group, in case wkhtmltoimage started processes of its own
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(process.pid, signal.SIGKILL)
+                _, _, usage = os.wait4(process.pid, 0)
+                process.returncode = -signal.SIGKILL
+                for key in list(selector.get_map().values()):
+                    key.fileobj.close()
+                metrics.childUsage(usage)
+                metrics.addStage("load", time.perf_counter() - start)
+                if deadline == ready_deadline:
+                    raise ReadyTimeout(time.perf_counter() - start, output.decode(errors="replace"))
+                raise RenderTimeout(time.perf_counter() - start, output.decode(errors="replace"))
+            events = selector.select(None if deadline is None else max(deadline - time.perf_counter(), 0))
+            for key, _ in events:
+                chunk = os.read(key.fd, READ_SIZE)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                key.data.extend(chunk)
+                if waiting and key.data is output and b"100%" in output:
+                    # the progress bar is complete once the page is loaded; from now on it waits for the signal
+                    ready_deadline = time.perf_counter() + wait_limit
+                    waiting = False
+                if loaded is None and key.data is output and b"Rendering" in output:
+                    # wkhtmltoimage prints "Loading page (1/2)" and later "Rendering (2/2)" unless --quiet is given
+                    loaded = time.perf_counter()
+
+    # wait4 instead of wait to get the CPU time and peak memory of wkhtmltoimage alone
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = _exitCode(status)
+    end = time.perf_counter()
+
+    metrics.childUsage(usage)
+    if loaded is not None:
+        metrics.addStage("load", loaded - start)
+        metrics.addStage("render", end - loaded)
+    else:
+        metrics.addStage("render", end - start)
+
+    if process.returncode != 0:
+        raise renderFailure(process.returncode, output, usage, settings)
+    return bytes(image)
+
+
+def renderWhenReady(arguments, display, metrics, settings):
+    """ Render with wkhtmltoimage; with settings.ready "status:VALUE" as soon as the page sets window.status to
+    VALUE. The JavaScript delay of the arguments is the upper bound of the wait; if the page is not ready by then,
+    it is rendered again with the delay.
+    """
+    ready = settings.ready
+    if ready is None or WINDOW_STATUS_OPTION in arguments:
+        return render(arguments, display, metrics, settings)
+    if not ready.startswith("status:"):
+        raise ValueError("PYVISUALCOMPARE_READY={} needs PYVISUALCOMPARE_RENDERER=webengine".format(ready))
+
+    delay = javascriptDelay(arguments)
+    ready_arguments = list(arguments)
+    if DELAY_OPTION in arguments[:-1]:
+        i = arguments.index(DELAY_OPTION)
+        del ready_arguments[i:i + 2]
+    # wkhtmltoimage would wait for the delay after the status is set, too
+    ready_arguments = [WINDOW_STATUS_OPTION, ready[len("status:"):], DELAY_OPTION, "0"] + ready_arguments
+    try:
+        data = render(ready_arguments, display, metrics, settings, wait_limit=delay / 1000)
+    except ReadyTimeout:
+        metrics.set(ready="timeout")
+        return render(arguments, display, metrics, settings)
+    metrics.set(ready="status")
+    return data
+
+
+def renderImage(job, pool, metrics, settings=None):
+    """ Render as little of a job's page as its areas of interest need and return the encoded image """
+    settings = settings or Settings()
+    # tracked areas are searched in the full page, also a bit below their last position
+    crop = not settings.track
+    height = None
+    if settings.limit_height and settings.track:
+        height = job.renderHeight(settings.track_margin, trackedRegions(settings.frameCache(), job))
+    elif settings.limit_height:
+        height = job.renderHeight()
+    return renderWithPool(job.renderArguments(crop, settings.image_format, height), pool, metrics, settings)
+
+
+def expectJobs(jobs, settings):
+    """ Announce the jobs a process will check, so that jobs of the same page can share one render """
+    if settings.coalesce is not None:
+        import coalesce
+        if settings.track:
+            cache = settings.frameCache()
+            coalesce.COALESCER.expect(jobs, settings.track_margin, settings.limit_height,
+                                      lambda job: trackedRegions(cache, job))
+        else:
+            coalesce.COALESCER.expect(jobs, 0, settings.limit_height)
+
+
+def renderSharedImage(job, pool, metrics, settings):
+    """ Render a job's page, or use the render of another job with the same page (see coalesce.py). The image is
+    not cropped.
+    """
+    import coalesce  # only needed in this mode
+
+    def renderPage(height):
+        arguments = coalesce.renderParameters(job) + [FORMAT_OPTIONS[0], settings.image_format]
+        if height is not None:
+            arguments = [HEIGHT_OPTION, str(height)] + arguments
+        return renderWithPool(arguments + [job.url()], pool, metrics, settings)
+
+    if settings.track:
+        needed = coalesce.neededHeight(job, settings.track_margin, trackedRegions(settings.frameCache(), job))
+    else:
+        needed = coalesce.neededHeight(job)
+    if not settings.limit_height:
+        needed = None
+    return coalesce.COALESCER.render(coalesce.renderKey(job), needed, settings.coalesce, settings.frameCache(),
+                                     settings.state_dir, renderPage, metrics)
+
+
+def renderWithPool(arguments, pool, metrics, settings):
+    """ Render with the given wkhtmltoimage parameters on a display (or web renderer) leased from the pool """
+    if settings.image_format not in IMAGE_FORMATS:
+        raise ValueError("Unsupported image format {}, expected one of {}".format(
+            settings.image_format, ", ".join(IMAGE_FORMATS)))
+    if settings.ready not in (None, "stable") and not settings.ready.startswith("status:"):
+        raise ValueError("Unsupported readiness signal {}, expected stable or status:VALUE".format(settings.ready))
+
+    lease_start = time.perf_counter()
+    with pool.lease() as display:
+        # includes starting an Xvfb server (or web renderer) if the pool had no healthy one
+        metrics.addStage("lease", time.perf_counter() - lease_start)
+        if isinstance(display, str):
+            data = renderWhenReady(arguments, display, metrics, settings)
+        else:
+            # a worker of a webrenderer.WebRendererPool renders by itself
+            data = display.render(arguments, metrics, timeout=settings.render_timeout, ready=settings.ready)
+    metrics.set(image_bytes=len(data))
+    return data
+
+
+def cropRegions(job, data, cropped=True):
+    """ Decode the pixels of all areas of interest of a job from its rendered image. Returns a list of (name, Frame).
+    cropped tells whether wkhtmltoimage already cropped a single area.
+    """
+    if not job.regions or (cropped and len(job.regions) == 1):
+        # wkhtmltoimage crops by itself, so the image only contains the area of interest
+        name = job.regions[0][0] if job.regions else None
+        return [(name, decodeImage(data))]
+
+    # decode only the part of the page that contains all areas, then cut out every area
+    bounds = boundingRect([rect for _, rect in job.regions])
+    frame = decodeImage(data, bounds)
+    left, top = max(bounds[0], 0), max(bounds[1], 0)
+    return [(name, frame.crop((x - left, y - top, w, h))) for name, (x, y, w, h) in job.regions]
+
+
+def trackedRegions(cache, job):
+    """ Areas of interest of a job at the positions the last check found them at (see trackRegions), or where
+    they were selected before the first check
+    """
+    regions = []
+    for name, (x, y, w, h) in job.regions:
+        position = cache.load(job.key(), "position-{}".format(name or "crop"))
+        if position:
+            x, y = json.loads(position.decode())
+        regions.append((name, (x, y, w, h)))
+    return regions
+
+
+def trackRegions(cache, job, data, settings, metrics):
+    """ Find every area of interest of a job in the rendered full page by the template stored at the first check
+    and decode its pixels at the found position. Returns a list of (name, Frame).
+    """
+    import tracking  # only needed in this mode, so numpy is not required otherwise
+
+    positions = [tuple(rect[:2]) for _, rect in trackedRegions(cache, job)]
+
+    # decode only the part of the page that contains the search windows of all areas
+    margin = settings.track_margin
+    bounds = boundingRect([(x - margin, y - margin, w + 2 * margin, h + 2 * margin)
+                           for (x, y), (_, (_, _, w, h)) in zip(positions, job.regions)])
+    frame = decodeImage(data, bounds)
+    left, top = max(bounds[0], 0), max(bounds[1], 0)
+    gray = None
+
+    regions = []
+    found = {}
+    for (x, y), (name, (_, _, w, h)) in zip(positions, job.regions):
+        ref = name or "crop"
+        template = cache.load(job.key(), "template-{}".format(ref))
+        if template is None:
+            # first check: the selected pixels become the template
+            cache.store(job.key(), "template-{}".format(ref), encodePpm(frame.crop((x - left, y - top, w, h))))
+        else:
+            if gray is None:
+                gray = tracking.grayArray(frame)
+            position, score = tracking.findTemplate(gray, tracking.grayArray(decodeImage(template)),
+                                                    (x - left, y - top), margin)
+            found[ref] = [position[0] + left, position[1] + top, round(score, 3)] if position else None
+            if position is not None and score >= settings.track_min_score:
+                x, y = position[0] + left, position[1] + top
+        cache.store(job.key(), "position-{}".format(ref), json.dumps([x, y]).encode())
+        regions.append((name, frame.crop((x - left, y - top, w, h))))
+    metrics.set(tracking=found)
+    return regions
+
+
+def compareWithBaseline(cache, job, name, frame, settings):
+    """ Tolerant comparison: report the hash of the cached baseline as long as the frame does not differ
+    significantly from it. A significant change becomes the new baseline.
+    """
+    import diffengine  # only needed in this mode, so numpy is not required otherwise
+
+    ref = "baseline-{}".format(name or "crop")
+    data = cache.load(job.key(), ref)
+    baseline = None if data is None else decodeImage(data)
+
+    boxes = None
+    if baseline is not None:
+        diff = diffengine.compareFrames(baseline, frame, settings.block_size, settings.diff_method,
+                                        settings.tolerance)
+        if not diff.changed:
+            return CheckResult(hashFrame(baseline, settings.algorithm), name=name)
+        boxes = diff.boxes
+
+    cache.store(job.key(), ref, encodePpm(frame))
+    return CheckResult(hashFrame(frame, settings.algorithm), boxes, name)
+
+
+def precheckJob(job, settings, metrics):
+    """ Fetch the page without rendering it. Returns (state, fingerprint, validators, results) where results are the
+    CheckResults of the last render if the page did not change since, otherwise None. fingerprint is None if the
+    page could not be fetched; it is rendered anyway then.
+    """
+    import precheck  # urllib.request is only needed in this mode
+
+    state = precheck.PrecheckState.forJob(settings.state_dir, job)
+    try:
+        fingerprint, validators = precheck.pageFingerprint(job.url(), state.validators())
+    except (OSError, ValueError) as e:
+        metrics.set(precheck="failed: {}".format(e))
+        return state, None, None, None
+
+    # hashes of another algorithm or comparison mode cannot be reported again
+    fingerprint = "{}:{}:{}".format(settings.algorithm, settings.tolerance, fingerprint)
+    previous = state.unchangedResults(fingerprint, settings.precheck_max_age)
+    metrics.set(precheck="unchanged" if previous else "changed")
+    if previous is None:
+        return state, fingerprint, validators, None
+    state.update(fingerprint, validators, previous, rendered=False)
+    return state, fingerprint, validators, [CheckResult(digest, name=name) for name, digest in previous]
+
+
+def check(job, pool, settings, metrics=None):
+    """ Render a job and return a list with a CheckResult for every area of interest.
+    The duration of the stages precheck (if enabled), coalesce (waiting for the render of another job, see
+    coalesce.py), lease (of an Xvfb display), load, render, decode (or track), hash, compare (tolerant comparison
+    only), cache and total are recorded in metrics.
+    """
+    metrics = metrics or CheckMetrics(job)
+    start = time.perf_counter()
+    try:
+        precheck_state = fingerprint = validators = None
+        if settings.precheck:
+            with metrics.stage("precheck"):
+                precheck_state, fingerprint, validators, results = precheckJob(job, settings, metrics)
+            if results is not None:
+                metrics.set(exit="ok")
+                return results
+
+        if settings.coalesce is not None:
+            data = renderSharedImage(job, pool, metrics, settings)
+        else:
+            data = renderImage(job, pool, metrics, settings)
+        cache = settings.frameCache() if settings.usesCache() else None
+        if settings.keep_frames:
+            with metrics.stage("cache"):
+                metrics.set(frame=cache.store(job.key(), "frame", data))
+
+        if settings.track and job.regions:
+            with metrics.stage("track"):
+                regions = trackRegions(cache, job, data, settings, metrics)
+        else:
+            with metrics.stage("decode"):
+                regions = cropRegions(job, data, cropped=settings.coalesce is None)
+        metrics.set(frames=[[frame.width, frame.height] for _, frame in regions])
+
+        results = []
+        for name, frame in regions:
+            if settings.tolerance is None:
+                with metrics.stage("hash"):
+                    results.append(CheckResult(hashFrame(frame, settings.algorithm), name=name))
+            else:
+                with metrics.stage("compare"):
+                    results.append(compareWithBaseline(cache, job, name, frame, settings))
+
+        if cache is not None:
+            cache.pruneRefs(job.key(), settings.cacheRefs(job))
+        if fingerprint is not None:
+            precheck_state.update(fingerprint, validators, [(result.name, result.digest) for result in results])
+    except RenderError as e:
+        metrics.set(exit="render-" + e.reason, returncode=e.returncode)
+        raise
+    except Exception as e:
+        metrics.set(exit="error", error=str(e))
+        raise
+    finally:
+        metrics.addStage("total", time.perf_counter() - start)
+
+    metrics.set(exit="ok")
+    return results
+
+
+def recordCheck(settings, metrics, results):
+    """ Write the metrics of a check and add its results (CheckResults, none if it failed) to the history """
+    if settings.metrics_path:
+        metrics.write(settings.metrics_path)
+    if settings.history_path:
+        import history  # sqlite3 is only needed in this mode
+        history.storeResults(settings.history_path, settings.history_days, metrics.record,
+                             [(result.name, result.digest) for result in results])
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        sys.stderr.write("Usage: {0} --crop-x X --crop-y Y --crop-w W --crop-h H [wkhtmltoimage parameters] URL\n"
+                         "       {0} --region NAME=X,Y,W,H [--region ...] [wkhtmltoimage parameters] URL\n"
+                         .format(os.path.basename(sys.argv[0])))
+        return 2
+
+    try:
+        job = parseJobArguments(argv)
+        settings = Settings.fromEnvironment()
+    except ValueError as e:
+        # e.g. an invalid --region or a setting that is not a number
+        sys.stderr.write("{}\n".format(e))
+        return 2
+    metrics = CheckMetrics(job)
+    results = []
+    try:
+        results = check(job, renderPool(), settings, metrics)
+    except RenderError as e:
+        # same behavior as pyvisualcompare-md5.sh: show what went wrong and pass on the exit code; renders stopped
+        # by the watchdog end with their own exit code and say why
+        sys.stdout.write(e.output)
+        if e.reason != RenderError.reason:
+            sys.stdout.write("{}: {}\n".format(e.reason, e))
+        return e.exitCode()
+    except ValueError as e:
+        # e.g. a parameter the renderer does not support or an unsupported image format; reported like a failed
+        # render instead of with a traceback
+        sys.stdout.write("{}\n".format(e))
+        return 2
+    finally:
+        recordCheck(settings, metrics, results)
+        if settings.usesCache():
+            settings.frameCache().evict()
+
+    for result in results:
+        if result.boxes:
+            # not part of the output for urlwatch, which would otherwise report another change on the next check
+            sys.stderr.write("Changed blocks of {} (x, y, w, h): {}\n".format(
+                result.name or "area", " ".join(map(str, result.boxes))))
+        # same output format as md5sum (like pyvisualcompare-md5.sh), with the name of the area instead of "-"
+        print("{}  {}".format(result.digest, result.name or "-"))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
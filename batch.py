@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Batch mode of the backend checker: checks many watch jobs in one process with bounded parallelism.
+
+The job list is a JSON file (or "-" for stdin) containing a list of objects like
+    {"name": "python.org", "crop": [8, 5, 232, 58], "parameters": ["--javascript-delay", "350", "python.org"]}
+where "parameters" are the wkhtmltoimage parameters as generated by MyMainWindow.getWkhtmlParameters and
+"crop" is the area of interest (optional). Instead of "crop", several named areas can be given as
+    "regions": {"title": [8, 5, 232, 58], "news": [8, 300, 600, 200]}
+
+One JSON object per line is written for every finished job, e.g.
+    {"name": "python.org", "url": "python.org", "status": "ok", "hash": "d41d8cd98f00b204e9800998ecf8427e"}
+("changed" is added with the changed areas if the tolerant comparison found a change, "stages" holds the duration
+of every stage of the check). Jobs with named areas get
+    "regions": [{"name": "title", "hash": "..."}, {"name": "news", "hash": "..."}]
+instead of "hash".
+or, if rendering failed,
+    {"name": "python.org", "url": "python.org", "status": "error", "returncode": 1, "error": "..."}
+where the status is "timeout" or "oom" instead of "error" if the render was stopped by the watchdog (see
+backend.render).
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+from backend import Job, RenderError, Settings, check, expectJobs, recordCheck, renderPool
+from frames import HASH_ALGORITHMS
+from metrics import CheckMetrics
+
+
+def jobFromEntry(entry, index):
+    """ Job of an entry of the job list; index is the job's name if the entry has none """
+    if entry.get("crop"):
+        regions = [(None, tuple(entry["crop"]))]
+    else:
+        regions = [(name, tuple(rect)) for name, rect in entry.get("regions", {}).items()]
+    return Job(entry["parameters"], regions, entry.get("name") or str(index))
+
+
+def loadJobs(f):
+    return [jobFromEntry(entry, i) for i, entry in enumerate(json.load(f))]
+
+
+def checkResult(job, pool, settings):
+    """ Check a job and describe the outcome as a dict, never raises for a failed render """
+    result = {"name": job.name, "url": job.url()}
+    metrics = CheckMetrics(job)
+    check_results = []
+    start = time.monotonic()
+    try:
+        region_results = []
+        check_results = check(job, pool, settings, metrics)
+        for check_result in check_results:
+            region_result = {"name": check_result.name, "hash": check_result.digest}
+            if check_result.boxes:
+                region_result["changed"] = check_result.boxes
+            region_results.append(region_result)
+
+        result["status"] = "ok"
+        if len(region_results) == 1 and region_results[0]["name"] is None:
+            del region_results[0]["name"]
+            result.update(region_results[0])
+        else:
+            result["regions"] = region_results
+    except RenderError as e:
+        error = e.output if e.reason == RenderError.reason else "{}{}: {}\n".format(e.output, e.reason, e)
+        result.update(status=e.reason, returncode=e.returncode, error=error)
+    except Exception as e:
+        result.update(status="error", returncode=None, error=str(e))
+    result["duration"] = round(time.monotonic() - start, 3)
+    result["stages"] = metrics.record["stages"]
+    try:
+        recordCheck(settings, metrics, check_results)
+    except Exception as e:
+        # e.g. a locked history database; the result of the check is still valid, and the other jobs go on
+        sys.stderr.write("Could not record the check of {}: {}\n".format(job.name, e))
+    return result
+
+
+def runBatch(jobs, pool, settings, workers, per_host):
+    """ Check all jobs with at most workers renders at a time and at most per_host renders per host.
+    Yields the results in the order the jobs finish.
+    """
+    pending = list(jobs)
+    running = {}  # future -> job
+    host_load = collections.Counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            # start as many jobs as the limits allow; jobs of busy hosts are skipped, not waited for
+            for job in list(pending):
+                if len(running) >= workers:
+                    break
+                if host_load[job.host()] >= per_host:
+                    continue
+                pending.remove(job)
+                host_load[job.host()] += 1
+                running[executor.submit(checkResult, job, pool, settings)] = job
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                host_load[job.host()] -= 1
+                yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check many pyvisualcompare watch jobs in parallel.")
+    parser.add_argument("jobs", help="JSON file with the job list or - for stdin")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="maximum number of concurrent renders (default: number of CPUs)")
+    parser.add_argument("--per-host", type=int, default=2,
+                        help="maximum number of concurrent renders per host (default: 2)")
+    parser.add_argument("--hash", choices=HASH_ALGORITHMS,
+                        help="hash algorithm for the pixels of the area of interest (default: md5)")
+    parser.add_argument("--tolerance", type=float,
+                        help="enable the tolerant comparison with this threshold per block (see diffengine.py)")
+    parser.add_argument("-o", "--output", default="-", help="output file for the results (default: stdout)")
+    args = parser.parse_args(argv)
+
+    if args.jobs == "-":
+        jobs = loadJobs(sys.stdin)
+    else:
+        with open(args.jobs, "r") as f:
+            jobs = loadJobs(f)
+
+    settings = Settings.fromEnvironment()
+    if args.hash:
+        settings.algorithm = args.hash
+    if args.tolerance is not None:
+        settings.tolerance = args.tolerance
+
+    # one display (or web renderer) per concurrent render; the environment can still ask for more
+    pool = renderPool()
+    pool.size = max(pool.size, args.workers)
+    expectJobs(jobs, settings)
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    failed = 0
+    try:
+        for result in runBatch(jobs, pool, settings, args.workers, max(1, args.per_host)):
+            failed += result["status"] != "ok"
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if settings.usesCache():
+            settings.frameCache().evict()
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of the backend checker. Fixture pages are served by a local HTTP server, so results do not
+depend on the network. Every check runs through the same render, crop and hash functions the backend uses and the
+latency of each stage is measured. For every concurrency level, the benchmark reports latency percentiles per stage,
+the throughput in jobs per minute and the peak memory of the renders, and writes everything to a JSON file so that
+runs can be compared. The fixture server answers conditional requests, so the pre-check (see precheck.py) can be
+measured too.
+
+    ./benchmark.py --concurrency 1,4,8 --jobs 32 --output bench.json
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+from backend import Job, Settings, check, renderPool
+from metrics import CheckMetrics
+
+FIXTURES = {
+    "static": """<html><body style="font-family: sans-serif">
+<h1>Static page</h1>
+<p>Python 3.8.0 is the newest major release of the Python programming language.</p>
+</body></html>""",
+
+    # content appears only after the JavaScript delay
+    "delayed": """<html><body style="font-family: sans-serif">
+<h1>Delayed page</h1><p id="content">loading...</p>
+<script>setTimeout(function() {
+    document.getElementById("content").innerHTML = "Content inserted by JavaScript";
+}, 200);</script>
+</body></html>""",
+
+    "tall": """<html><body style="font-family: sans-serif">
+<h1>Tall page</h1>
+""" + "\n".join("<p>Line {} of a very tall page</p>".format(i) for i in range(400)) + """
+<div style="height: 12000px; background: linear-gradient(#fff, #36c)"></div>
+</body></html>""",
+}
+
+# area of interest per fixture, (x, y, w, h)
+FIXTURE_AREAS = {"static": (0, 0, 400, 120), "delayed": (0, 0, 400, 120), "tall": (0, 200, 600, 400)}
+STAGES = ("lease", "load", "render", "decode", "hash", "total")
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = FIXTURES.get(self.path.strip("/"))
+        if body is None:
+            self.send_error(404)
+            return
+        body = body.encode()
+        # conditional requests, as used by the pre-check
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # keep the benchmark output clean
+
+
+def startFixtureServer():
+    """ Serve the fixture pages on a free local port in a background thread """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timedCheck(job, pool, settings):
+    """ Check a job like the backend does and return its metrics record, see metrics.CheckMetrics """
+    metrics = CheckMetrics(job)
+    check(job, pool, settings, metrics)
+    return metrics.record
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of a non-empty list """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def summarize(values):
+    return {"p50": percentile(values, 0.5), "p90": percentile(values, 0.9), "p99": percentile(values, 0.99),
+            "max": max(values), "mean": sum(values) / len(values)}
+
+
+def peakRssKilobytes(records):
+    """ Peak resident set size of the largest render process (wkhtmltoimage) of the given checks [KiB] or None if
+    none of them started one, e.g. because the pre-check skipped the render. getrusage cannot be used per level:
+    it reports the peak over the whole lifetime of the benchmark.
+    """
+    return max((record["child"]["max_rss_kib"] for record in records if "child" in record), default=None)
+
+
+def runLevel(jobs, pool, concurrency, settings):
+    """ Check all jobs with the given number of concurrent checks """
+    records = []
+    errors = 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(timedCheck, job, pool, settings) for job in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                records.append(future.result())
+            except Exception as e:
+                errors += 1
+                sys.stderr.write("Check failed: {}\n".format(e))
+    elapsed = time.perf_counter() - start
+
+    timings = [record["stages"] for record in records]
+    result = {"concurrency": concurrency, "jobs": len(jobs), "errors": errors, "elapsed": elapsed,
+              "jobs_per_minute": 60 * len(timings) / elapsed, "peak_rss_kib": peakRssKilobytes(records)}
+    if timings:
+        # "load" is missing if wkhtmltoimage runs with --quiet
+        result["stages"] = {stage: summarize([t[stage] for t in timings if stage in t])
+                            for stage in STAGES if any(stage in t for t in timings)}
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pyvisualcompare backend with local fixture pages.")
+    parser.add_argument("--concurrency", default="1,2,4",
+                        help="comma separated list of concurrency levels (default: 1,2,4)")
+    parser.add_argument("--jobs", type=int, default=12, help="number of checks per concurrency level (default: 12)")
+    parser.add_argument("--fixtures", default=",".join(FIXTURES),
+                        help="comma separated list of fixture pages (default: all)")
+    parser.add_argument("--delay", type=int, default=350, help="JavaScript delay [ms] (default: 350)")
+    parser.add_argument("--hash", default="md5", help="hash algorithm (default: md5)")
+    parser.add_argument("--precheck", action="store_true",
+                        help="enable the pre-check, so only the first check of a fixture renders it")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="result file (default: benchmark.json)")
+    args = parser.parse_args(argv)
+
+    levels = [int(level) for level in args.concurrency.split(",")]
+    fixtures = args.fixtures.split(",")
+
+    server = startFixtureServer()
+    base_url = "http://127.0.0.1:{}/".format(server.server_address[1])
+    pool = renderPool()
+    pool.size = max(pool.size, max(levels))
+    state_dir = tempfile.TemporaryDirectory(prefix="pyvisualcompare-benchmark-")
+    settings = Settings(algorithm=args.hash, state_dir=state_dir.name, precheck=args.precheck)
+
+    results = {"started": time.time(), "python": platform.python_version(), "machine": platform.machine(),
+               "precheck": args.precheck, "fixtures": {}}
+    try:
+        for fixture in fixtures:
+            job = Job(["--javascript-delay", str(args.delay), base_url + fixture],
+                      [(None, FIXTURE_AREAS[fixture])], fixture)
+            # warm up: starts the Xvfb displays (or web renderers), which is not part of a check
+            timedCheck(job, pool, settings)
+
+            results["fixtures"][fixture] = []
+            for level in levels:
+                level_result = runLevel([job] * args.jobs, pool, level, settings)
+                results["fixtures"][fixture].append(level_result)
+                stages = level_result.get("stages", {})
+                print("{:8} concurrency {:3}: {:7.1f} jobs/min, total p50 {:.3f} s, p90 {:.3f} s, {} errors".format(
+                    fixture, level, level_result["jobs_per_minute"], stages.get("total", {}).get("p50", 0),
+                    stages.get("total", {}).get("p90", 0), level_result["errors"]))
+    finally:
+        server.shutdown()
+        state_dir.cleanup()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""
+Content-addressed on-disk cache for screenshots and baselines that is shared by all checker processes.
+
+Every stored image is an object named after the hash of its content, so identical frames of different jobs are
+only stored once. Jobs point to objects with small reference files (e.g. the baseline of an area or the last
+full frame of a page). All files are written to a temporary file first and then renamed, so concurrent processes
+never see partially written files. The total size of the objects is kept below a byte budget by deleting the
+least recently used objects; a reference to a deleted object behaves like a missing reference.
+
+Objects that a reference points to are not evicted, otherwise the baseline of a rarely checked job would be
+deleted by the frames of busier ones and its next check would report a change. Instead, references are deleted
+once a job stops using them (see pruneRefs) or has not used them for max_ref_age seconds, e.g. because the job was
+removed from the configuration, which makes their objects evictable. Objects used within the last EVICT_GRACE
+seconds are not evicted either, since the reference to a stored object is written only after it was stored.
+The full frames of jobs (UNPINNED_REFS) are the exception: they are large and only kept for inspection, so they are
+evicted like unreferenced objects to keep the cache within its budget.
+"""
+import contextlib
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+DEFAULT_REF_AGE = 30 * 86400
+# objects used less than this long before or during an eviction are kept [s]: a reference to an object is written
+# right after put or store used it, possibly after evict has read the references
+EVICT_GRACE = 60
+# references that do not keep their objects from being evicted
+UNPINNED_REFS = frozenset({"frame"})
+
+
+class FrameCache:
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE, max_ref_age=DEFAULT_REF_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_ref_age = max_ref_age
+        self.objects_dir = os.path.join(directory, "objects")
+        self.refs_dir = os.path.join(directory, "refs")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+
+    @staticmethod
+    def contentHash(data):
+        return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+    def _objectPath(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _refPath(self, job_key, ref):
+        return os.path.join(self.refs_dir, job_key, ref)
+
+    @staticmethod
+    def _writeAtomically(path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        except FileNotFoundError:
+            # the empty directory of a job was just removed by evict
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(temp_path)
+            raise
+
+    def put(self, data):
+        """ Store data and return its content hash. Data that is already stored is not written again. """
+        digest = self.contentHash(data)
+        path = self._objectPath(digest)
+        try:
+            os.utime(path)  # already stored, mark as recently used
+        except FileNotFoundError:
+            self._writeAtomically(path, data)
+        return digest
+
+    def get(self, digest):
+        """ Return the stored data with the given content hash or None """
+        path = self._objectPath(digest)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)  # may have been evicted right after it was read
+        return data
+
+    def setRef(self, job_key, ref, digest):
+        self._writeAtomically(self._refPath(job_key, ref), digest.encode())
+
+    def getRef(self, job_key, ref):
+        """ Return the content hash a job's reference points to or None """
+        path = self._refPath(job_key, ref)
+        try:
+            with open(path, "r") as f:
+                digest = f.read().strip() or None
+            os.utime(path)  # still used, see evict
+        except FileNotFoundError:
+            return None
+        return digest
+
+    def pruneRefs(self, job_key, refs):
+        """ Delete all references of a job except the given ones, e.g. baselines of a comparison mode that was
+        turned off
+        """
+        try:
+            entries = list(os.scandir(os.path.join(self.refs_dir, job_key)))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.name not in refs and not entry.name.startswith(".tmp-"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(entry.path)
+
+    def store(self, job_key, ref, data):
+        """ Store data and point a reference of a job to it """
+        digest = self.put(data)
+        self.setRef(job_key, ref, digest)
+        return digest
+
+    def load(self, job_key, ref):
+        """ Return the data a reference of a job points to or None """
+        digest = self.getRef(job_key, ref)
+        return None if digest is None else self.get(digest)
+
+    def _referencedObjects(self):
+        """ Content hashes of all references that are still used, except for UNPINNED_REFS. References that were
+        not used for max_ref_age seconds are deleted, and so are the directories of jobs without references.
+        """
+        referenced = set()
+        expired = time.time() - self.max_ref_age
+        for job in os.scandir(self.refs_dir):
+            for entry in os.scandir(job.path):
+                try:
+                    if entry.stat().st_mtime < expired:
+                        os.unlink(entry.path)
+                        continue
+                    if entry.name.startswith(".tmp-") or entry.name in UNPINNED_REFS:
+                        continue
+                    with open(entry.path, "r") as f:
+                        referenced.add(f.read().strip())
+                except FileNotFoundError:
+                    continue
+            with contextlib.suppress(OSError):
+                os.rmdir(job.path)  # only if empty
+        return referenced
+
+    def evict(self):
+        """ Delete least recently used objects that no pinning reference points to until the cache fits into its byte
+        budget. Only one process evicts at a time; others skip eviction instead of waiting.
+        """
+        lock_fd = os.open(os.path.join(self.directory, "evict.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            # before reading the references, so that an object whose reference is written later is still recent
+            recent = time.time() - EVICT_GRACE
+            referenced = self._referencedObjects()
+            objects = []
+            total = 0
+            for prefix in os.scandir(self.objects_dir):
+                for entry in os.scandir(prefix.path):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    if entry.name.startswith(".tmp-"):
+                        # left behind by a crashed writer
+                        if stat.st_mtime < time.time() - 3600:
+                            with contextlib.suppress(FileNotFoundError):
+                                os.unlink(entry.path)
+                        continue
+                    total += stat.st_size
+                    if entry.name not in referenced and stat.st_mtime < recent:
+                        objects.append((stat.st_mtime, stat.st_size, entry.path))
+
+            objects.sort()
+            for _, size, path in objects:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    if os.stat(path).st_mtime >= recent:
+                        continue  # used by put or get since it was listed
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        finally:
+            os.close(lock_fd)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Headless command line interface of pyvisualcompare for scripts and servers. It never imports PyQt5 and
+only imports the backend modules a command needs, so it starts quickly.
+
+    cli.py config --url https://www.python.org --area title=8,5,232,58   print an urlwatch job
+    cli.py check [backend parameters]                                    same as backend.py
+    cli.py batch [batch parameters]                                      same as batch.py
+    cli.py schedule [scheduler parameters]                               same as scheduler.py
+    cli.py history summary --since 7                                     same as history.py
+    cli.py import-time                                                   check the import time budget
+"""
+import argparse
+import re
+import sys
+
+# budget for the cumulative import time of these modules in a fresh interpreter [ms]
+IMPORT_BUDGET_MS = {"cli": 30, "backend": 60, "batch": 80}
+
+
+def parseArea(value):
+    name, _, rect = value.rpartition("=")
+    rect = tuple(int(v) for v in rect.split(","))
+    if len(rect) != 4:
+        raise argparse.ArgumentTypeError("expected [NAME=]X,Y,W,H")
+    return name or None, rect
+
+
+def parseSize(value):
+    match = re.fullmatch(r"(\d+)x(\d+)", value)
+    if match is None:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT")
+    return int(match.group(1)), int(match.group(2))
+
+
+def configCommand(args):
+    from urlwatchconfig import urlwatchConfig, wkhtmlParameters
+
+    areas = args.area
+    if len(areas) > 1:
+        # several areas need names; unnamed ones are numbered like in the GUI
+        areas = [(name or "area{}".format(i + 1), rect) for i, (name, rect) in enumerate(areas)]
+    if args.size:
+        parameters = wkhtmlParameters(args.url, args.delay, args.size[0], args.size[1])
+    else:
+        parameters = wkhtmlParameters(args.url, args.delay)
+    print(urlwatchConfig(areas, parameters, args.name))
+    return 0
+
+
+def measureImportTime(module):
+    """ Import a module in a fresh interpreter and return its cumulative import time [ms] and whether
+    PyQt5 was imported along with it
+    """
+    import subprocess
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError("Importing {} failed:\n{}".format(module, result.stderr))
+
+    cumulative = None
+    qt_imported = False
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) != 3:
+            continue
+        name = fields[2].strip()
+        if name.startswith("PyQt5"):
+            qt_imported = True
+        if name == module:
+            cumulative = int(fields[1]) / 1000
+    return cumulative, qt_imported
+
+
+def importTimeCommand(args):
+    failed = False
+    for module, budget in IMPORT_BUDGET_MS.items():
+        milliseconds, qt_imported = measureImportTime(module)
+        ok = milliseconds <= budget * args.factor and not qt_imported
+        failed |= not ok
+        print("{:10} {:7.1f} ms  (budget {:.0f} ms){}  {}".format(
+            module, milliseconds, budget * args.factor, ", imports PyQt5" if qt_imported else "",
+            "ok" if ok else "FAILED"))
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    # the parameters of these commands are passed on unparsed since they contain wkhtmltoimage parameters
+    if argv and argv[0] == "check":
+        import backend
+        return backend.main(argv[1:])
+    if argv and argv[0] == "batch":
+        import batch
+        return batch.main(argv[1:])
+    if argv and argv[0] == "schedule":
+        import scheduler
+        return scheduler.main(argv[1:])
+    if argv and argv[0] == "history":
+        import history
+        return history.main(argv[1:])
+
+    parser = argparse.ArgumentParser(description="Headless interface of pyvisualcompare.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("check", help="check a single job, see backend.py")
+    subparsers.add_parser("batch", help="check many jobs in parallel, see batch.py")
+    subparsers.add_parser("schedule", help="check jobs at their own intervals, see scheduler.py")
+    subparsers.add_parser("history", help="summarize the history of checks, see history.py")
+
+    config_parser = subparsers.add_parser("config", help="print an urlwatch job for known areas")
+    config_parser.add_argument("--url", required=True)
+    config_parser.add_argument("--area", type=parseArea, action="append", required=True,
+                               help="area of interest [NAME=]X,Y,W,H, can be given several times")
+    config_parser.add_argument("--delay", type=int, default=350, help="JavaScript delay [ms] (default: 350)")
+    config_parser.add_argument("--size", type=parseSize, help="static size of the page, e.g. 1280x1024")
+    config_parser.add_argument("--name", default="ExampleName", help="name of the urlwatch job")
+    config_parser.set_defaults(function=configCommand)
+
+    import_parser = subparsers.add_parser("import-time", help="check that the import time stays within its budget")
+    import_parser.add_argument("--factor", type=float, default=1.0,
+                               help="multiply the budgets, e.g. for slow machines (default: 1)")
+    import_parser.set_defaults(function=importTimeCommand)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
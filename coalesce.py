@@ -0,0 +1,203 @@
+"""
+Render coalescing: jobs that watch the same page with the same wkhtmltoimage parameters and only differ in their
+areas of interest share one render of the page instead of rendering it once each, so the number of renders grows
+with the number of pages instead of the number of jobs.
+
+Jobs are grouped by a render key made from their parameters without the ones that only depend on the areas
+(--crop-* and --region) and with a normalized URL. The shared render is not cropped and is as high as the lowest
+area of any job that uses it (rounded up to HEIGHT_STEP). A --height the user gave is part of the render key and
+used as it is, since it changes the viewport and possibly the layout. A render is shared
+  - between threads of one process (batch mode, scheduler) while it is in flight; it is kept in memory only until
+    every waiting thread took it,
+  - between threads and checker processes (one per urlwatch job) through the frame cache: while one process
+    renders, the others wait for its lock, and the render is reused for window seconds.
+A failed render is never shared: the threads that waited for it render the page again.
+A job whose areas reach below a shared render renders the page again, higher; batch mode and the scheduler
+announce all their jobs beforehand (RenderCoalescer.expect), so that the first render is high enough for all.
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+# wkhtmltoimage parameters that do not change how the page looks and their number of values
+IGNORED_OPTIONS = {"--format": 1, "-f": 1, "--quiet": 0, "-q": 0}
+HEIGHT_OPTION = "--height"
+# height of shared renders is rounded up to a multiple of this [pixels], so that similar jobs can share them
+HEIGHT_STEP = 256
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalizeUrl(url):
+    """ The URL with scheme, lower case host, no default port and no fragment """
+    if "://" not in url:
+        url = "http://" + url  # wkhtmltoimage accepts URLs without scheme
+    parts = urllib.parse.urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(parts.scheme.lower()):
+        host = "{}:{}".format(host, parts.port)
+    return urllib.parse.urlunsplit((parts.scheme.lower(), host, parts.path or "/", parts.query, ""))
+
+
+def renderParameters(job):
+    """ wkhtmltoimage parameters of a job (without the URL) that change how the page looks """
+    arguments = job.wkhtml_args[:-1]
+    parameters = []
+    i = 0
+    while i < len(arguments):
+        if arguments[i] in IGNORED_OPTIONS:
+            i += 1 + IGNORED_OPTIONS[arguments[i]]
+            continue
+        parameters.append(arguments[i])
+        i += 1
+    return parameters
+
+
+def renderKey(job):
+    """ Jobs with the same render key can share a render of their page """
+    return hashlib.sha1(repr((renderParameters(job), normalizeUrl(job.url()))).encode()).hexdigest()
+
+
+def neededHeight(job, margin=0, regions=None):
+    """ Height a shared render must have for the areas of a job (plus margin), None for the whole page or the
+    height the parameters set. regions are the areas at the positions they are expected at, default the job's.
+    """
+    regions = regions or job.regions
+    if not regions or HEIGHT_OPTION in job.wkhtml_args:
+        return None
+    bottom = max(y + h for _, (_, y, _, h) in regions) + margin
+    return -(-bottom // HEIGHT_STEP) * HEIGHT_STEP
+
+
+def tallest(height, other):
+    """ The larger of two render heights, None (the whole page) is larger than any """
+    return None if height is None or other is None else max(height, other)
+
+
+def covers(height, needed):
+    """ Whether a render of the given height (None: whole page) contains what a job needs """
+    return height is None or (needed is not None and height >= needed)
+
+
+class SharedRender:
+    def __init__(self, height):
+        self.height = height
+        self.done = threading.Event()
+        self.data = None
+        self.error = None
+        self.finished = None
+        # threads that still need the render, including the one rendering it
+        self.users = 1
+
+
+class RenderCoalescer:
+    """ Shares renders by render key, see the module documentation """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._renders = {}  # render key -> SharedRender that is in flight or not taken by all its users yet
+        self._expected = {}  # render key -> height needed by the announced jobs
+
+    def expect(self, jobs, margin=0, limit_height=True, regions=None):
+        """ Announce jobs that will be checked, e.g. all jobs of a batch, so that their shared renders are high
+        enough for all of them. regions(job) returns the areas of a job at their expected positions, e.g. the
+        tracked ones.
+        """
+        with self._lock:
+            for job in jobs:
+                key = renderKey(job)
+                needed = neededHeight(job, margin, regions(job) if regions else None) if limit_height else None
+                self._expected[key] = tallest(needed, self._expected.get(key, 0))
+
+    def render(self, key, needed, window, cache, state_dir, renderFunction, metrics):
+        """ Return the encoded image of a render with the given key that is at least needed pixels high.
+        renderFunction(height) renders the page if no shared render can be used.
+        """
+        while True:
+            with self._lock:
+                shared = self._renders.get(key)
+                if shared is not None and covers(shared.height, needed) and \
+                        (not shared.done.is_set() or time.monotonic() - shared.finished <= window):
+                    shared.users += 1
+                    owner = False
+                else:
+                    needed = tallest(needed, self._expected.get(key, 0))
+                    shared = SharedRender(needed)
+                    self._renders[key] = shared
+                    owner = True
+
+            if owner:
+                break
+            with metrics.stage("coalesce"):
+                shared.done.wait()
+            self._release(key, shared)
+            if shared.error is None:
+                metrics.set(coalesced="shared")
+                return shared.data
+            # the render failed, which may not happen again: render the page (or wait for another thread that does)
+
+        try:
+            shared.data = self._renderOrLoad(key, needed, window, cache, state_dir, renderFunction, metrics)
+        except Exception as e:
+            shared.error = e
+            raise
+        finally:
+            shared.finished = time.monotonic()
+            shared.done.set()
+            self._release(key, shared)
+        return shared.data
+
+    def _release(self, key, shared):
+        """ A user took the result of a shared render; the render is forgotten once all users took it or it
+        failed, so that a long-running process does not keep a render of every page in memory
+        """
+        with self._lock:
+            shared.users -= 1
+            if (shared.users == 0 or shared.error is not None) and self._renders.get(key) is shared:
+                del self._renders[key]
+
+    @staticmethod
+    def _renderOrLoad(key, needed, window, cache, state_dir, renderFunction, metrics):
+        """ Reuse a fresh render of another process or render the page, one process at a time per key """
+        directory = os.path.join(state_dir, "coalesce")
+        os.makedirs(directory, exist_ok=True)
+        lock_fd = os.open(os.path.join(directory, key + ".lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            with metrics.stage("coalesce"):
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)  # released when lock_fd is closed
+            state_path = os.path.join(directory, key + ".json")
+            try:
+                with open(state_path, "r") as f:
+                    state = json.load(f)
+            except (FileNotFoundError, ValueError):
+                state = None
+            if state is not None and time.time() - state["time"] <= window and covers(state["height"], needed):
+                data = cache.get(state["digest"])
+                if data is not None:
+                    metrics.set(coalesced="cached")
+                    return data
+
+            data = renderFunction(needed)
+            state = {"time": time.time(), "height": needed, "digest": cache.put(data)}
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(state, f)
+                os.replace(temp_path, state_path)
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(temp_path)
+                raise
+            metrics.set(coalesced="rendered")
+            return data
+        finally:
+            os.close(lock_fd)
+
+
+# renders are shared by all threads of a process
+COALESCER = RenderCoalescer()
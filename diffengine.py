@@ -0,0 +1,123 @@
+"""
+Tolerant comparison of two frames. The area of interest is split into square blocks and every block gets a
+difference score; a change is only reported if the score of a block exceeds a threshold. This way a single
+anti-aliased pixel does not trigger a notification while a changed word still does.
+
+Two methods are available:
+- "mad": mean absolute difference of all color channels of a block, in 8 bit intensity units (0-255)
+- "ahash": average hash of each block (8x8 cells, one bit per cell), the score is the number of differing bits (0-64)
+
+Everything is vectorized with NumPy, so a 2000x2000 region is compared in milliseconds.
+"""
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError("Requires numpy.")
+
+from frames import Frame
+
+DIFF_METHODS = ("mad", "ahash")
+DEFAULT_THRESHOLDS = {"mad": 2.0, "ahash": 4}
+
+
+class DiffResult:
+    def __init__(self, changed, boxes, scores):
+        # whether at least one block exceeded the threshold
+        self.changed = changed
+        # bounding boxes (x, y, w, h) in pixels of groups of adjacent changed blocks
+        self.boxes = boxes
+        # score of every block as 2D array (block rows x block columns)
+        self.scores = scores
+
+
+def frameToArray(frame: Frame):
+    """ View the pixels of a frame as array of shape (height, width, 3) without copying """
+    return np.frombuffer(frame.pixels, dtype=np.uint8).reshape(frame.height, frame.width, 3)
+
+
+def _padToBlocks(a, block_size, mode="constant"):
+    pad_h, pad_w = -a.shape[0] % block_size, -a.shape[1] % block_size
+    if not pad_h and not pad_w:
+        return a
+    return np.pad(a, ((0, pad_h), (0, pad_w)) + ((0, 0),) * (a.ndim - 2), mode=mode)
+
+
+def _blockSums(a, block_size):
+    """ Sums over all pixels and channels of each block of a uint8 array of shape (height, width, 3) whose size
+    is a multiple of block_size. Rows are summed first because reducing the short channel axis on its own is slow.
+    """
+    rows, cols = a.shape[0] // block_size, a.shape[1] // block_size
+    sums = a.reshape(rows, block_size, cols * block_size * 3).sum(axis=1, dtype=np.uint32)
+    return sums.reshape(rows, cols, block_size * 3).sum(axis=2, dtype=np.uint64)
+
+
+def blockMeanAbsoluteDifference(baseline, current, block_size):
+    """ Mean absolute difference per block of two uint8 arrays of shape (height, width, 3) """
+    height, width = baseline.shape[:2]
+    # |a - b| without leaving uint8
+    diff = np.maximum(baseline, current) - np.minimum(baseline, current)
+    sums = _blockSums(_padToBlocks(diff, block_size), block_size)
+    rows, cols = sums.shape
+
+    # blocks at the right and bottom border can be smaller than block_size
+    row_counts = np.minimum(block_size, height - np.arange(rows) * block_size)
+    col_counts = np.minimum(block_size, width - np.arange(cols) * block_size)
+    return sums / (np.outer(row_counts, col_counts) * 3)
+
+
+def blockAverageHashes(a, block_size):
+    """ Average hash (64 bits as boolean array) per block of a uint8 array of shape (height, width, 3) """
+    if block_size % 8:
+        raise ValueError("Block size must be a multiple of 8 for ahash")
+    cells = _blockSums(_padToBlocks(a, block_size, mode="edge"), block_size // 8)
+    rows, cols = cells.shape[0] // 8, cells.shape[1] // 8
+    cells = cells.reshape(rows, 8, cols, 8).transpose(0, 2, 1, 3).reshape(rows, cols, 64)
+    return cells * 64 > cells.sum(axis=2, keepdims=True)
+
+
+def blockScores(baseline, current, block_size, method="mad"):
+    if method == "mad":
+        return blockMeanAbsoluteDifference(baseline, current, block_size)
+    if method == "ahash":
+        diff = blockAverageHashes(baseline, block_size) != blockAverageHashes(current, block_size)
+        return diff.sum(axis=2)
+    raise ValueError("Unknown diff method {}, choose one of {}".format(method, ", ".join(DIFF_METHODS)))
+
+
+def changedBoxes(changed_blocks, block_size, width, height):
+    """ Merge adjacent changed blocks into bounding boxes (x, y, w, h) in pixels """
+    remaining = set(zip(*np.nonzero(changed_blocks)))
+    boxes = []
+    while remaining:
+        stack = [remaining.pop()]
+        top, left = bottom, right = stack[0]
+        while stack:
+            row, col = stack.pop()
+            top, bottom = min(top, row), max(bottom, row)
+            left, right = min(left, col), max(right, col)
+            for neighbor in ((row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)):
+                if neighbor in remaining:
+                    remaining.remove(neighbor)
+                    stack.append(neighbor)
+        x, y = int(left) * block_size, int(top) * block_size
+        boxes.append((x, y, min((int(right) + 1) * block_size, width) - x,
+                      min((int(bottom) + 1) * block_size, height) - y))
+    return sorted(boxes, key=lambda box: (box[1], box[0]))
+
+
+def compareFrames(baseline: Frame, current: Frame, block_size=32, method="mad", threshold=None):
+    """ Compare a frame with its baseline block by block. A block counts as changed if its score exceeds
+    the threshold (default: DEFAULT_THRESHOLDS of the method).
+    """
+    if threshold is None:
+        threshold = DEFAULT_THRESHOLDS[method]
+
+    if (baseline.width, baseline.height) != (current.width, current.height):
+        # size changed, e.g. because the page got shorter: everything counts as changed
+        return DiffResult(True, [(0, 0, current.width, current.height)], None)
+
+    scores = blockScores(frameToArray(baseline), frameToArray(current), block_size, method)
+    changed_blocks = scores > threshold
+    return DiffResult(bool(changed_blocks.any()),
+                      changedBoxes(changed_blocks, block_size, current.width, current.height),
+                      scores)
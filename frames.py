@@ -0,0 +1,269 @@
+"""
+Decoding of rendered screenshots into raw pixels and hashing of these pixels.
+
+Hashing decoded pixels instead of the encoded image file makes the hash independent of the image encoder:
+a different compression level or encoder version does not change the hash as long as the pixels are the same.
+All images are converted to one fixed pixel format (8 bit RGB, rows top to bottom, no padding).
+"""
+import hashlib
+import importlib
+import io
+import re
+import struct
+import zlib
+
+# optional modules, imported on first use because importing Pillow takes longer than hashing a small area
+_optional_modules = {}
+
+HASH_ALGORITHMS = ("md5", "blake2b", "xxh64", "xxh3")
+
+PPM_HEADER = re.compile(rb"P6\s+(\d+)\s+(\d+)\s+(\d+)\s")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+BMP_SIGNATURE = b"BM"
+# bytes per pixel of 8 bit PNG images by color type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+class Frame:
+    """ Decoded image: 8 bit RGB pixels, rows top to bottom without padding """
+
+    def __init__(self, width, height, pixels):
+        self.width = width
+        self.height = height
+        self.pixels = bytes(pixels)
+
+    def crop(self, rect):
+        """ Return the part (x, y, w, h) of the frame, clipped to the frame """
+        x0, y0, x1, y1 = clipRect(rect, self.width, self.height)
+        stride = self.width * 3
+        rows = [self.pixels[y * stride + x0 * 3:y * stride + x1 * 3] for y in range(y0, y1)]
+        return Frame(x1 - x0, y1 - y0, b"".join(rows))
+
+
+def clipRect(rect, width, height):
+    """ Convert (x, y, w, h) to the corners (x0, y0, x1, y1) clipped to an image of the given size """
+    x, y, w, h = rect
+    x0, y0 = min(max(x, 0), width), min(max(y, 0), height)
+    return x0, y0, max(x0, min(x + w, width)), max(y0, min(y + h, height))
+
+
+def boundingRect(rects):
+    """ Smallest rectangle (x, y, w, h) that contains all given rectangles """
+    x0 = min(x for x, _, _, _ in rects)
+    y0 = min(y for _, y, _, _ in rects)
+    x1 = max(x + w for x, _, w, _ in rects)
+    y1 = max(y + h for _, y, _, h in rects)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def encodePpm(frame):
+    """ Encode a frame as binary PPM, which stores the pixels unchanged in the same format as Frame """
+    return "P6\n{} {}\n255\n".format(frame.width, frame.height).encode() + frame.pixels
+
+
+def _decodePpm(data, crop):
+    # header without comments, the pixels start after exactly one whitespace character
+    header = PPM_HEADER.match(data)
+    if header is None or int(header.group(3)) != 255:
+        raise ValueError("Unsupported PPM header")
+    width, height = int(header.group(1)), int(header.group(2))
+    if len(data) - header.end() < width * height * 3:
+        raise ValueError("Truncated/invalid PPM image")
+    frame = Frame(width, height, data[header.end():header.end() + width * height * 3])
+    return frame if crop is None else frame.crop(crop)
+
+
+def _decodeBmp(data, crop):
+    """ Decoder for uncompressed 24 and 32 bit BMP images as written by wkhtmltoimage (--format bmp) """
+    if len(data) < 34:
+        raise ValueError("Truncated/invalid BMP image")
+    pixel_offset, = struct.unpack("<I", data[10:14])
+    width, height, _, bpp, compression = struct.unpack("<iiHHI", data[18:34])
+    if bpp not in (24, 32) or compression != 0:
+        raise ValueError("Unsupported BMP format ({} bit, compression {})".format(bpp, compression))
+
+    bottom_up = height > 0
+    height = abs(height)
+    x0, y0, x1, y1 = clipRect(crop or (0, 0, width, height), width, height)
+    channels = bpp // 8
+    stride = (width * channels + 3) // 4 * 4  # rows are padded to 4 bytes
+    if width < 0 or len(data) < pixel_offset + stride * height:
+        raise ValueError("Truncated/invalid BMP image")
+    rows = []
+    for y in range(y0, y1):
+        start = pixel_offset + (height - 1 - y if bottom_up else y) * stride + x0 * channels
+        rows.append(data[start:start + (x1 - x0) * channels])
+    bgr = b"".join(rows)
+
+    # BGR(A) to RGB
+    rgb = bytearray(len(bgr) // channels * 3)
+    rgb[0::3] = bgr[2::channels]
+    rgb[1::3] = bgr[1::channels]
+    rgb[2::3] = bgr[0::channels]
+    return Frame(x1 - x0, y1 - y0, rgb)
+
+
+def decodeImage(data, crop=None):
+    """ Decode an encoded image (PNG, BMP or binary PPM) into a Frame. If crop (x, y, w, h) is given, only that part
+    of the image is converted into pixels.
+    """
+    if data.startswith(b"P6"):
+        return _decodePpm(data, crop)
+    if data.startswith(BMP_SIGNATURE):
+        return _decodeBmp(data, crop)
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("Unsupported image format")
+    if _optionalModule("PIL.Image") is not None:
+        return _decodeWithPillow(data, crop)
+    return _decodePng(data, crop)
+
+
+def _optionalModule(name):
+    """ Returns the imported module or None if it is not installed """
+    if name not in _optional_modules:
+        try:
+            _optional_modules[name] = importlib.import_module(name)
+        except ImportError:
+            _optional_modules[name] = None
+    return _optional_modules[name]
+
+
+def _decodeWithPillow(data, crop):
+    try:
+        image = _optionalModule("PIL.Image").open(io.BytesIO(data))
+        if crop is not None:
+            x0, y0, x1, y1 = clipRect(crop, image.width, image.height)
+            image = image.crop((x0, y0, x1, y1))
+        image = image.convert("RGB")
+    except OSError as e:
+        # Pillow reports broken images as OSError
+        raise ValueError("Truncated/invalid PNG image") from e
+    return Frame(image.width, image.height, image.tobytes())
+
+
+def _decodePng(data, crop):
+    """ Minimal decoder for non-interlaced 8 bit PNG images as written by wkhtmltoimage """
+    pos = len(PNG_SIGNATURE)
+    header = None
+    palette = None
+    compressed = []
+    while pos < len(data):
+        if pos + 8 > len(data):
+            raise ValueError("Truncated/invalid PNG image")
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        if len(chunk) < length:
+            raise ValueError("Truncated/invalid PNG image")
+        pos += 12 + length
+        if chunk_type == b"IHDR":
+            if length != 13:
+                raise ValueError("Truncated/invalid PNG image")
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif chunk_type == b"PLTE":
+            palette = [chunk[i:i + 3] for i in range(0, len(chunk), 3)]
+        elif chunk_type == b"IDAT":
+            compressed.append(chunk)
+        elif chunk_type == b"IEND":
+            break
+
+    if header is None:
+        raise ValueError("Truncated/invalid PNG image")
+    width, height, bit_depth, color_type, _, _, interlace = header
+    if bit_depth != 8 or interlace or color_type not in PNG_CHANNELS:
+        raise ValueError("Unsupported PNG format (bit depth {}, color type {}, interlace {})"
+                         .format(bit_depth, color_type, interlace))
+
+    x0, y0, x1, y1 = clipRect(crop or (0, 0, width, height), width, height)
+    bpp = PNG_CHANNELS[color_type]
+    stride = width * bpp
+
+    # rows above the crop must be unfiltered because filters refer to the previous row,
+    # but decompression stops after the last row of the crop
+    needed = (stride + 1) * y1
+    decompressor = zlib.decompressobj()
+    raw = bytearray()
+    try:
+        for chunk in compressed:
+            raw += decompressor.decompress(chunk, needed - len(raw))
+            if len(raw) >= needed:
+                break
+    except zlib.error as e:
+        raise ValueError("Truncated/invalid PNG image") from e
+    if len(raw) < needed:
+        raise ValueError("Truncated/invalid PNG image")
+
+    previous = bytearray(stride)
+    rows = []
+    for y in range(y1):
+        offset = y * (stride + 1)
+        row = _unfilter(raw[offset], bytearray(raw[offset + 1:offset + 1 + stride]), previous, bpp)
+        if y >= y0:
+            rows.append(_toRgb(row[x0 * bpp:x1 * bpp], color_type, palette))
+        previous = row
+    return Frame(x1 - x0, y1 - y0, b"".join(rows))
+
+
+def _unfilter(filter_type, row, previous, bpp):
+    if filter_type == 1:  # Sub
+        for i in range(bpp, len(row)):
+            row[i] = (row[i] + row[i - bpp]) & 0xff
+    elif filter_type == 2:  # Up
+        for i in range(len(row)):
+            row[i] = (row[i] + previous[i]) & 0xff
+    elif filter_type == 3:  # Average
+        for i in range(len(row)):
+            left = row[i - bpp] if i >= bpp else 0
+            row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+    elif filter_type == 4:  # Paeth
+        for i in range(len(row)):
+            a = row[i - bpp] if i >= bpp else 0
+            b = previous[i]
+            c = previous[i - bpp] if i >= bpp else 0
+            p = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            if pa <= pb and pa <= pc:
+                predictor = a
+            elif pb <= pc:
+                predictor = b
+            else:
+                predictor = c
+            row[i] = (row[i] + predictor) & 0xff
+    elif filter_type != 0:
+        raise ValueError("Invalid PNG filter type {}".format(filter_type))
+    return row
+
+
+def _toRgb(row, color_type, palette):
+    if color_type == 2:
+        return bytes(row)
+    if color_type == 3:
+        return b"".join(palette[index] for index in row)
+
+    bpp = PNG_CHANNELS[color_type]
+    pixel_count = len(row) // bpp
+    rgb = bytearray(pixel_count * 3)
+    if color_type in (0, 4):  # gray (with alpha)
+        gray = row[0::bpp]
+        rgb[0::3], rgb[1::3], rgb[2::3] = gray, gray, gray
+    else:  # RGBA, alpha is dropped
+        rgb[0::3], rgb[1::3], rgb[2::3] = row[0::4], row[1::4], row[2::4]
+    return bytes(rgb)
+
+
+def newHash(algorithm):
+    if algorithm in ("md5", "blake2b"):
+        return hashlib.new(algorithm)
+    if algorithm in ("xxh64", "xxh3"):
+        xxhash = _optionalModule("xxhash")
+        if xxhash is None:
+            raise ImportError("Hash algorithm {} requires xxhash.".format(algorithm))
+        return xxhash.xxh64() if algorithm == "xxh64" else xxhash.xxh3_64()
+    raise ValueError("Unknown hash algorithm {}, choose one of {}".format(algorithm, ", ".join(HASH_ALGORITHMS)))
+
+
+def hashFrame(frame, algorithm="md5"):
+    """ Hash the pixels of a frame. The size is part of the hash so that e.g. a 2x1 and a 1x2 image differ. """
+    h = newHash(algorithm)
+    h.update("{}x{}:".format(frame.width, frame.height).encode())
+    h.update(frame.pixels)
+    return h.hexdigest()
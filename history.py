@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+History of check results in a SQLite database, so that questions like "how often does this area change" or
+"when did it last change" can be answered without keeping logs. urlwatch itself only keeps the latest output.
+
+Every check adds one row per area with the time, the hash, whether it differs from the previous hash of the area,
+the stage timings and the cached frame (with PYVISUALCOMPARE_KEEP_FRAMES). Hashes are stored as binary and jobs
+as small integers, so a row takes less than 100 bytes. The same check also updates daily totals per job and area
+(number of checks, changes and failures, and a histogram of the check duration), so summaries only read a few
+rows per job and day instead of millions of checks. Rows older than the retention period are deleted and the
+freed space is given back to the file system at most once a day.
+
+    ./history.py summary --since 7          change frequency and latency per job and area of the last 7 days
+    ./history.py compact                    apply the retention period now
+"""
+import argparse
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+
+DEFAULT_RETENTION_DAYS = 90
+COMPACT_INTERVAL = 24 * 3600
+# the bounds of the buckets of the duration histogram grow by this factor, so percentiles are within 10 %
+LATENCY_GROWTH = 1.1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    name TEXT,
+    url TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    job INTEGER NOT NULL,
+    time REAL NOT NULL,
+    region TEXT NOT NULL,   -- name of the area, '' for the area given by --crop-*
+    digest BLOB,            -- NULL if the check failed
+    changed INTEGER NOT NULL,
+    total_ms INTEGER,
+    stages TEXT,            -- duration of every stage [ms] as JSON
+    exit TEXT,
+    frame TEXT              -- content hash of the rendered image in the cache
+);
+CREATE INDEX IF NOT EXISTS results_job_region_time ON results (job, region, time);
+CREATE INDEX IF NOT EXISTS results_time ON results (time);
+CREATE TABLE IF NOT EXISTS daily (
+    job INTEGER NOT NULL,
+    region TEXT NOT NULL,
+    day INTEGER NOT NULL,   -- days since 1970-01-01 (UTC)
+    checks INTEGER NOT NULL,
+    changes INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    last_change REAL,
+    PRIMARY KEY (job, region, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS latency (
+    job INTEGER NOT NULL,
+    region TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,  -- see latencyBucket
+    count INTEGER NOT NULL,
+    PRIMARY KEY (job, region, day, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+SUMMARY_QUERY = """
+SELECT jobs.name, jobs.url, jobs.key, daily.job, daily.region, SUM(checks), SUM(changes), SUM(failures), MIN(day),
+       MAX(last_change)
+FROM daily JOIN jobs ON jobs.id = daily.job
+WHERE day >= ?
+GROUP BY daily.job, daily.region
+ORDER BY SUM(changes) DESC, jobs.name
+"""
+
+
+def latencyBucket(milliseconds):
+    return int(math.log(max(milliseconds, 1)) / math.log(LATENCY_GROWTH))
+
+
+def bucketLimit(bucket):
+    """ Upper bound of a bucket of the duration histogram [ms] """
+    return int(math.ceil(LATENCY_GROWTH ** (bucket + 1)))
+
+
+def percentiles(histogram, fractions):
+    """ Percentiles (upper bounds of their buckets) of a histogram given as dict bucket -> count """
+    total = sum(histogram.values())
+    values = []
+    for fraction in fractions:
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= fraction * total:
+                values.append(bucketLimit(bucket))
+                break
+    return values
+
+
+class HistoryStore:
+    def __init__(self, path, retention_days=DEFAULT_RETENTION_DAYS):
+        self.path = path
+        self.retention_days = retention_days
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # checker processes write concurrently; WAL lets them do so without blocking readers
+        self.connection = sqlite3.connect(path, timeout=30)
+        # only takes effect on a new database, whose freed pages can then be released incrementally
+        self.connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def _jobId(self, record):
+        self.connection.execute("INSERT OR IGNORE INTO jobs (key, name, url) VALUES (?, ?, ?)",
+                                (record["job"], record["name"], record["url"]))
+        return self.connection.execute("SELECT id FROM jobs WHERE key = ?", (record["job"],)).fetchone()[0]
+
+    def add(self, record, results):
+        """ Add a check described by its metrics record (see metrics.CheckMetrics) and its results as list of
+        (name, digest); an empty list for a failed check.
+        """
+        stages = {stage: int(round(seconds * 1000)) for stage, seconds in record["stages"].items()}
+        total_ms = stages.get("total")
+        with self.connection:
+            job = self._jobId(record)
+            if not results:
+                # failures are stored for every area that had a hash before
+                regions = [row[0] for row in self.connection.execute(
+                    "SELECT DISTINCT region FROM results WHERE job = ?", (job,))] or [""]
+                results = [(region, None) for region in regions]
+
+            for name, digest in results:
+                region = name or ""
+                digest = bytes.fromhex(digest) if digest is not None else None
+                previous = self.connection.execute(
+                    "SELECT digest FROM results WHERE job = ? AND region = ? AND digest IS NOT NULL "
+                    "ORDER BY time DESC LIMIT 1", (job, region)).fetchone()
+                changed = digest is not None and previous is not None and previous[0] != digest
+                self.connection.execute(
+                    "INSERT INTO results (job, time, region, digest, changed, total_ms, stages, exit, frame) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job, record["time"], region, digest, int(changed), total_ms,
+                     json.dumps(stages, separators=(",", ":")), record["exit"], record.get("frame")))
+
+                day = int(record["time"] // 86400)
+                self.connection.execute(
+                    "INSERT INTO daily (job, region, day, checks, changes, failures, last_change) "
+                    "VALUES (?, ?, ?, 1, ?, ?, ?) ON CONFLICT (job, region, day) DO UPDATE SET "
+                    "checks = checks + 1, changes = changes + excluded.changes, "
+                    "failures = failures + excluded.failures, "
+                    "last_change = COALESCE(excluded.last_change, last_change)",
+                    (job, region, day, int(changed), int(digest is None), record["time"] if changed else None))
+                if digest is not None and total_ms is not None:
+                    self.connection.execute(
+                        "INSERT INTO latency (job, region, day, bucket, count) VALUES (?, ?, ?, ?, 1) "
+                        "ON CONFLICT (job, region, day, bucket) DO UPDATE SET count = count + 1",
+                        (job, region, day, latencyBucket(total_ms)))
+
+    def compact(self):
+        """ Delete rows older than the retention period and jobs without rows, and free the space """
+        limit = time.time() - self.retention_days * 86400
+        with self.connection:
+            self.connection.execute("DELETE FROM results WHERE time < ?", (limit,))
+            self.connection.execute("DELETE FROM daily WHERE day < ?", (int(limit // 86400),))
+            self.connection.execute("DELETE FROM latency WHERE day < ?", (int(limit // 86400),))
+            self.connection.execute("DELETE FROM jobs WHERE id NOT IN (SELECT DISTINCT job FROM daily)")
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('compacted', ?)",
+                                    (str(time.time()),))
+        self.connection.execute("PRAGMA incremental_vacuum")
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def compactIfDue(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'compacted'").fetchone()
+        if row is None or time.time() - float(row[0]) > COMPACT_INTERVAL:
+            self.compact()
+
+    def summary(self, days=30, job=None):
+        """ Statistics per job and area of the last days (including today), optionally only of the jobs with the
+        given name or key
+        """
+        today = int(time.time() // 86400)
+        first_day = today - int(days) + 1
+        histograms = {}
+        for job_id, region, bucket, count in self.connection.execute(
+                "SELECT job, region, bucket, SUM(count) FROM latency WHERE day >= ? GROUP BY job, region, bucket",
+                (first_day,)):
+            histograms.setdefault((job_id, region), {})[bucket] = count
+
+        summaries = []
+        for name, url, key, job_id, region, checks, changes, failures, first, last_change in \
+                self.connection.execute(SUMMARY_QUERY, (first_day,)):
+            if job is not None and job not in (name, key):
+                continue
+            p50, p95, maximum = percentiles(histograms.get((job_id, region), {}), (0.5, 0.95, 1.0)) or \
+                (None, None, None)
+            summaries.append({"name": name, "url": url, "job": key, "region": region or None, "checks": checks,
+                              "changes": changes, "changes_per_day": round(changes / (today - first + 1), 3),
+                              "failures": failures, "last_change": last_change,
+                              "latency_ms": {"p50": p50, "p95": p95, "max": maximum}})
+        return summaries
+
+
+def storeResults(path, retention_days, record, results):
+    """ Add a check to the history at path and apply the retention period if it is due """
+    store = HistoryStore(path, retention_days)
+    try:
+        store.add(record, results)
+        store.compactIfDue()
+    finally:
+        store.close()
+
+
+def formatTime(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp)) if timestamp else "never"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the history of pyvisualcompare checks.")
+    parser.add_argument("--db", default=os.environ.get("PYVISUALCOMPARE_HISTORY"),
+                        help="history database (default: $PYVISUALCOMPARE_HISTORY)")
+    subparsers = parser.add_subparsers(dest="command")
+    summary_parser = subparsers.add_parser("summary", help="change frequency and latency per job and area")
+    summary_parser.add_argument("--since", type=int, default=30,
+                                help="only the last days, including today (default: 30)")
+    summary_parser.add_argument("--job", help="only the job with this name or key")
+    summary_parser.add_argument("--json", action="store_true", help="write JSON lines instead of a table")
+    compact_parser = subparsers.add_parser("compact", help="delete rows older than the retention period")
+    compact_parser.add_argument("--retention", type=float,
+                                default=float(os.environ.get("PYVISUALCOMPARE_HISTORY_DAYS",
+                                                             DEFAULT_RETENTION_DAYS)),
+                                help="retention period in days (default: {})".format(DEFAULT_RETENTION_DAYS))
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 2
+    if not args.db:
+        sys.stderr.write("No history database given, set PYVISUALCOMPARE_HISTORY or use --db\n")
+        return 2
+    if not os.path.exists(args.db):
+        sys.stderr.write("No history at {}\n".format(args.db))
+        return 1
+
+    if args.command == "compact":
+        store = HistoryStore(args.db, args.retention)
+        store.compact()
+        store.close()
+        return 0
+
+    store = HistoryStore(args.db)
+    summaries = store.summary(args.since, args.job)
+    store.close()
+    if args.json:
+        for summary in summaries:
+            print(json.dumps(summary))
+        return 0
+
+    print("{:24} {:12} {:>7} {:>7} {:>8} {:>8} {:16} {:>8} {:>8}".format(
+        "job", "area", "checks", "changes", "per day", "failures", "last change", "p50 ms", "p95 ms"))
+    for summary in summaries:
+        print("{:24} {:12} {:7} {:7} {:8.2f} {:8} {:16} {:>8} {:>8}".format(
+            (summary["name"] or summary["url"])[:24], (summary["region"] or "-")[:12], summary["checks"],
+            summary["changes"], summary["changes_per_day"], summary["failures"],
+            formatTime(summary["last_change"]), str(summary["latency_ms"]["p50"]),
+            str(summary["latency_ms"]["p95"])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
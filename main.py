@@ -1,33 +1,111 @@
 import sys
-import tempfile
-import subprocess
 import os
+import re
+import signal
+import importlib.util
 
 try:
-    from PyQt5.QtCore import Qt, QT_VERSION_STR, QDateTime, QCoreApplication, QRect, QThread, pyqtSignal, QProcess
-    from PyQt5.QtGui import QImage, QIntValidator, QValidator
+    from PyQt5.QtCore import Qt, QT_VERSION_STR, QDateTime, QCoreApplication, QRect, QThread, pyqtSignal, QProcess, \
+        QSize, QTimer, QByteArray, QBuffer
+    from PyQt5.QtGui import QImage, QIntValidator, QValidator, QImageReader
     from PyQt5.QtWidgets import QApplication, QFileDialog, QMainWindow, QDialog, QVBoxLayout, QDialogButtonBox, \
         QDateTimeEdit, QTextEdit, QPlainTextEdit, QLineEdit, QLabel, QStyle, QCheckBox, QHBoxLayout, QGridLayout, \
         QMessageBox, QAbstractButton, QWizard, QWizardPage, QComboBox
 except ImportError:
     raise ImportError("Requires PyQt5.")
-from QtImagePartSelector import QtImagePartSelector
-
-WKHTMLTOIMAGE = "wkhtmltoimage"
-XVFB = "xvfb-run"
-XVFB_BASE_PARAMETERS = ["-a", "-s", "-screen 0 640x480x16", WKHTMLTOIMAGE]
-
-try:
-    subprocess.run(WKHTMLTOIMAGE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-except FileNotFoundError:
-    raise FileNotFoundError("wkhtmltopdf must be installed on system")
-
-try:
-    subprocess.run(XVFB, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-except FileNotFoundError:
-    raise FileNotFoundError("xvfb must be installed on system")
-
-PATH_MD5_SCRIPT = "pyvisualcompare-md5.sh"
+from QtImagePartSelector import QtImagePartSelector, buildPyramid
+from tools import WKHTMLTOIMAGE, XVFB, requireTool, xvfbParameters
+from urlwatchconfig import BACKEND_COMMAND, jobParameters, urlwatchConfig, wkhtmlParameters
+from profiletuner import DelayTunerDialog, ProfileTunerDialog, withoutOption
+from variantcapture import VariantDialog
+
+# longest edge of the preview that is shown while the full screenshot is decoded
+PREVIEW_SIZE = 1024
+# rendering is cancelled if it takes longer than this plus the JavaScript delay [ms]
+RENDER_TIMEOUT = 120000
+# edge length of the tiles a refreshed screenshot is compared with the previous one in [pixels]
+DIFF_TILE_SIZE = 16
+
+
+def imageArray(image, width, height):
+    """ The top left width x height pixels of a QImage as NumPy array of shape (height, width, 3) """
+    import numpy as np
+
+    image = image.convertToFormat(QImage.Format_RGB888)
+    bits = image.constBits()
+    bits.setsize(image.bytesPerLine() * image.height())
+    # rows are padded to bytesPerLine; copied since the converted image is freed on return
+    rows = np.frombuffer(bits, dtype=np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:height, :width * 3].reshape(height, width, 3).copy()
+
+
+def changedTiles(previous, image, tile_size=DIFF_TILE_SIZE):
+    """ Tiles (QRects) of image in which any pixel differs from previous. If the page got larger, the new part
+    counts as changed.
+    """
+    import diffengine  # only needed for refreshing, so numpy is not required otherwise
+
+    width, height = min(previous.width(), image.width()), min(previous.height(), image.height())
+    # the backend hashes the exact pixels, so every changed pixel would cause a notification
+    scores = diffengine.blockScores(imageArray(previous, width, height), imageArray(image, width, height),
+                                    tile_size)
+    tiles = [QRect(int(column) * tile_size, int(row) * tile_size, tile_size, tile_size).intersected(
+        QRect(0, 0, width, height)) for row, column in zip(*scores.nonzero())]
+    if image.width() > width:
+        tiles.append(QRect(width, 0, image.width() - width, height))
+    if image.height() > height:
+        tiles.append(QRect(0, height, image.width(), image.height() - height))
+    return tiles
+
+
+class ImageLoader(QThread):
+    """ Decodes a screenshot and prepares its resolution pyramid outside of the GUI thread.
+    For large screenshots, a downscaled preview is decoded and emitted first.
+    If a previous screenshot is given, there is no preview, and the tiles that changed since it (see changedTiles)
+    and the total number of tiles are emitted right before the image.
+    """
+
+    previewReady = pyqtSignal(QImage, QSize)
+    diffReady = pyqtSignal(list, int)
+    imageReady = pyqtSignal(QImage, list)
+    failed = pyqtSignal(str)
+
+    def __init__(self, data, parent=None, previous=None):
+        super(ImageLoader, self).__init__(parent)
+        # encoded screenshot (QByteArray), as wkhtmltoimage wrote it to its standard output
+        self.data = data
+        # screenshot (QImage) that is shown while the page is refreshed
+        self.previous = previous
+
+    def reader(self):
+        buffer = QBuffer(self.data)
+        buffer.open(QBuffer.ReadOnly)
+        reader = QImageReader(buffer)
+        reader.buffer = buffer  # keep the buffer alive as long as the reader
+        return reader
+
+    def run(self):
+        reader = self.reader()
+        size = reader.size()
+        if self.previous is None and size.isValid() and max(size.width(), size.height()) > PREVIEW_SIZE:
+            reader.setScaledSize(size.scaled(PREVIEW_SIZE, PREVIEW_SIZE, Qt.KeepAspectRatio))
+            preview = reader.read()
+            if not preview.isNull() and not self.isInterruptionRequested():
+                self.previewReady.emit(preview, size)
+            reader = self.reader()
+
+        image = reader.read()
+        if image.isNull():
+            self.failed.emit(reader.errorString())
+            return
+        if self.isInterruptionRequested():
+            return
+        levels = buildPyramid(image)
+        if self.previous is not None and not self.isInterruptionRequested():
+            tiles = changedTiles(self.previous, image)
+            self.diffReady.emit(tiles, -(-image.width() // DIFF_TILE_SIZE) * -(-image.height() // DIFF_TILE_SIZE))
+        if not self.isInterruptionRequested():
+            self.imageReady.emit(image, levels)
 
 
 class NotEmptyValidator(QValidator):
@@ -187,7 +265,8 @@ class MagicWizard(QWizard):
                                            ))
 
         self.addPage(LabelAndTextfieldPage(self,
-                                           "urlwatch, wkhtmltopdf and xvfb need to be installed on the server.\n"
+                                           "urlwatch, python3, wkhtmltopdf and xvfb need to be installed on the "
+                                           "server.\n"
                                            "urlwatch is necessary to watch out for changes and send notifications.\n"
                                            "wkhtmltopdf is a tool to render a web page into PDF or image files "
                                            "(similar to a browser).\n"
@@ -196,7 +275,7 @@ class MagicWizard(QWizard):
                                            "On Ubuntu or Debian systems, these "
                                            "applications can be installed with the following command:",
 
-                                           "$ sudo apt install urlwatch wkhtmltopdf xvfb"
+                                           "$ sudo apt install urlwatch python3 wkhtmltopdf xvfb"
                                            ))
         self.addPage(LabelAndTextfieldPage(self,
                                            "Login on your server as the user that is supposed to run urlwatch and "
@@ -217,16 +296,16 @@ class MagicWizard(QWizard):
                                            "file permissions for urlwatch:",
 
                                            "$ chmod 700 -R ~/.config/urlwatch/"))
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), PATH_MD5_SCRIPT), "r") as f:
-            script_content = f.read()
-
         self.addPage(LabelAndTextfieldPage(self,
-                                           "To simplify quite a lot of things, a simple script must be installed on "
-                                           "the server. You should put it into the file "
-                                           "/usr/local/bin/pyvisualcompare-md5.sh. Make sure to mark it as "
-                                           "executable.",
+                                           "The backend checker of pyvisualcompare must be installed on the "
+                                           "server. It keeps a few virtual displays running in the background "
+                                           "instead of starting a new one for every check. Clone the repository "
+                                           "and link the checker into urlwatch's PATH:",
 
-                                           script_content))
+                                           "$ sudo git clone https://github.com/nspo/pyvisualcompare.git "
+                                           "/opt/pyvisualcompare\n"
+                                           "$ sudo ln -s /opt/pyvisualcompare/backend.py "
+                                           "/usr/local/bin/{}".format(BACKEND_COMMAND)))
 
         self.addPage(LabelAndTextfieldPage(self,
                                            "Configure urlwatch to your liking, e.g. to send mail notifications. "
@@ -255,7 +334,8 @@ class MagicWizard(QWizard):
                                            "MD5 hash - except when a change was made in the area of interest.\n\n"
                                            "If the area of interest gets moved because new content is added above, "
                                            "your filter will still notice a change. If that is not the desired "
-                                           "behavior, you can have a look at the other urlwatch filters available.",
+                                           "behavior, set PYVISUALCOMPARE_TRACK=1 in the environment of urlwatch "
+                                           "to let the checker follow the area (requires python3-numpy).",
 
                                            "$ urlwatch --test-filter 1"
                                            ))
@@ -272,7 +352,7 @@ class MyMainWindow(QMainWindow):
         self.graphicsView = QtImagePartSelector()
         self.setCentralWidget(self.graphicsView)
 
-        self.graphicsView.rectSet.connect(self.onRectSet)
+        self.graphicsView.selectionsChanged.connect(self.onSelectionsChanged)
 
         menubar = self.menuBar()
 
@@ -280,6 +360,18 @@ class MyMainWindow(QMainWindow):
         load_url_action = file_menu.addAction("Load from URL")
         load_url_action.triggered.connect(self.getImage)
 
+        compare_action = file_menu.addAction("Compare viewports and delays...")
+        compare_action.triggered.connect(self.compareVariants)
+
+        self.refresh_action = file_menu.addAction("Refresh")
+        self.refresh_action.setShortcut("F5")
+        self.refresh_action.setDisabled(True)
+        self.refresh_action.triggered.connect(self.refresh)
+
+        self.cancel_action = file_menu.addAction("Cancel loading")
+        self.cancel_action.setDisabled(True)
+        self.cancel_action.triggered.connect(lambda: self.cancelLoading("Loading was cancelled"))
+
         close_action = file_menu.addAction("Quit")
         close_action.triggered.connect(self.close)
 
@@ -292,124 +384,298 @@ class MyMainWindow(QMainWindow):
         self.statusBar().addWidget(self.statusBarWidget)
         self.statusBarWidget.setText("Ready to load URL")
 
-        self.tempdir = tempfile.mkdtemp()
-        self.tempfilename = os.path.join(self.tempdir, "pyvisualcompare.png")
+        self.url_dict = None
 
-        self.selected_rectangle = None
+        self.process = None
+        # the screenshot is streamed from wkhtmltoimage's standard output into memory, no file is written
+        self.render_image = QByteArray()
+        self.render_output = b""
+        self.cancel_reason = None
+        self.loader = None
+        # screenshot that stays visible while the page is refreshed, None if no refresh is running
+        self.refresh_previous = None
 
-        self.url_dict = None
+        self.timeout_timer = QTimer(self)
+        self.timeout_timer.setSingleShot(True)
+        self.timeout_timer.timeout.connect(lambda: self.cancelLoading("Loading the page timed out"))
 
         self.resize(500, 300)
 
         self.setWindowTitle('pyvisualcompare')
 
-    def getUrlwatchConfig(self):
-        s = "name: ExampleName\n" \
-            "kind: shell\n" \
-            "command: pyvisualcompare-md5.sh"
-
-        s += " --crop-x {} --crop-y {} --crop-w {} --crop-h {} ".format(
-            self.selected_rectangle.topLeft().x(),
-            self.selected_rectangle.topLeft().y(),
-            self.selected_rectangle.width(),
-            self.selected_rectangle.height()
-        )
-
-        s += " ".join(self.getWkhtmlParameters())
-        s += "\n---"
+    def getAreas(self):
+        return [(name, (rect.x(), rect.y(), rect.width(), rect.height()))
+                for name, rect in self.graphicsView.selectedAreas()]
 
-        return s
+    def getUrlwatchConfig(self, wkhtml_parameters=None):
+        return urlwatchConfig(self.getAreas(), wkhtml_parameters or self.getWkhtmlParameters())
 
     def getWkhtmlParameters(self):
         # generate only parameters passed to wkhtmltoimage (except destination filename) to get full screenshot
-        parameters = []
-
         if self.url_dict["static_size"]:
-            parameters.append("--height")
-            parameters.append(self.url_dict["height"])
-            parameters.append("--width")
-            parameters.append(self.url_dict["width"])
-
-        # add delay
-        parameters.append("--javascript-delay")
-        parameters.append(self.url_dict["delay"])
-
-        parameters.append(self.url_dict["url"])
-
-        return parameters
+            return wkhtmlParameters(self.url_dict["url"], self.url_dict["delay"],
+                                    self.url_dict["width"], self.url_dict["height"])
+        # a viewport width without static height may have been chosen by comparing variants
+        return wkhtmlParameters(self.url_dict["url"], self.url_dict["delay"], self.url_dict.get("viewport_width"))
 
     def getXvfbParameters(self):
-        # generate complete parameter set for xvfb call
-
-        parameters = XVFB_BASE_PARAMETERS.copy()
-        # append wkhtmltoimage parameters
-        parameters += self.getWkhtmlParameters()
-        parameters.append(self.tempfilename)
-
-        return parameters
+        # generate complete parameter set for xvfb call, the screenshot is written to the standard output
+        return xvfbParameters(self.getWkhtmlParameters())
 
     def getImage(self):
         self.url_dict = UrlDialog.getUrl(self)
 
         if self.url_dict["ok"]:
+            self.cancelLoading(None)
+
             self.statusBarWidget.setText("Loading page...")
             self.graphicsView.clearImage()
+            self.graphicsView.clearSelections()
+            self.graphicsView.clearChangedTiles()
             self.confirm_area_action.setDisabled(True)
-            self.selected_rectangle = None
+            self.startRender()
+
+    def refresh(self):
+        """ Render the page again with the same parameters while the current screenshot and areas stay, then show
+        the tiles that changed, e.g. ads or timestamps that should not be part of an area of interest
+        """
+        if importlib.util.find_spec("numpy") is None:
+            QMessageBox.warning(self, "Refresh", "Comparing the screenshots requires numpy "
+                                                 "(sudo apt install python3-numpy).")
+            return
+        self.cancelLoading(None)
+        self.refresh_previous = self.graphicsView.image()
+        self.statusBarWidget.setText("Refreshing page...")
+        self.startRender()
+
+    def startRender(self):
+        """ Render the page of url_dict in the background, see getImageCallback """
+        self.cancel_action.setDisabled(False)
+        self.refresh_action.setDisabled(True)
+
+        self.render_image = QByteArray()
+        self.render_output = b""
+        self.cancel_reason = None
+        self.process = QProcess()
+        self.process.readyReadStandardOutput.connect(self.onRenderData)
+        self.process.readyReadStandardError.connect(self.onRenderProgress)
+        self.process.finished.connect(self.getImageCallback)
+
+        # run in a new session so that cancelling can stop xvfb-run, Xvfb and wkhtmltoimage together
+        self.process.start("setsid", [XVFB] + self.getXvfbParameters())
+        self.timeout_timer.start(RENDER_TIMEOUT + int(self.url_dict["delay"]))
+
+    def updateRefreshAction(self):
+        """ A screenshot can be refreshed once it is shown and nothing is loading """
+        loading = self.loader is not None or \
+            (self.process is not None and self.process.state() != QProcess.NotRunning)
+        self.refresh_action.setDisabled(loading or self.url_dict is None or not self.graphicsView.hasImage())
+
+    def onRenderData(self):
+        if self.sender() is self.process:
+            self.render_image.append(self.process.readAllStandardOutput())
+
+    def onRenderProgress(self):
+        """ wkhtmltoimage reports its progress on the error output, e.g. "[=====>   ] 50%" """
+        self.render_output += bytes(self.process.readAllStandardError())
+        progress = re.findall(rb"(\d+)%", self.render_output[-200:])
+        if progress:
+            action = "Loading" if self.refresh_previous is None else "Refreshing"
+            self.statusBarWidget.setText("{} page... {}%".format(action, int(progress[-1])))
+
+    def cancelLoading(self, reason):
+        """ Stop rendering and decoding of the current screenshot """
+        self.timeout_timer.stop()
+        self.cancel_action.setDisabled(True)
+
+        if self.loader is not None:
+            self.loader.requestInterruption()
+            self.loader = None
+            if self.refresh_previous is None:
+                # a preview may be shown already, which cannot be used to select an area precisely
+                self.graphicsView.clearImage()
+                self.onSelectionsChanged()
+            if reason is not None:
+                self.statusBarWidget.setText(reason)
+        # a cancelled refresh keeps the previous screenshot
+        self.refresh_previous = None
+
+        if self.process is not None and self.process.state() != QProcess.NotRunning:
+            self.cancel_reason = reason
+            process = self.process
+            self.killRenderProcess(process, signal.SIGTERM)
+            # xvfb-run may ignore SIGTERM while it waits for its children
+            QTimer.singleShot(3000, lambda: self.killRenderProcess(process, signal.SIGKILL))
 
-            self.process = QProcess()
-            self.process.finished.connect(self.getImageCallback)
-
-            self.process.start(XVFB, self.getXvfbParameters())
+    @staticmethod
+    def killRenderProcess(process, sig):
+        if process.state() == QProcess.NotRunning:
+            return
+        try:
+            os.killpg(process.processId(), sig)
+        except ProcessLookupError:
+            pass
 
     def getImageCallback(self, returncode):
-        msg = QMessageBox(self)
+        if self.sender() is not self.process:
+            return  # a cancelled process finished after a new one was started
+        self.timeout_timer.stop()
+
+        self.render_image.append(self.process.readAllStandardOutput())
+        data, self.render_image = self.render_image, QByteArray()
+
+        if self.cancel_reason is not None:
+            self.statusBarWidget.setText(self.cancel_reason)
+            self.updateRefreshAction()
+            return
 
         if returncode == 0:
-            image = QImage(self.tempfilename)
-            self.graphicsView.setImage(image)
-            self.resize(min(image.width() + 64, 1400), min(image.height() + 64, 800))
-            self.statusBarWidget.setText("Drag or zoom with middle button and select area of interest. "
-                                         "Afterwards confirm area in menu.")
-
-            msg.setIcon(QMessageBox.Information)
-            msg.setWindowTitle("Screenshot loaded")
-            msg.setText("A screenshot was successfully loaded.")
-            msg.setInformativeText("1. Drag or zoom the image with the middle button and mousewheel. \n"
-                                   "2. Select area of interest by left-clicking and dragging. \n"
-                                   "3. Finally, confirm the area.")
+            self.loadScreenshot(data)
+            return
 
-        else:
-            self.statusBarWidget.setText("Error while loading page")
-
-            msg.setIcon(QMessageBox.Warning)
-            msg.setWindowTitle("Error while loading page")
-            msg.setText("There was an error while loading the page.")
-            msg.setInformativeText("The URL was possibly incorrect. "
-                                   "Also, some pages cannot be loaded without specifying a static size - "
-                                   "so you might want to try that.")
-            msg.setDetailedText(
-                "Standard output:\n\n{}\n\n--\nError output:\n\n{}".format(
-                    bytes(self.process.readAllStandardOutput()).decode(),
-                    bytes(self.process.readAllStandardError()).decode()
-                ))
+        self.cancel_action.setDisabled(True)
+        self.refresh_previous = None
+        self.updateRefreshAction()
+        self.statusBarWidget.setText("Error while loading page")
 
+        msg = QMessageBox(self)
+        msg.setIcon(QMessageBox.Warning)
+        msg.setWindowTitle("Error while loading page")
+        msg.setText("There was an error while loading the page.")
+        msg.setInformativeText("The URL was possibly incorrect. "
+                               "Also, some pages cannot be loaded without specifying a static size - "
+                               "so you might want to try that.")
+        msg.setDetailedText(
+            "Error output:\n\n{}".format(
+                (self.render_output + bytes(self.process.readAllStandardError())).decode(errors="replace")
+            ))
         msg.exec_()
 
+    def loadScreenshot(self, data):
+        """ Decode an encoded screenshot in the background and show it """
+        self.statusBarWidget.setText("Decoding screenshot...")
+        self.cancel_action.setDisabled(False)
+        self.loader = ImageLoader(data, self, self.refresh_previous)
+        self.loader.previewReady.connect(self.onPreviewReady)
+        self.loader.diffReady.connect(self.onDiffReady)
+        self.loader.imageReady.connect(self.onImageReady)
+        self.loader.failed.connect(self.onImageFailed)
+        self.loader.start()
+
+    def compareVariants(self):
+        """ Render the page at several viewports and delays and continue with the chosen screenshot """
+        variant, data = VariantDialog.getVariant(self.url_dict["url"] if self.url_dict else "", self)
+        if variant is None:
+            return
+
+        self.cancelLoading(None)
+        self.graphicsView.clearImage()
+        self.graphicsView.clearSelections()
+        self.graphicsView.clearChangedTiles()
+        self.confirm_area_action.setDisabled(True)
+        self.refresh_action.setDisabled(True)
+        self.url_dict = {"ok": True, "url": variant.url, "static_size": variant.height is not None,
+                         "width": variant.width, "height": variant.height, "delay": variant.delay,
+                         "viewport_width": variant.width}
+        # the screenshot of the variant is used as is, the page is not rendered again
+        self.loadScreenshot(data)
+
+    def onPreviewReady(self, preview, size):
+        if self.sender() is not self.loader:
+            return
+        self.graphicsView.setImage(preview, size=size)
+        self.resize(min(size.width() + 64, 1400), min(size.height() + 64, 800))
+        self.statusBarWidget.setText("Showing preview, decoding full resolution screenshot...")
+
+    def onDiffReady(self, tiles, total):
+        if self.sender() is not self.loader:
+            return
+        self.graphicsView.setChangedTiles(tiles)
+        changed_areas = [name for name, rect in self.graphicsView.selectedAreas()
+                         if any(rect.intersects(tile) for tile in tiles)]
+        text = "Refreshed: {} of {} tiles changed".format(len(tiles), total)
+        if changed_areas:
+            text += ", some of them in {}".format(", ".join(changed_areas))
+        self.statusBarWidget.setText(text)
+
+    def onImageReady(self, image, levels):
+        if self.sender() is not self.loader:
+            return
+        self.loader = None
+        self.cancel_action.setDisabled(True)
+
+        if self.refresh_previous is not None:
+            # zoom, position and areas stay as they are; the areas are kept in scene (image) coordinates
+            self.refresh_previous = None
+            self.graphicsView.setImage(image, levels)
+            self.graphicsView.updateRubberBandDisplay()
+            self.onSelectionsChanged()
+            self.updateRefreshAction()
+            return
+
+        # selections made on the preview are kept, they already use full resolution coordinates
+        self.graphicsView.setImage(image, levels)
+        self.resize(min(image.width() + 64, 1400), min(image.height() + 64, 800))
+        self.onSelectionsChanged()
+        self.updateRefreshAction()
+        self.statusBarWidget.setText("Drag or zoom with middle button and select area of interest. "
+                                     "Afterwards confirm area in menu.")
+
+        msg = QMessageBox(self)
+        msg.setIcon(QMessageBox.Information)
+        msg.setWindowTitle("Screenshot loaded")
+        msg.setText("A screenshot was successfully loaded.")
+        msg.setInformativeText("1. Drag or zoom the image with the middle button and mousewheel. \n"
+                               "2. Select area of interest by left-clicking and dragging. "
+                               "Hold shift to select further areas, right-click an area to rename it. \n"
+                               "3. Finally, confirm the area.")
+        msg.exec_()
+
+    def onImageFailed(self, error):
+        if self.sender() is not self.loader:
+            return
+        self.loader = None
+        self.cancel_action.setDisabled(True)
+        if self.refresh_previous is None:
+            self.graphicsView.clearImage()
+        self.refresh_previous = None
+        self.updateRefreshAction()
+        self.statusBarWidget.setText("Error while decoding screenshot")
+        QMessageBox.warning(self, "Error while decoding screenshot",
+                            "The screenshot could not be decoded: {}".format(error))
+
     def onConfirm(self, event):
-        wizard = MagicWizard(self, self.getUrlwatchConfig())
+        if not self.hasFullImage():
+            return
+        # offer to find a shorter delay and cheaper settings that render the selected areas the same way
+        areas = self.getAreas()
+        image = self.graphicsView.image()
+        wkhtml_parameters = self.getWkhtmlParameters()
+        parameters = DelayTunerDialog.getParameters(jobParameters(areas, wkhtml_parameters), areas, image, self)
+        parameters = ProfileTunerDialog.getParameters(parameters, areas, image, self)
+        if "--height" not in wkhtml_parameters:
+            # the backend limits the height by itself, further down for tracked areas that may move
+            parameters = withoutOption(parameters, "--height")
+        wizard = MagicWizard(self, self.getUrlwatchConfig(parameters))
         wizard.exec_()
 
-    def onRectSet(self, r: QRect):
-        """Rectangle has been selected"""
-        self.selected_rectangle = r
-        if self.graphicsView.hasImage() and r.width() > 1 and r.height() > 1:
+    def hasFullImage(self):
+        """ Whether the screenshot is shown in full resolution, not only the preview of the loader """
+        return self.graphicsView.hasImage() and (self.loader is None or self.refresh_previous is not None)
+
+    def onSelectionsChanged(self):
+        """Areas have been selected, changed or removed"""
+        # the tuners of onConfirm compare renders with the shown screenshot, which must not be the preview
+        if self.hasFullImage() and self.graphicsView.selectedAreas():
             self.confirm_area_action.setDisabled(False)
         else:
             self.confirm_area_action.setDisabled(True)
 
 
 if __name__ == '__main__':
+    requireTool(WKHTMLTOIMAGE)
+    requireTool(XVFB)
+
     app = QApplication(sys.argv)
     app.setQuitOnLastWindowClosed(True)
 
@@ -0,0 +1,115 @@
+"""
+Instrumentation of checks: duration of every stage, CPU time and peak memory of the wkhtmltoimage process,
+size of the rendered image and the reason the check ended.
+
+Metrics are appended as one JSON object per line to a file, or, if the file name ends with .prom, written in the
+Prometheus text format (e.g. for the textfile collector of the node exporter) with one set of samples per job.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import time
+
+PROMETHEUS_PREFIX = "pyvisualcompare_check_"
+
+
+class CheckMetrics:
+    """ Metrics of one check of a job """
+
+    def __init__(self, job):
+        self.record = {
+            "time": round(time.time(), 3),
+            "job": job.key(),
+            "name": job.name,
+            "url": job.url(),
+            # duration of every stage [s], see backend.check for the stages
+            "stages": {},
+            # "ok", "render-error", "render-timeout", "render-oom" or "error"
+            "exit": None,
+        }
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Measure the duration of a stage; a stage that is run several times is summed up """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages = self.record["stages"]
+            stages[name] = round(stages.get(name, 0.0) + time.perf_counter() - start, 6)
+
+    def addStage(self, name, seconds):
+        self.record["stages"][name] = round(self.record["stages"].get(name, 0.0) + seconds, 6)
+
+    def set(self, **values):
+        self.record.update(values)
+
+    def childUsage(self, usage):
+        """ Store the resource usage (from os.wait4) of the render process """
+        self.record["child"] = {"cpu_user": round(usage.ru_utime, 6), "cpu_system": round(usage.ru_stime, 6),
+                                "max_rss_kib": usage.ru_maxrss}
+
+    def write(self, path):
+        if path.endswith(".prom"):
+            writePrometheus(path, self.record)
+        else:
+            writeJsonLine(path, self.record)
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """ Lock a file against concurrent writers (other threads or checker processes) """
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def writeJsonLine(path, record):
+    line = json.dumps(record, sort_keys=True) + "\n"
+    with _locked(path), open(path, "a") as f:
+        f.write(line)
+
+
+def _escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def prometheusSamples(record):
+    """ Samples of a record as lines in the Prometheus text format """
+    labels = 'job_key="{}",name="{}",url="{}"'.format(
+        _escapeLabel(record["job"]), _escapeLabel(record["name"] or ""), _escapeLabel(record["url"]))
+    lines = ["{}timestamp_seconds{{{}}} {}".format(PROMETHEUS_PREFIX, labels, record["time"]),
+             '{}success{{{}}} {}'.format(PROMETHEUS_PREFIX, labels, int(record["exit"] == "ok"))]
+    for stage, seconds in sorted(record["stages"].items()):
+        lines.append('{}stage_seconds{{{},stage="{}"}} {}'.format(PROMETHEUS_PREFIX, labels, stage, seconds))
+    for key, value in sorted(record.get("child", {}).items()):
+        lines.append("{}child_{}{{{}}} {}".format(PROMETHEUS_PREFIX, key, labels, value))
+    if "image_bytes" in record:
+        lines.append("{}image_bytes{{{}}} {}".format(PROMETHEUS_PREFIX, labels, record["image_bytes"]))
+    return lines
+
+
+def writePrometheus(path, record):
+    """ Replace the samples of the record's job in a Prometheus text file, keeping those of other jobs """
+    own_label = 'job_key="{}"'.format(_escapeLabel(record["job"]))
+    with _locked(path):
+        try:
+            with open(path, "r") as f:
+                lines = [line.rstrip("\n") for line in f if own_label not in line and not line.startswith("#")]
+        except FileNotFoundError:
+            lines = []
+        lines += prometheusSamples(record)
+
+        # samples of one metric must be grouped below its TYPE line
+        metrics = {}
+        for line in lines:
+            metrics.setdefault(line.split("{", 1)[0], []).append(line)
+        with open(path + ".tmp", "w") as f:
+            for metric in sorted(metrics):
+                f.write("# TYPE {} gauge\n".format(metric))
+                f.write("\n".join(metrics[metric]) + "\n")
+        os.replace(path + ".tmp", path)
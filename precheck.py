@@ -0,0 +1,172 @@
+"""
+Cheap pre-check before rendering: fetches the page and the resources it links (style sheets, scripts and images)
+with conditional requests (ETag, If-Modified-Since) and hashes them. If the fingerprint of the page is the same
+as at the last render, the page would look the same, so the render is skipped and the previous hashes are reported.
+
+Content that JavaScript loads later (e.g. with XMLHttpRequest) is not part of the fingerprint, which is why the
+pre-check is optional and a page is rendered at least every max_age seconds anyway.
+"""
+import contextlib
+import hashlib
+import html.parser
+import http.client
+import json
+import os
+import re
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+USER_AGENT = "pyvisualcompare-precheck"
+FETCH_TIMEOUT = 10
+MAX_RESOURCES = 50
+MAX_BYTES = 16 * 1024 * 1024
+
+COMMENT = re.compile(r"<!--.*?-->", re.DOTALL)
+WHITESPACE = re.compile(r"\s+")
+WHITESPACE_BETWEEN_TAGS = re.compile(r">\s+<")
+
+
+class ResourceCollector(html.parser.HTMLParser):
+    """ Collects the URLs of resources that change the look of a page """
+
+    def __init__(self):
+        super(ResourceCollector, self).__init__()
+        self.urls = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "link" and "stylesheet" in (attrs.get("rel") or "").lower().split():
+            url = attrs.get("href")
+        elif tag in ("script", "img", "iframe"):
+            url = attrs.get("src")
+        else:
+            return
+        if url and url not in self.urls:
+            self.urls.append(url)
+
+
+def normalizeHtml(text):
+    """ Drop what does not change the look of a page: comments, whitespace between tags and the amount of
+    whitespace elsewhere
+    """
+    text = WHITESPACE.sub(" ", COMMENT.sub("", text))
+    return WHITESPACE_BETWEEN_TAGS.sub("><", text).strip()
+
+
+def contentHash(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def fetch(url, validator, timeout=FETCH_TIMEOUT):
+    """ Conditional GET of a URL. validator holds the ETag and Last-Modified header of the last fetch (or is None).
+    Returns (validator, response, body); response and body are None if the server reported 304 Not Modified.
+    """
+    headers = {"User-Agent": USER_AGENT}
+    if validator:
+        if validator.get("etag"):
+            headers["If-None-Match"] = validator["etag"]
+        if validator.get("last_modified"):
+            headers["If-Modified-Since"] = validator["last_modified"]
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+            body = response.read(MAX_BYTES)
+            if len(body) < MAX_BYTES and response.length:
+                # read with a size limit returns what arrived if the connection was closed early
+                raise http.client.IncompleteRead(body, response.length)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and validator:
+            return validator, None, None
+        raise
+    return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}, \
+        response, body
+
+
+def pageFingerprint(url, previous, timeout=FETCH_TIMEOUT):
+    """ Fetch a page and its resources and return (fingerprint, validators). previous are the validators of the
+    last fetch, which also hold the hashes of documents that are not modified since.
+    """
+    if "://" not in url:
+        url = "http://" + url  # wkhtmltoimage accepts URLs without scheme
+    validators = {}
+
+    try:
+        validator, response, body = fetch(url, previous.get(url), timeout)
+    except http.client.HTTPException as e:
+        # e.g. a truncated response (IncompleteRead) or a malformed status line, a network error for the caller
+        raise OSError("Invalid HTTP response: {!r}".format(e)) from e
+    if response is None:
+        validators[url] = validator
+    else:
+        charset = response.headers.get_content_charset() or "utf-8"
+        text = body.decode(charset, errors="replace")
+        collector = ResourceCollector()
+        collector.feed(text)
+        base = response.geturl()
+        resources = [urllib.parse.urljoin(base, resource) for resource in collector.urls]
+        validator.update(hash=contentHash(normalizeHtml(text).encode()),
+                         resources=[resource for resource in resources
+                                    if resource.startswith(("http://", "https://"))][:MAX_RESOURCES])
+        validators[url] = validator
+
+    parts = [validators[url]["hash"]]
+    for resource in validators[url]["resources"]:
+        try:
+            validator, response, body = fetch(resource, previous.get(resource), timeout)
+        except (urllib.error.URLError, OSError, http.client.HTTPException) as e:
+            # a broken resource is part of the look of the page as well
+            validator = {"hash": "error:{}".format(getattr(e, "code", None) or type(e).__name__)}
+        else:
+            if response is not None:
+                validator["hash"] = contentHash(body)
+        validators[resource] = validator
+        parts.append(validator["hash"])
+    return contentHash("\n".join(parts).encode()), validators
+
+
+class PrecheckState:
+    """ Fingerprint and reported hashes of a job at its last render, stored in a JSON file per job """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    @classmethod
+    def forJob(cls, state_dir, job):
+        return cls(os.path.join(state_dir, "precheck", job.key() + ".json"))
+
+    def validators(self):
+        return self.entries.get("validators", {})
+
+    def unchangedResults(self, fingerprint, max_age):
+        """ The results of the last render as list of (name, digest) if the page has the same fingerprint and
+        was rendered less than max_age seconds ago, otherwise None
+        """
+        if self.entries.get("fingerprint") != fingerprint or time.time() - self.entries.get("rendered", 0) > max_age:
+            return None
+        return [tuple(result) for result in self.entries.get("results", [])] or None
+
+    def update(self, fingerprint, validators, results, rendered=True):
+        """ Store the state after a check; results are (name, digest) of every area """
+        self.entries["validators"] = validators
+        if rendered:
+            self.entries.update(fingerprint=fingerprint, results=[list(result) for result in results],
+                                rendered=time.time())
+
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(temp_path)
+            raise
@@ -0,0 +1,360 @@
+"""
+Finds the cheapest wkhtmltoimage settings that still render the selected areas exactly as in the screenshot.
+
+The JavaScript delay is tuned first (DelayTunerDialog): the page is rendered several times with every shorter
+delay, in parallel, and the shortest delay is chosen whose renders all match the screenshot, as do the renders of
+every longer delay. That delay would otherwise be paid on every check.
+
+After an area has been confirmed, the page is rendered again with every combination of cheaper settings: without
+images, without JavaScript (and therefore without the JavaScript delay) and with a viewport just wide enough for
+the areas. A profile matches if the pixels of every area are unchanged; the fastest matching profile is then used
+for the urlwatch configuration. Renders run one after the other by default so that their times are comparable.
+"""
+import itertools
+import os
+import statistics
+
+from PyQt5.QtCore import Qt, QBuffer, QRect
+from PyQt5.QtGui import QImage, QImageReader
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QTableWidget, \
+    QTableWidgetItem, QHeaderView, QAbstractItemView, QSpinBox
+
+from urlwatchconfig import optionValue, withoutOption
+from variantcapture import RenderPool
+
+# width of a page if the parameters do not set one, like wkhtmltoimage
+DEFAULT_WIDTH = 1024
+# a narrower viewport is rounded up to a multiple of this [pixels]
+WIDTH_STEP = 16
+# delays that are tried if they are shorter than the one of the screenshot [ms]
+DELAY_STEPS = (0, 100, 250, 500, 1000, 2000, 3000, 5000, 10000)
+# renders per delay; a delay is stable if all of them match
+DELAY_REPEATS = 3
+
+
+def areaWidth(areas):
+    """ Narrowest viewport that contains all areas of interest """
+    right = max(x + w for _, (x, _, w, _) in areas)
+    return -(-right // WIDTH_STEP) * WIDTH_STEP
+
+
+class RenderProfile:
+    """ Cheaper settings applied to the wkhtmltoimage parameters of a job """
+
+    def __init__(self, parameters, images=True, javascript=True, width=None, delay=None):
+        # parameters of the job as generated by the frontend, the URL is the last one
+        self.parameters = list(parameters)
+        self.images = images
+        self.javascript = javascript
+        # None keeps the width or JavaScript delay [ms] of the parameters
+        self.width = width
+        self.delay = delay
+
+    def label(self):
+        changes = []
+        if not self.images:
+            changes.append("no images")
+        if not self.javascript:
+            changes.append("no JavaScript")
+        if self.width is not None:
+            changes.append("{} px wide".format(self.width))
+        if self.delay is not None:
+            changes.append("{} ms delay".format(self.delay))
+        return ", ".join(changes) or "original settings"
+
+    def wkhtmlParameters(self):
+        parameters = self.parameters
+        if self.width is not None:
+            parameters = ["--width", str(self.width)] + withoutOption(parameters, "--width")
+        if self.delay is not None:
+            parameters = ["--javascript-delay", str(self.delay)] + withoutOption(parameters, "--javascript-delay")
+        if not self.javascript:
+            # no script can change the page, so there is nothing to wait for
+            parameters = ["--disable-javascript", "--javascript-delay", "0"] + \
+                withoutOption(parameters, "--javascript-delay")
+        if not self.images:
+            parameters = ["--no-images"] + parameters
+        return parameters
+
+
+def renderProfiles(parameters, areas):
+    """ All profiles to try, starting with the original settings """
+    widths = [None]
+    narrow = areaWidth(areas)
+    if narrow < int(optionValue(parameters, "--width") or DEFAULT_WIDTH):
+        widths.append(narrow)
+    return [RenderProfile(parameters, images, javascript, width)
+            for images, javascript, width in itertools.product((True, False), (True, False), widths)]
+
+
+def areasUnchanged(data, areas, reference):
+    """ Whether an encoded screenshot has the same pixels as the reference image (QImage) in all areas """
+    rects = [QRect(*rect) for _, rect in areas]
+    bounds = rects[0]
+    for rect in rects[1:]:
+        bounds = bounds.united(rect)
+
+    # decode only the part of the page with the areas
+    buffer = QBuffer(data)
+    buffer.open(QBuffer.ReadOnly)
+    reader = QImageReader(buffer)
+    size = reader.size()
+    if not QRect(0, 0, size.width(), size.height()).contains(bounds):
+        return False
+    reader.setClipRect(bounds)
+    image = reader.read()
+    if image.isNull():
+        return False
+    image = image.convertToFormat(QImage.Format_RGB32)
+    reference = reference.convertToFormat(QImage.Format_RGB32)
+    return all(image.copy(rect.translated(-bounds.topLeft())) == reference.copy(rect) for rect in rects)
+
+
+class ProfileTunerDialog(QDialog):
+    def __init__(self, parameters, areas, reference, parent=None):
+        super(ProfileTunerDialog, self).__init__(parent)
+        self.setWindowTitle("Find the fastest render settings")
+        self.areas = areas
+        self.reference = reference
+        self.profiles = renderProfiles(parameters, areas)
+        self.results = {}  # index -> (render time [ms], areas unchanged)
+        self.selected = None
+
+        vbox = QVBoxLayout(self)
+        label = QLabel("The page is rendered again with cheaper settings. Settings that leave the selected areas "
+                       "unchanged can be used for the urlwatch configuration; the fastest one is preselected.")
+        label.setWordWrap(True)
+        vbox.addWidget(label)
+
+        self.table = QTableWidget(len(self.profiles), 3)
+        self.table.setHorizontalHeaderLabels(["Settings", "Render time", "Areas"])
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        for row, profile in enumerate(self.profiles):
+            self.table.setItem(row, 0, QTableWidgetItem(profile.label()))
+            self.table.setItem(row, 1, QTableWidgetItem("waiting..."))
+            self.table.setItem(row, 2, QTableWidgetItem(""))
+        self.table.itemSelectionChanged.connect(self.onSelectionChanged)
+        vbox.addWidget(self.table)
+
+        controls = QHBoxLayout()
+        controls.addWidget(QLabel("Parallel renders"))
+        self.workers_edit = QSpinBox()
+        self.workers_edit.setRange(1, 8)
+        self.workers_edit.setValue(1)
+        self.workers_edit.setToolTip("Parallel renders are faster, but their times are less comparable")
+        controls.addWidget(self.workers_edit)
+        self.status_label = QLabel()
+        controls.addWidget(self.status_label, 1)
+        vbox.addLayout(controls)
+
+        buttons = QHBoxLayout()
+        self.start_button = QPushButton("Start")
+        self.start_button.clicked.connect(self.startRendering)
+        buttons.addWidget(self.start_button)
+        buttons.addStretch(1)
+        self.use_button = QPushButton("Use selected settings")
+        self.use_button.setDisabled(True)
+        self.use_button.clicked.connect(self.useSelected)
+        buttons.addWidget(self.use_button)
+        keep_button = QPushButton("Keep original settings")
+        keep_button.clicked.connect(self.reject)
+        buttons.addWidget(keep_button)
+        vbox.addLayout(buttons)
+
+        self.pool = RenderPool(1, self)
+        self.pool.variantStarted.connect(lambda row: self.table.item(row, 1).setText("rendering..."))
+        self.pool.variantFinished.connect(self.onProfileFinished)
+        self.pool.variantFailed.connect(self.onProfileFailed)
+        self.pool.allFinished.connect(self.onAllFinished)
+
+        self.resize(600, 400)
+
+    def startRendering(self):
+        self.start_button.setDisabled(True)
+        self.workers_edit.setDisabled(True)
+        self.status_label.setText("Rendering {} settings...".format(len(self.profiles)))
+        self.pool.max_workers = self.workers_edit.value()
+        self.pool.render(self.profiles)
+
+    def onProfileFinished(self, row, data, elapsed):
+        unchanged = areasUnchanged(data, self.areas, self.reference)
+        self.results[row] = (elapsed, unchanged)
+        self.table.item(row, 1).setText("{:.1f} s".format(elapsed / 1000))
+        self.table.item(row, 2).setText("unchanged" if unchanged else "changed")
+        if not unchanged:
+            for column in range(3):
+                self.table.item(row, column).setForeground(Qt.gray)
+
+    def onProfileFailed(self, row, error):
+        self.table.item(row, 1).setText("failed")
+        self.table.item(row, 2).setText(error)
+
+    def onAllFinished(self):
+        matching = [row for row, (_, unchanged) in self.results.items() if unchanged]
+        if not matching:
+            self.status_label.setText("No settings render the areas unchanged, the page may change on every "
+                                      "render. Keep the original settings.")
+            return
+        fastest = min(matching, key=lambda row: self.results[row][0])
+        self.status_label.setText("Fastest: {}".format(self.profiles[fastest].label()))
+        self.table.selectRow(fastest)
+
+    def onSelectionChanged(self):
+        rows = self.table.selectionModel().selectedRows()
+        row = rows[0].row() if rows else None
+        self.use_button.setEnabled(row is not None and self.results.get(row, (0, False))[1])
+
+    def useSelected(self):
+        self.selected = self.table.selectionModel().selectedRows()[0].row()
+        self.pool.cancel()
+        self.accept()
+
+    def reject(self):
+        self.pool.cancel()
+        super(ProfileTunerDialog, self).reject()
+
+    @staticmethod
+    def getParameters(parameters, areas, reference, parent=None):
+        """ Show the dialog; returns the wkhtmltoimage parameters of the chosen profile, or the given ones """
+        dialog = ProfileTunerDialog(parameters, areas, reference, parent)
+        if dialog.exec_() != QDialog.Accepted or dialog.selected is None:
+            return list(parameters)
+        return dialog.profiles[dialog.selected].wkhtmlParameters()
+
+
+def shortestStableDelay(matches):
+    """ Shortest delay from which on all renders matched, from a dict delay -> list of whether each render
+    matched; None if not even the longest delay is stable
+    """
+    stable = None
+    for delay in sorted(matches, reverse=True):
+        if not matches[delay] or not all(matches[delay]):
+            break
+        stable = delay
+    return stable
+
+
+class DelayTunerDialog(QDialog):
+    def __init__(self, parameters, areas, reference, parent=None):
+        super(DelayTunerDialog, self).__init__(parent)
+        self.setWindowTitle("Find the shortest JavaScript delay")
+        self.parameters = list(parameters)
+        self.areas = areas
+        self.reference = reference
+        current = int(optionValue(parameters, "--javascript-delay") or 0)
+        self.delays = [delay for delay in DELAY_STEPS if delay < current] + [current]
+        # every delay is rendered several times; variant i belongs to delay i // DELAY_REPEATS
+        self.variants = [RenderProfile(parameters, delay=delay)
+                         for delay in self.delays for _ in range(DELAY_REPEATS)]
+        self.matches = {delay: [] for delay in self.delays}
+        self.times = {delay: [] for delay in self.delays}
+        self.stable_delay = None
+        self.selected = None
+
+        vbox = QVBoxLayout(self)
+        label = QLabel("The page is rendered {} times with every shorter JavaScript delay. The shortest delay at "
+                       "which the selected areas always look like in the screenshot is preselected; it is waited "
+                       "for on every check.".format(DELAY_REPEATS))
+        label.setWordWrap(True)
+        vbox.addWidget(label)
+
+        self.table = QTableWidget(len(self.delays), 3)
+        self.table.setHorizontalHeaderLabels(["Delay", "Matching renders", "Render time"])
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        for row, delay in enumerate(self.delays):
+            self.table.setItem(row, 0, QTableWidgetItem("{} ms".format(delay)))
+            self.table.setItem(row, 1, QTableWidgetItem("waiting..."))
+            self.table.setItem(row, 2, QTableWidgetItem(""))
+        self.table.itemSelectionChanged.connect(self.onSelectionChanged)
+        vbox.addWidget(self.table)
+
+        controls = QHBoxLayout()
+        controls.addWidget(QLabel("Parallel renders"))
+        self.workers_edit = QSpinBox()
+        self.workers_edit.setRange(1, 16)
+        self.workers_edit.setValue(min(4, os.cpu_count() or 1))
+        controls.addWidget(self.workers_edit)
+        self.status_label = QLabel()
+        controls.addWidget(self.status_label, 1)
+        vbox.addLayout(controls)
+
+        buttons = QHBoxLayout()
+        self.start_button = QPushButton("Start")
+        self.start_button.clicked.connect(self.startRendering)
+        buttons.addWidget(self.start_button)
+        buttons.addStretch(1)
+        self.use_button = QPushButton("Use selected delay")
+        self.use_button.setDisabled(True)
+        self.use_button.clicked.connect(self.useSelected)
+        buttons.addWidget(self.use_button)
+        keep_button = QPushButton("Keep delay of {} ms".format(current))
+        keep_button.clicked.connect(self.reject)
+        buttons.addWidget(keep_button)
+        vbox.addLayout(buttons)
+
+        self.pool = RenderPool(1, self)
+        self.pool.variantFinished.connect(self.onVariantFinished)
+        self.pool.variantFailed.connect(lambda index, error: self.addResult(index, False, None))
+        self.pool.allFinished.connect(self.onAllFinished)
+
+        self.resize(500, 400)
+
+    def startRendering(self):
+        self.start_button.setDisabled(True)
+        self.workers_edit.setDisabled(True)
+        self.status_label.setText("Rendering {} times...".format(len(self.variants)))
+        self.pool.max_workers = self.workers_edit.value()
+        self.pool.render(self.variants)
+
+    def onVariantFinished(self, index, data, elapsed):
+        self.addResult(index, areasUnchanged(data, self.areas, self.reference), elapsed)
+
+    def addResult(self, index, unchanged, elapsed):
+        row = index // DELAY_REPEATS
+        delay = self.delays[row]
+        self.matches[delay].append(unchanged)
+        if elapsed is not None:
+            self.times[delay].append(elapsed)
+        self.table.item(row, 1).setText("{} of {}".format(sum(self.matches[delay]), len(self.matches[delay])))
+        if self.times[delay]:
+            self.table.item(row, 2).setText("{:.1f} s".format(statistics.median(self.times[delay]) / 1000))
+
+    def onAllFinished(self):
+        delay = self.stable_delay = shortestStableDelay(self.matches)
+        if delay is None:
+            self.status_label.setText("The areas differ between renders even with the longest delay. "
+                                      "Keep the delay.")
+            return
+        self.status_label.setText("Shortest stable delay: {} ms".format(delay))
+        self.table.selectRow(self.delays.index(delay))
+
+    def onSelectionChanged(self):
+        rows = self.table.selectionModel().selectedRows()
+        # every delay from the shortest stable one on can be used
+        self.use_button.setEnabled(bool(rows) and self.stable_delay is not None and
+                                   self.delays[rows[0].row()] >= self.stable_delay)
+
+    def useSelected(self):
+        self.selected = self.delays[self.table.selectionModel().selectedRows()[0].row()]
+        self.pool.cancel()
+        self.accept()
+
+    def reject(self):
+        self.pool.cancel()
+        super(DelayTunerDialog, self).reject()
+
+    @staticmethod
+    def getParameters(parameters, areas, reference, parent=None):
+        """ Show the dialog; returns the wkhtmltoimage parameters with the chosen delay, or the given ones """
+        if "--disable-javascript" in parameters or not int(optionValue(parameters, "--javascript-delay") or 0):
+            return list(parameters)  # nothing to wait for
+        dialog = DelayTunerDialog(parameters, areas, reference, parent)
+        if dialog.exec_() != QDialog.Accepted or dialog.selected is None:
+            return list(parameters)
+        return RenderProfile(parameters, delay=dialog.selected).wkhtmlParameters()
@@ -1,21 +1,29 @@
 #!/bin/bash
-IMGFILE=$(mktemp)".png"
-ERRFILE=$(mktemp)".log"
-
-xvfb-run -a -s "-screen 0 640x480x16" wkhtmltoimage "$@" "$IMGFILE" >"$ERRFILE" 2>&1
+# The screenshot is streamed from wkhtmltoimage's standard output into md5sum, so no temporary files are needed.
+# The messages of xvfb-run and wkhtmltoimage are captured together with the hash, which sed puts on a line of its own.
+# Like the backend checker, the render is limited in time, address space and CPU time (same environment variables,
+# 0 disables a limit). timeout stops the whole process group of xvfb-run, including Xvfb.
+set -o pipefail
+TIMEOUT=${PYVISUALCOMPARE_RENDER_TIMEOUT:-120}
+MEMORY=${PYVISUALCOMPARE_RENDER_MEMORY:-4096}
+CPU=${PYVISUALCOMPARE_RENDER_CPU:-60}
+OUTPUT=$( { (
+    [ "$MEMORY" != 0 ] && ulimit -v $((MEMORY * 1024))
+    [ "$CPU" != 0 ] && ulimit -t "$CPU"
+    exec timeout --kill-after=5 "$TIMEOUT" xvfb-run -a -s "-screen 0 640x480x16" wkhtmltoimage --format png "$@" -
+) 2>&3 | md5sum | sed 's/^/\n/'; } 3>&1 )
 
 RETCODE=$?
 if [ $RETCODE -ne 0 ]; then
-    # command failed
-    cat $ERRFILE
+    # command failed, show its messages without the hash of the incomplete output
+    echo "${OUTPUT%$'\n'*}"
+    if [ $RETCODE -eq 124 ] || [ $RETCODE -eq 137 ]; then
+        echo "timeout: wkhtmltoimage did not finish within $TIMEOUT s"
+    fi
     exit $RETCODE
 fi
 
-md5sum < $IMGFILE
-
-# clean up
-rm $IMGFILE 2>/dev/null
-rm $ERRFILE 2>/dev/null
+echo "${OUTPUT##*$'\n'}"
 
 # This script must be marked as executable and in urlwatch's PATH! Example:
 # sudo chmod +x /usr/local/bin/pyvisualcompare-md5.sh
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Scheduler mode of the backend checker: a long-running process that checks every watch job at its own interval
+instead of checking all jobs at once from a cronjob.
+
+The job list has the format of batch.py, every entry can additionally have an "interval" in seconds, e.g.
+    {"name": "python.org", "interval": 600, "crop": [8, 5, 232, 58], "parameters": ["python.org"]}
+
+Load is spread evenly:
+- the first check of every job starts at a random time within its interval and later checks are shifted by a
+  random jitter, so jobs with the same interval do not run at the same time,
+- at most --workers checks run at a time and at most --per-host checks of pages on the same host,
+- a job whose previous check is still running is skipped until its next turn,
+- after a failed check, the job is retried with exponentially growing delays (up to --max-backoff).
+
+Like urlwatch, a report is written whenever the output of a job is new, changed or an error, e.g.
+    CHANGED: python.org ( https://www.python.org )
+    --- @ Mon, 14 Oct 2019 10:00:00 +0200
+    +++ @ Mon, 14 Oct 2019 10:10:00 +0200
+    -d41d8cd98f00b204e9800998ecf8427e  -
+    +9e107d9d372bb6826bd81d3542a419d6  -
+The last output of every job is kept in the state directory, so restarting the scheduler does not report all jobs
+as new. With --json, the results are written as JSON lines like batch.py does.
+"""
+import argparse
+import collections
+import concurrent.futures
+import email.utils
+import heapq
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from backend import Settings, expectJobs, renderPool
+from batch import checkResult, jobFromEntry
+from frames import HASH_ALGORITHMS
+
+DEFAULT_INTERVAL = 600
+EVICT_INTERVAL = 600  # the cache is kept within its size at most this often [s]
+
+
+class ScheduledJob:
+    def __init__(self, job, interval):
+        self.job = job
+        self.interval = interval
+        self.next_run = 0.0  # time.monotonic()
+        self.failures = 0
+        self.running = False
+        self.queued = False
+
+    def jitter(self, fraction):
+        return random.uniform(-fraction, fraction) * self.interval
+
+    def backoff(self, max_backoff):
+        """ Delay until the next check after the given number of consecutive failures [s] """
+        return min(max_backoff, self.interval * 2 ** (self.failures - 1))
+
+
+def loadScheduledJobs(f, default_interval):
+    scheduled = []
+    for i, entry in enumerate(json.load(f)):
+        interval = float(entry.get("interval", default_interval))
+        if interval <= 0:
+            raise ValueError("Interval of job {} must be positive".format(entry.get("name") or i))
+        scheduled.append(ScheduledJob(jobFromEntry(entry, i), interval))
+    return scheduled
+
+
+def resultOutput(result):
+    """ Output of a check like the backend prints it, which is what urlwatch compares """
+    if result["status"] != "ok":
+        return None
+    if "regions" in result:
+        return "".join("{}  {}\n".format(region["hash"], region["name"]) for region in result["regions"])
+    return "{}  -\n".format(result["hash"])
+
+
+class OutputState:
+    """ Last output of every job, stored in a JSON file """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def get(self, job):
+        return self.entries.get(job.key())
+
+    def set(self, job, output, timestamp):
+        self.entries[job.key()] = {"output": output, "time": timestamp}
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(temp_path, self.path)
+
+
+def urlwatchReport(job, result, previous, timestamp):
+    """ Report in the style of urlwatch's text reporter or None if nothing changed """
+    title = "{} ( {} )".format(job.name, job.url())
+    output = resultOutput(result)
+    if output is None:
+        return "ERROR: {}\n{}\n".format(title, str(result.get("error", "")).strip())
+    if previous is None:
+        return "NEW: {}\n".format(title)
+    if previous["output"] == output:
+        return None
+
+    lines = ["CHANGED: {}".format(title),
+             "--- @ {}".format(email.utils.formatdate(previous["time"], localtime=True)),
+             "+++ @ {}".format(email.utils.formatdate(timestamp, localtime=True))]
+    lines += ["-" + line for line in previous["output"].splitlines()]
+    lines += ["+" + line for line in output.splitlines()]
+    return "\n".join(lines) + "\n"
+
+
+def runScheduler(scheduled, pool, settings, workers, per_host, report, jitter=0.1, max_backoff=3600,
+                 stop=None):
+    """ Check the jobs at their intervals until stop (a threading.Event) is set.
+    report(scheduled_job, result) is called in this thread for every finished check.
+    """
+    stop = stop or threading.Event()
+    now = time.monotonic()
+    heap = []  # (next_run, index), due jobs are moved to ready
+    for i, item in enumerate(scheduled):
+        item.next_run = now + random.uniform(0, item.interval)
+        heapq.heappush(heap, (item.next_run, i))
+    ready = collections.deque()  # due jobs waiting for a free worker or host slot
+    running = {}  # future -> ScheduledJob
+    host_load = collections.Counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while not stop.is_set():
+            now = time.monotonic()
+            while heap and heap[0][0] <= now:
+                _, i = heapq.heappop(heap)
+                item = scheduled[i]
+                # the next turn is planned from the due time, not from the end of the check
+                item.next_run = max(item.next_run + item.interval + item.jitter(jitter), now)
+                heapq.heappush(heap, (item.next_run, i))
+                if item.running or item.queued:
+                    sys.stderr.write("Skipping {}, its previous check is still running\n".format(item.job.name))
+                    continue
+                item.queued = True
+                ready.append(item)
+
+            # start as many jobs as the limits allow; jobs of busy hosts are skipped, not waited for
+            for item in list(ready):
+                if len(running) >= workers:
+                    break
+                if host_load[item.job.host()] >= per_host:
+                    continue
+                ready.remove(item)
+                item.queued = False
+                item.running = True
+                host_load[item.job.host()] += 1
+                running[executor.submit(checkResult, item.job, pool, settings)] = item
+
+            # sleep until the next job is due or a check finishes, but wake up regularly to notice stop
+            timeout = min(heap[0][0] - time.monotonic(), 1.0) if heap else 1.0
+            if running:
+                done, _ = concurrent.futures.wait(running, timeout=max(0.0, timeout),
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+            else:
+                done = ()
+                stop.wait(max(0.0, timeout))
+
+            for future in done:
+                item = running.pop(future)
+                item.running = False
+                host_load[item.job.host()] -= 1
+                result = future.result()
+                if result["status"] == "ok":
+                    item.failures = 0
+                else:
+                    item.failures += 1
+                    delay = item.backoff(max_backoff)
+                    if delay > item.interval:
+                        item.next_run = time.monotonic() + delay
+                        heap = [(run, i) if scheduled[i] is not item else (item.next_run, i) for run, i in heap]
+                        heapq.heapify(heap)
+                report(item, result)
+
+        # let running checks finish, their results are still reported
+        for future in concurrent.futures.as_completed(running):
+            report(running[future], future.result())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check pyvisualcompare watch jobs at their own intervals.")
+    parser.add_argument("jobs", help="JSON file with the job list")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL,
+                        help="interval of jobs without one [s] (default: {})".format(DEFAULT_INTERVAL))
+    parser.add_argument("--jitter", type=float, default=0.1,
+                        help="random shift of every check as fraction of the interval (default: 0.1)")
+    parser.add_argument("--max-backoff", type=float, default=3600,
+                        help="maximum delay between checks of a failing job [s] (default: 3600)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="maximum number of concurrent renders (default: number of CPUs)")
+    parser.add_argument("--per-host", type=int, default=2,
+                        help="maximum number of concurrent renders per host (default: 2)")
+    parser.add_argument("--hash", choices=HASH_ALGORITHMS,
+                        help="hash algorithm for the pixels of the area of interest (default: md5)")
+    parser.add_argument("--tolerance", type=float,
+                        help="enable the tolerant comparison with this threshold per block (see diffengine.py)")
+    parser.add_argument("--json", action="store_true", help="write every result as JSON line instead of reports")
+    parser.add_argument("-o", "--output", default="-", help="output file for the reports (default: stdout)")
+    args = parser.parse_args(argv)
+
+    with open(args.jobs, "r") as f:
+        scheduled = loadScheduledJobs(f, args.interval)
+
+    settings = Settings.fromEnvironment()
+    if args.hash:
+        settings.algorithm = args.hash
+    if args.tolerance is not None:
+        settings.tolerance = args.tolerance
+
+    pool = renderPool()
+    pool.size = max(pool.size, args.workers)
+    expectJobs([item.job for item in scheduled], settings)
+
+    os.makedirs(settings.state_dir, exist_ok=True)
+    state = OutputState(os.path.join(settings.state_dir, "scheduler.json"))
+    out = sys.stdout if args.output == "-" else open(args.output, "a")
+    last_eviction = time.monotonic()
+
+    def report(item, result):
+        nonlocal last_eviction
+        timestamp = time.time()
+        if args.json:
+            text = json.dumps(result) + "\n"
+        else:
+            text = urlwatchReport(item.job, result, state.get(item.job), timestamp)
+        output = resultOutput(result)
+        if output is not None:
+            previous = state.get(item.job)
+            if previous is None or previous["output"] != output:
+                state.set(item.job, output, timestamp)
+        if text:
+            out.write(text)
+            out.flush()
+        if settings.usesCache() and time.monotonic() - last_eviction > EVICT_INTERVAL:
+            settings.frameCache().evict()
+            last_eviction = time.monotonic()
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    try:
+        runScheduler(scheduled, pool, settings, args.workers, max(1, args.per_host), report, args.jitter,
+                     args.max_backoff, stop)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if settings.usesCache():
+            settings.frameCache().evict()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
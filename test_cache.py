@@ -0,0 +1,68 @@
+"""
+Tests of the eviction of the frame cache; run with python3 -m unittest
+"""
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from cache import EVICT_GRACE, FrameCache
+
+
+class EvictTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = FrameCache(tempfile.mkdtemp(), max_bytes=1000)
+
+    def age(self, digest, seconds):
+        path = self.cache._objectPath(digest)
+        os.utime(path, (time.time() - seconds,) * 2)
+
+    def testKeepsReferencedAndRecentObjects(self):
+        baseline = self.cache.store("job", "baseline-crop", b"b" * 800)
+        old = self.cache.put(b"o" * 800)
+        recent = self.cache.put(b"r" * 800)
+        self.age(baseline, 3600)
+        self.age(old, 3600)
+        self.cache.evict()
+        self.assertIsNotNone(self.cache.load("job", "baseline-crop"))
+        self.assertIsNone(self.cache.get(old))
+        self.assertIsNotNone(self.cache.get(recent))
+
+    def testKeepsObjectReferencedDuringEviction(self):
+        """ An old object that store uses again after evict read the references must not be deleted """
+        data = b"s" * 800
+        digest = self.cache.put(data)
+        self.age(digest, EVICT_GRACE * 2)
+        self.cache.put(b"x" * 800)
+        read_references = self.cache._referencedObjects
+
+        def storeDuringEviction():
+            referenced = read_references()
+            self.cache.store("job", "frame", data)
+            return referenced
+
+        with mock.patch.object(self.cache, "_referencedObjects", storeDuringEviction):
+            self.cache.evict()
+        self.assertEqual(self.cache.load("job", "frame"), data)
+
+    def testEvictsKeptFrames(self):
+        """ Full frames kept with PYVISUALCOMPARE_KEEP_FRAMES must not keep the cache above its budget """
+        baseline = self.cache.store("job-0", "baseline-crop", b"b" * 100)
+        self.age(baseline, 3600)
+        for i in range(20):
+            self.age(self.cache.store("job-{}".format(i), "frame", bytes([i]) * 500), 3600)
+        self.cache.evict()
+        sizes = [entry.stat().st_size for prefix in os.scandir(self.cache.objects_dir)
+                 for entry in os.scandir(prefix.path)]
+        self.assertLessEqual(sum(sizes), self.cache.max_bytes)
+        self.assertIsNotNone(self.cache.load("job-0", "baseline-crop"))
+
+    def testMissingObjectIsCacheMiss(self):
+        digest = self.cache.store("job", "baseline-crop", b"b")
+        os.unlink(self.cache._objectPath(digest))
+        self.assertIsNone(self.cache.load("job", "baseline-crop"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+"""
+Tests of sharing renders between threads; run with python3 -m unittest
+"""
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import backend
+from cache import FrameCache
+from coalesce import RenderCoalescer
+from metrics import CheckMetrics
+
+KEY = "page"
+WINDOW = 0.2
+
+
+class CoalesceTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.cache = FrameCache(os.path.join(self.state_dir, "cache"))
+        self.coalescer = RenderCoalescer()
+        self.job = backend.Job(["http://example.com"])
+        self.renders = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.fail_first = False
+
+    def render(self, needed=None):
+        return self.coalescer.render(KEY, needed, WINDOW, self.cache, self.state_dir, self.renderPage,
+                                     CheckMetrics(self.job))
+
+    def renderPage(self, height):
+        self.renders.append(height)
+        self.started.set()
+        self.release.wait(5)
+        if self.fail_first and len(self.renders) == 1:
+            raise backend.RenderError(1, "failed\n")
+        return b"image"
+
+    def renderConcurrently(self, count):
+        """ Start count renders while the first one is in flight, returns their results or exceptions """
+        results = [None] * count
+
+        def run(i):
+            try:
+                results[i] = self.render()
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        threads[0].start()
+        self.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while sum(shared.users for shared in self.coalescer._renders.values()) < count:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def testRendersAreForgottenOnceTaken(self):
+        self.assertEqual(self.renderConcurrently(3), [b"image"] * 3)
+        self.assertEqual(self.renders, [None])
+        self.assertEqual(self.coalescer._renders, {})
+
+        # within the window, the render is reused through the cache instead of memory
+        self.assertEqual(self.render(), b"image")
+        self.assertEqual(self.renders, [None])
+        time.sleep(WINDOW * 2)
+        self.assertEqual(self.render(), b"image")
+        self.assertEqual(self.renders, [None, None])
+        self.assertEqual(self.coalescer._renders, {})
+
+    def testFailuresAreNotShared(self):
+        self.fail_first = True
+        results = self.renderConcurrently(3)
+        self.assertIsInstance(results[0], backend.RenderError)
+        # the waiting threads rendered the page again, together
+        self.assertEqual(results[1:], [b"image"] * 2)
+        self.assertEqual(self.renders, [None, None])
+        self.assertEqual(self.coalescer._renders, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
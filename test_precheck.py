@@ -0,0 +1,120 @@
+"""
+Tests of the pre-check against a local HTTP server; run with python3 -m unittest
+"""
+import hashlib
+import http.server
+import tempfile
+import threading
+import unittest
+
+import backend
+from metrics import CheckMetrics
+
+PAGES = {
+    "/page": ("text/html", '<html><head><link rel="stylesheet" href="/style.css"></head>'
+                           '<body><h1>Page</h1></body></html>'),
+    "/style.css": ("text/css", "h1 { color: black }"),
+}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        if self.path == "/garbled":
+            # announces more than it sends, so the response is truncated
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", "1000")
+            self.end_headers()
+            self.wfile.write(b"<html><body>trunc")
+            self.close_connection = True
+            return
+        if self.path == "/status":
+            self.wfile.write(b"HTTP/1.1 OK\r\n\r\n")
+            self.close_connection = True
+            return
+        content_type, body = server.pages[self.path]
+        body = body.encode()
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            server.statuses.append((self.path, 304))
+            self.send_response(304)
+            self.end_headers()
+            return
+        server.statuses.append((self.path, 200))
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PrecheckTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.pages = dict(PAGES)
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.settings = backend.Settings(state_dir=tempfile.mkdtemp(), precheck=True)
+
+    def job(self, path="/page"):
+        return backend.Job(["http://127.0.0.1:{}{}".format(self.server.server_port, path)])
+
+    def precheck(self, job):
+        metrics = CheckMetrics(job)
+        state, fingerprint, validators, results = backend.precheckJob(job, self.settings, metrics)
+        return metrics.record["precheck"], state, fingerprint, validators, results
+
+    def render(self, job, digest="digest"):
+        """ Check a job and store its state as if it was rendered after a changed pre-check """
+        status, state, fingerprint, validators, results = self.precheck(job)
+        if results is None:
+            state.update(fingerprint, validators, [(None, digest)])
+        return status, fingerprint
+
+    def testUnchangedPageReportsPreviousResults(self):
+        job = self.job()
+        status, fingerprint = self.render(job)
+        self.assertEqual(status, "changed")
+        del self.server.statuses[:]
+
+        status, _, second, _, results = self.precheck(job)
+        self.assertEqual(status, "unchanged")
+        self.assertEqual(second, fingerprint)
+        self.assertEqual([(result.name, result.digest) for result in results], [(None, "digest")])
+        self.assertEqual(self.server.statuses, [("/page", 304), ("/style.css", 304)])
+
+    def testChangedStylesheetChangesFingerprint(self):
+        job = self.job()
+        _, fingerprint = self.render(job)
+        self.server.pages["/style.css"] = ("text/css", "h1 { color: red }")
+        status, _, second, _, results = self.precheck(job)
+        self.assertEqual(status, "changed")
+        self.assertNotEqual(second, fingerprint)
+        self.assertIsNone(results)
+
+    def testGarbledResponseIsFailedFetch(self):
+        for path in ("/garbled", "/status"):
+            status, _, fingerprint, _, results = self.precheck(self.job(path))
+            self.assertTrue(status.startswith("failed: "), path)
+            self.assertIsNone(fingerprint)
+            self.assertIsNone(results)
+
+    def testMaxAgeForcesRender(self):
+        job = self.job()
+        self.render(job)
+        self.settings.precheck_max_age = 0
+        status, _, fingerprint, _, results = self.precheck(job)
+        self.assertEqual(status, "changed")
+        self.assertIsNotNone(fingerprint)
+        self.assertIsNone(results)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Tests of tracked areas of interest over several checks; run with python3 -m unittest (requires numpy)
+"""
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import backend
+import coalesce
+from frames import Frame, encodePpm
+from metrics import CheckMetrics
+
+PAGE_WIDTH = 200
+PAGE_HEIGHT = 2000
+AREA = (20, 115, 40, 30)
+
+
+class FakePage:
+    """ Renders a page whose area of interest has moved down by shift pixels, cut at the requested --height """
+
+    def __init__(self):
+        self.shift = 0
+        self.heights = []
+        generator = random.Random(1)
+        self.texture = bytes(generator.randrange(256) for _ in range(AREA[2] * AREA[3] * 3))
+
+    def render(self, arguments, pool, metrics, settings):
+        height = PAGE_HEIGHT
+        if backend.HEIGHT_OPTION in arguments:
+            height = int(arguments[arguments.index(backend.HEIGHT_OPTION) + 1])
+        self.heights.append(height)
+        pixels = bytearray(b"\x80" * PAGE_WIDTH * height * 3)
+        x, y, w, h = AREA
+        for row in range(h):
+            if y + self.shift + row < height:
+                offset = ((y + self.shift + row) * PAGE_WIDTH + x) * 3
+                pixels[offset:offset + w * 3] = self.texture[row * w * 3:(row + 1) * w * 3]
+        return encodePpm(Frame(PAGE_WIDTH, height, pixels))
+
+
+class TrackingTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = backend.Settings(state_dir=tempfile.mkdtemp(), track=True, track_margin=64)
+        self.job = backend.Job(["--javascript-delay", "0", "http://example.com"], [(None, AREA)])
+        self.page = FakePage()
+
+    def check(self):
+        metrics = CheckMetrics(self.job)
+        with mock.patch.object(backend, "renderWithPool", self.page.render):
+            results = backend.check(self.job, None, self.settings, metrics)
+        return results[0].digest, metrics.record["tracking"]
+
+    def followArea(self):
+        """ Move the area down 50 pixels per check, in total further than the margin; returns the needed height """
+        digest, _ = self.check()
+        for step in range(1, 9):
+            self.page.shift = 50 * step
+            moved_digest, found = self.check()
+            self.assertEqual(found["crop"], [AREA[0], AREA[1] + self.page.shift, 1.0])
+            self.assertEqual(moved_digest, digest)
+        self.assertGreater(self.page.shift, self.settings.track_margin)
+        # the last render was limited by the position found by the check before
+        return AREA[1] + 50 * 7 + AREA[3] + self.settings.track_margin
+
+    def testFollowsAreaFurtherThanMargin(self):
+        """ The render height follows the tracked area, so it is not lost once it moved further than the margin """
+        self.assertEqual(self.followArea(), self.page.heights[-1])
+
+    def testFollowsAreaInSharedRenders(self):
+        # a window of 0 s renders again on every check
+        self.settings.coalesce = 0
+        needed = self.followArea()
+        self.assertTrue(needed <= self.page.heights[-1] < needed + coalesce.HEIGHT_STEP)
+
+    def testFirstCheckUsesSelectedArea(self):
+        self.check()
+        self.assertEqual(self.page.heights, [AREA[1] + AREA[3] + self.settings.track_margin])
+
+
+if __name__ == '__main__':
+    unittest.main()
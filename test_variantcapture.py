@@ -0,0 +1,51 @@
+"""
+Tests of the render pool of the GUI; run with python3 -m unittest
+"""
+import unittest
+from unittest import mock
+
+from PyQt5.QtCore import QCoreApplication, QProcess, QTimer
+
+import variantcapture
+from profiletuner import renderProfiles
+from variantcapture import RENDER_TIMEOUT, RenderPool, RenderVariant
+
+PARAMETERS = ["--width", "1280", "--javascript-delay", "700", "http://example.com"]
+AREAS = [("crop", (0, 0, 300, 200))]
+
+
+class IdleProcess(QProcess):
+    """ Does not start anything, the render stays running until it is cancelled """
+
+    def start(self, program, arguments):
+        self.arguments = arguments
+
+
+class RenderPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.app = QCoreApplication.instance() or QCoreApplication([])
+        patcher = mock.patch.object(variantcapture, "QProcess", IdleProcess)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = RenderPool(max_workers=100)
+        self.addCleanup(self.pool.cancel)
+
+    def timeouts(self):
+        return sorted(process.findChild(QTimer).interval() for process in self.pool.running)
+
+    def testTimeoutOfTunerProfiles(self):
+        """ Profiles of the tuner have no delay of their own, the timeout uses the delay they render with """
+        profiles = renderProfiles(PARAMETERS, AREAS)
+        self.pool.render(profiles)
+        self.assertEqual(len(self.pool.running), len(profiles))
+        # profiles without JavaScript render without delay
+        self.assertEqual(self.timeouts(), sorted(RENDER_TIMEOUT + (700 if profile.javascript else 0)
+                                                 for profile in profiles))
+
+    def testTimeoutOfVariants(self):
+        self.pool.render([RenderVariant("http://example.com", 1024, None, delay) for delay in (350, 3000)])
+        self.assertEqual(self.timeouts(), [RENDER_TIMEOUT + 350, RENDER_TIMEOUT + 3000])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+"""
+External programs used for rendering. They are looked up lazily on first use and the result is cached,
+so importing a module never starts a process.
+"""
+import functools
+import shutil
+
+WKHTMLTOIMAGE = "wkhtmltoimage"
+XVFB = "xvfb-run"
+XVFB_BASE_PARAMETERS = ["-s", "-screen 0 640x480x16", WKHTMLTOIMAGE]
+# format of screenshots the GUI renders to the standard output of wkhtmltoimage. The backend uses bmp, which is the
+# cheapest to encode, but the GUI keeps the encoded screenshot in memory next to the decoded one (and decodes it
+# twice for the preview), which for an uncompressed bmp of a huge page would cost as much memory again.
+RENDER_FORMAT = "png"
+
+# package that provides a program, for error messages
+PACKAGES = {WKHTMLTOIMAGE: "wkhtmltopdf", XVFB: "xvfb", "Xvfb": "xvfb"}
+
+
+@functools.lru_cache(maxsize=None)
+def findTool(name):
+    """ Returns the full path of a program in PATH or None """
+    return shutil.which(name)
+
+
+def xvfbParameters(wkhtml_parameters, display=None):
+    """ Parameters of xvfb-run to render a screenshot with the given wkhtmltoimage parameters (except destination
+    filename) to the standard output. Without a display number, xvfb-run picks a free one itself (-a), which is only
+    safe if no other xvfb-run starts at the same time.
+    """
+    server = ["-a"] if display is None else ["-n", str(display)]
+    return server + XVFB_BASE_PARAMETERS + ["--format", RENDER_FORMAT] + list(wkhtml_parameters) + ["-"]
+
+
+def requireTool(name):
+    """ Returns the full path of a program, raises FileNotFoundError if it is not installed """
+    path = findTool(name)
+    if path is None:
+        raise FileNotFoundError("{} must be installed on system".format(PACKAGES.get(name, name)))
+    return path
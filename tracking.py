@@ -0,0 +1,115 @@
+"""
+Anchored tracking of areas of interest. When content is added above an area, the area moves down on the page and
+a fixed crop rectangle would report a change. With tracking, the pixels of the area at the first check are kept
+as template and on every check the area is searched again in a window around its last position; only the pixels
+found there are hashed or compared.
+
+The search uses the normalized cross-correlation (NCC) of the grayscale template, which does not depend on the
+brightness or contrast of the page. It starts on a coarse level of an image pyramid, where the whole window is
+searched with FFT-based correlation, and refines the best position on every finer level in a small neighborhood
+only. Searching a 232x58 template in a 744x570 window takes a few milliseconds.
+"""
+try:
+    import numpy as np
+except ImportError:
+    raise ImportError("Requires numpy.")
+
+from diffengine import frameToArray
+
+# smallest edge of the template on the coarsest pyramid level [pixels]
+MIN_TEMPLATE_SIZE = 8
+MAX_LEVELS = 4
+# neighborhood that is searched on the finer pyramid levels [pixels]
+REFINE_RADIUS = 2
+# float64: in float32, the FFT correlation of large white or flat areas is far off and scores exceed 1
+LUMINANCE = np.array([0.299, 0.587, 0.114], dtype=np.float64)
+# windows (and templates) whose luminance variance per pixel is below this are flat and match nothing; much less
+# than a single pixel that differs by one gray level, much more than rounding errors
+FLAT_VARIANCE = 1e-3
+
+
+def grayArray(frame):
+    """ Luminance of a frame as float64 array of shape (height, width) """
+    return frameToArray(frame) @ LUMINANCE
+
+
+def downsample(a):
+    """ Half the size of a 2D array by averaging 2x2 pixels; an odd last row or column is dropped """
+    h, w = a.shape[0] // 2 * 2, a.shape[1] // 2 * 2
+    return (a[0:h:2, 0:w:2] + a[1:h:2, 0:w:2] + a[0:h:2, 1:w:2] + a[1:h:2, 1:w:2]) * 0.25
+
+
+def _windowSums(a, height, width):
+    """ Sum of every height x width window of a 2D array, from its integral image """
+    integral = np.zeros((a.shape[0] + 1, a.shape[1] + 1))
+    integral[1:, 1:] = a.cumsum(axis=0).cumsum(axis=1)
+    return integral[height:, width:] - integral[:-height, width:] - integral[height:, :-width] \
+        + integral[:-height, :-width]
+
+
+def normalizedCrossCorrelation(image, template):
+    """ NCC of the template at every position where it fits completely into the image. Returns an array of shape
+    (image height - template height + 1, image width - template width + 1) with values from -1 to 1.
+    """
+    th, tw = template.shape
+    h, w = image.shape
+    count = th * tw
+    t = template.astype(np.float64) - template.mean()
+    t_variance = (t * t).sum()
+    # the mean of the image does not change the result, but leaves less to cancel out
+    image = image.astype(np.float64) - image.mean()
+
+    # correlation with the zero-mean template, so the mean of the image window cancels out
+    spectrum = np.fft.rfft2(image, image.shape) * np.conj(np.fft.rfft2(t, image.shape))
+    correlation = np.fft.irfft2(spectrum, image.shape)[:h - th + 1, :w - tw + 1]
+
+    # sum of squared deviations from the mean of every window
+    sums = _windowSums(image, th, tw)
+    variance = np.maximum(_windowSums(image * image, th, tw) - sums * sums / count, 0)
+    if t_variance <= FLAT_VARIANCE * count:
+        # a flat template does not match anything
+        return np.zeros(variance.shape)
+    ncc = correlation / np.sqrt(t_variance * np.maximum(variance, FLAT_VARIANCE * count))
+    # flat windows do not match anything either
+    return np.where(variance > FLAT_VARIANCE * count, np.clip(ncc, -1, 1), 0)
+
+
+def pyramidLevels(template_shape):
+    levels = 1
+    while levels < MAX_LEVELS and min(template_shape) >> levels >= MIN_TEMPLATE_SIZE:
+        levels += 1
+    return levels
+
+
+def findTemplate(image, template, position, margin):
+    """ Search the template (2D array) in the image (2D array) with its top left corner at most margin pixels away
+    from position (x, y). Returns ((x, y), score) of the best match or (None, 0) if the template does not fit.
+    """
+    th, tw = template.shape
+    x0, y0 = max(position[0] - margin, 0), max(position[1] - margin, 0)
+    x1, y1 = min(position[0] + margin + tw, image.shape[1]), min(position[1] + margin + th, image.shape[0])
+    if x1 - x0 < tw or y1 - y0 < th:
+        return None, 0.0
+
+    images = [image[y0:y1, x0:x1]]
+    templates = [template]
+    for _ in range(pyramidLevels(template.shape) - 1):
+        images.append(downsample(images[-1]))
+        templates.append(downsample(templates[-1]))
+
+    # the whole window on the coarsest level
+    ncc = normalizedCrossCorrelation(images[-1], templates[-1])
+    y, x = np.unravel_index(np.argmax(ncc), ncc.shape)
+    score = ncc[y, x]
+
+    # refine the position on every finer level
+    for level in range(len(images) - 2, -1, -1):
+        level_image, level_template = images[level], templates[level]
+        ry0, rx0 = max(2 * y - REFINE_RADIUS, 0), max(2 * x - REFINE_RADIUS, 0)
+        ry1 = min(2 * y + REFINE_RADIUS + level_template.shape[0], level_image.shape[0])
+        rx1 = min(2 * x + REFINE_RADIUS + level_template.shape[1], level_image.shape[1])
+        ncc = normalizedCrossCorrelation(level_image[ry0:ry1, rx0:rx1], level_template)
+        dy, dx = np.unravel_index(np.argmax(ncc), ncc.shape)
+        y, x, score = ry0 + dy, rx0 + dx, ncc[dy, dx]
+
+    return (x0 + int(x), y0 + int(y)), float(score)
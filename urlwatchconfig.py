@@ -0,0 +1,86 @@
+"""
+Generation of urlwatch job configurations for the backend checker. Does not depend on Qt so that configurations
+can also be created by scripts, e.g. with cli.py.
+"""
+
+# command of the backend checker (backend.py) on the server that is called by urlwatch
+BACKEND_COMMAND = "pyvisualcompare-check"
+
+
+def wkhtmlParameters(url, delay, width=None, height=None):
+    """ Parameters passed to wkhtmltoimage (except destination filename) to get a full screenshot.
+    width and height are only passed for a static size; a width alone sets the viewport width of a full page.
+    """
+    parameters = []
+
+    if height is not None:
+        parameters.append("--height")
+        parameters.append(str(height))
+    if width is not None:
+        parameters.append("--width")
+        parameters.append(str(width))
+
+    # add delay
+    parameters.append("--javascript-delay")
+    parameters.append(str(delay))
+
+    parameters.append(url)
+
+    return parameters
+
+
+def optionValue(parameters, option):
+    """ Value of an option in wkhtmltoimage parameters or None """
+    if option in parameters[:-1]:
+        return parameters[parameters.index(option) + 1]
+    return None
+
+
+def withoutOption(parameters, option):
+    """ wkhtmltoimage parameters without an option and its value """
+    if option not in parameters[:-1]:
+        return list(parameters)
+    i = parameters.index(option)
+    return parameters[:i] + parameters[i + 2:]
+
+
+def areaParameters(areas):
+    """ Backend parameters for a list of areas of interest given as (name, (x, y, w, h)) """
+    if len(areas) == 1:
+        # a single area is cropped by wkhtmltoimage, like pyvisualcompare-md5.sh does
+        x, y, w, h = areas[0][1]
+        return ["--crop-x", str(x), "--crop-y", str(y), "--crop-w", str(w), "--crop-h", str(h)]
+
+    # several areas are hashed from the same render of the page
+    parameters = []
+    for name, (x, y, w, h) in areas:
+        parameters += ["--region", "{}={},{},{},{}".format(name, x, y, w, h)]
+    return parameters
+
+
+def renderHeight(areas):
+    """ Screen height that contains all areas of interest; the rest of the page does not need to be rendered """
+    return max(y + h for _, (_, y, _, h) in areas)
+
+
+def jobParameters(areas, wkhtml_parameters):
+    """ wkhtmltoimage parameters the backend renders the given areas of interest with, e.g. to try settings in the
+    frontend. The generated configuration does not contain the height: the backend derives it from the areas by
+    itself (see backend.Job.renderHeight), with room below them for tracked areas.
+    """
+    if "--height" not in wkhtml_parameters:
+        # without a static size, wkhtmltoimage would render the whole page, however tall it is
+        return ["--height", str(renderHeight(areas))] + list(wkhtml_parameters)
+    return list(wkhtml_parameters)
+
+
+def urlwatchConfig(areas, wkhtml_parameters, name="ExampleName"):
+    s = "name: {}\n" \
+        "kind: shell\n" \
+        "command: {}".format(name, BACKEND_COMMAND)
+
+    s += " " + " ".join(areaParameters(areas)) + " "
+    s += " ".join(wkhtml_parameters)
+    s += "\n---"
+
+    return s
@@ -0,0 +1,456 @@
+"""
+Renders one URL at several viewport widths, heights and JavaScript delays at the same time, so that a setting
+where the page renders correctly can be chosen at once instead of trying one after the other.
+
+Renders run in a small pool of QProcess workers, each with an Xvfb display number of its own: several xvfb-run -a
+started at the same time would pick the same free display and fail. The screenshots are decoded in worker threads
+and shown side by side with their render time. A variant is marked as stable if its pixels are identical to the
+ones of the longest delay at the same size, i.e. the page had finished changing; the fastest stable variant is
+usually the best choice.
+"""
+import hashlib
+import itertools
+import os
+import signal
+
+from PyQt5.QtCore import Qt, QObject, QProcess, QByteArray, QBuffer, QElapsedTimer, QRect, QSize, QThread, QTimer, \
+    pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader, QPixmap
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QGridLayout, QLabel, QLineEdit, QPushButton, \
+    QScrollArea, QWidget, QFrame, QSpinBox
+
+from tools import XVFB, xvfbParameters
+from urlwatchconfig import optionValue, wkhtmlParameters
+
+DEFAULT_WIDTHS = "1024, 1280, 1920"
+DEFAULT_DELAYS = "350, 1000, 3000"
+THUMBNAIL_WIDTH = 240
+# the thumbnail shows the top of the page, at most this many times as high as wide
+THUMBNAIL_ASPECT = 2
+# a render is stopped if it takes longer than this plus its delay [ms]
+RENDER_TIMEOUT = 120000
+# a render whose X server could not start (e.g. another program took the display first) is tried this often
+MAX_ATTEMPTS = 3
+# display numbers the pool chooses from; each process of the dialog starts at its own offset
+FIRST_DISPLAY = 100
+DISPLAY_RANGE = 400
+X11_LOCK_FILE = "/tmp/.X{}-lock"
+XVFB_START_ERROR = b"Xvfb failed to start"
+
+
+class RenderVariant:
+    """ One combination of viewport size and JavaScript delay """
+
+    def __init__(self, url, width, height, delay):
+        self.url = url
+        self.width = width
+        # None renders the full height of the page
+        self.height = height
+        self.delay = delay
+
+    def label(self):
+        size = "{}x{}".format(self.width, self.height) if self.height else "{} px wide".format(self.width)
+        return "{}, {} ms".format(size, self.delay)
+
+    def wkhtmlParameters(self):
+        return wkhtmlParameters(self.url, self.delay, self.width, self.height)
+
+
+def parseNumbers(text):
+    """ Parse a comma separated list of positive integers """
+    return [int(value) for value in text.replace(" ", "").split(",") if value]
+
+
+def freeDisplay(used):
+    """ A display number that is neither used by the pool nor locked by a running X server """
+    offset = os.getpid() % DISPLAY_RANGE
+    for i in range(DISPLAY_RANGE):
+        display = FIRST_DISPLAY + (offset + i) % DISPLAY_RANGE
+        if display not in used and not os.path.exists(X11_LOCK_FILE.format(display)):
+            return display
+    raise RuntimeError("No free X display between {} and {}".format(FIRST_DISPLAY, FIRST_DISPLAY + DISPLAY_RANGE))
+
+
+class RenderTask:
+    """ A running render of the pool """
+
+    def __init__(self, index, variant, attempt, display):
+        self.index = index
+        self.variant = variant
+        self.attempt = attempt
+        self.display = display
+        self.elapsed = QElapsedTimer()
+        self.data = QByteArray()
+        self.timed_out = False
+
+
+class RenderPool(QObject):
+    """ Renders variants with at most max_workers wkhtmltoimage processes at a time """
+
+    variantStarted = pyqtSignal(int)
+    # index, encoded screenshot, render time [ms]
+    variantFinished = pyqtSignal(int, QByteArray, int)
+    variantFailed = pyqtSignal(int, str)
+    allFinished = pyqtSignal()
+
+    def __init__(self, max_workers, parent=None):
+        super(RenderPool, self).__init__(parent)
+        self.max_workers = max_workers
+        self.queue = []  # (index, variant, attempt)
+        self.running = {}  # QProcess -> RenderTask
+
+    def render(self, variants):
+        """ Queue variants; their indices in the signals refer to this list """
+        self.cancel()
+        self.queue = [(index, variant, 1) for index, variant in enumerate(variants)]
+        self._startNext()
+
+    def _startNext(self):
+        while self.queue and len(self.running) < self.max_workers:
+            index, variant, attempt = self.queue.pop(0)
+            try:
+                display = freeDisplay({task.display for task in self.running.values()})
+            except RuntimeError as e:
+                self.variantFailed.emit(index, str(e))
+                continue
+            task = RenderTask(index, variant, attempt, display)
+            process = QProcess(self)
+            self.running[process] = task
+            process.readyReadStandardOutput.connect(lambda p=process: self._onData(p))
+            process.finished.connect(lambda returncode, _, p=process: self._onFinished(p, returncode))
+            timer = QTimer(process)
+            timer.setSingleShot(True)
+            timer.timeout.connect(lambda p=process: self._onTimeout(p))
+            parameters = variant.wkhtmlParameters()
+            task.elapsed.start()
+            # in a new session, so that cancelling stops xvfb-run, Xvfb and wkhtmltoimage together
+            process.start("setsid", [XVFB] + xvfbParameters(parameters, display))
+            # variants of the profile tuner keep the delay of their parameters
+            timer.start(RENDER_TIMEOUT + int(optionValue(parameters, "--javascript-delay") or 0))
+            if attempt == 1:
+                self.variantStarted.emit(index)
+        if not self.queue and not self.running:
+            self.allFinished.emit()
+
+    def _onData(self, process):
+        if process in self.running:
+            self.running[process].data.append(process.readAllStandardOutput())
+
+    def _onTimeout(self, process):
+        if process in self.running:
+            self.running[process].timed_out = True
+            self._kill(process)
+
+    def _onFinished(self, process, returncode):
+        if process not in self.running:
+            return  # cancelled
+        task = self.running.pop(process)
+        task.data.append(process.readAllStandardOutput())
+        error = bytes(process.readAllStandardError())
+        if task.timed_out:
+            self.variantFailed.emit(task.index, "timed out after {} s".format(task.elapsed.elapsed() // 1000))
+        elif returncode == 0:
+            self.variantFinished.emit(task.index, task.data, task.elapsed.elapsed())
+        elif XVFB_START_ERROR in error and task.attempt < MAX_ATTEMPTS:
+            # another X server took the display between choosing and starting it, try the next free one
+            self.queue.insert(0, (task.index, task.variant, task.attempt + 1))
+        else:
+            lines = error.decode(errors="replace").strip().splitlines()
+            self.variantFailed.emit(task.index, lines[-1] if lines else "exit code {}".format(returncode))
+        process.deleteLater()
+        self._startNext()
+
+    @staticmethod
+    def _kill(process, sig=signal.SIGTERM):
+        """ Stop the session of a render; SIGTERM lets Xvfb remove its lock file, SIGKILL follows if it is ignored """
+        if process.state() == QProcess.NotRunning:
+            return
+        try:
+            os.killpg(process.processId(), sig)
+        except ProcessLookupError:
+            return
+        if sig != signal.SIGKILL:
+            QTimer.singleShot(3000, lambda: RenderPool._kill(process, signal.SIGKILL))
+
+    def cancel(self):
+        self.queue = []
+        running, self.running = self.running, {}
+        for process in running:
+            self._kill(process)
+
+
+def pixelHash(image):
+    """ Hash of the pixels of a QImage, independent of how the screenshot was encoded """
+    image = image.convertToFormat(QImage.Format_RGB32)
+    bits = image.constBits()
+    bits.setsize(image.bytesPerLine() * image.height())
+    h = hashlib.md5("{}x{}:".format(image.width(), image.height()).encode())
+    h.update(bits)
+    return h.hexdigest()
+
+
+class VariantLoader(QThread):
+    """ Decodes the screenshot of a variant outside of the GUI thread: first a thumbnail of the top of the page,
+    read scaled down, then the complete screenshot to hash its pixels
+    """
+
+    # thumbnail, size of the screenshot
+    thumbnailReady = pyqtSignal(QImage, QSize)
+    pixelsReady = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, data, parent=None):
+        super(VariantLoader, self).__init__(parent)
+        self.data = data
+
+    def reader(self):
+        buffer = QBuffer(self.data)
+        buffer.open(QBuffer.ReadOnly)
+        reader = QImageReader(buffer)
+        reader.buffer = buffer  # keep the buffer alive as long as the reader
+        return reader
+
+    def run(self):
+        reader = self.reader()
+        size = reader.size()
+        if not size.isValid() or size.isEmpty():
+            self.failed.emit("screenshot could not be decoded")
+            return
+        height = min(size.height(), size.width() * THUMBNAIL_ASPECT)
+        reader.setClipRect(QRect(0, 0, size.width(), height))
+        reader.setScaledSize(QSize(THUMBNAIL_WIDTH, max(1, height * THUMBNAIL_WIDTH // size.width())))
+        thumbnail = reader.read()
+        if thumbnail.isNull():
+            self.failed.emit("screenshot could not be decoded: {}".format(reader.errorString()))
+            return
+        self.thumbnailReady.emit(thumbnail, size)
+
+        if self.isInterruptionRequested():
+            return
+        reader = self.reader()
+        image = reader.read()
+        if image.isNull():
+            self.failed.emit("screenshot could not be decoded: {}".format(reader.errorString()))
+            return
+        self.pixelsReady.emit(pixelHash(image))
+
+
+class VariantCard(QFrame):
+    """ Result of one variant: thumbnail, render time and a button to use it """
+
+    def __init__(self, variant, parent=None):
+        super(VariantCard, self).__init__(parent)
+        self.setFrameShape(QFrame.StyledPanel)
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel(variant.label()))
+        self.image_label = QLabel("waiting...")
+        self.image_label.setFixedSize(QSize(THUMBNAIL_WIDTH, THUMBNAIL_WIDTH * THUMBNAIL_ASPECT))
+        self.image_label.setAlignment(Qt.AlignHCenter | Qt.AlignTop)
+        layout.addWidget(self.image_label)
+        self.status_label = QLabel()
+        self.status_label.setWordWrap(True)
+        layout.addWidget(self.status_label)
+        self.summary = ""
+        self.use_button = QPushButton("Use this variant")
+        self.use_button.setDisabled(True)
+        layout.addWidget(self.use_button)
+
+
+class VariantDialog(QDialog):
+    def __init__(self, url="", parent=None):
+        super(VariantDialog, self).__init__(parent)
+        self.setWindowTitle("Compare viewports and delays")
+
+        vbox = QVBoxLayout(self)
+        grid = QGridLayout()
+        vbox.addLayout(grid)
+
+        grid.addWidget(QLabel("URL of web page"), 0, 0)
+        self.url_edit = QLineEdit(url)
+        self.url_edit.setPlaceholderText("https://duckduckgo.com")
+        grid.addWidget(self.url_edit, 0, 1)
+
+        grid.addWidget(QLabel("Widths of page"), 1, 0)
+        self.widths_edit = QLineEdit(DEFAULT_WIDTHS)
+        grid.addWidget(self.widths_edit, 1, 1)
+
+        grid.addWidget(QLabel("Heights of page"), 2, 0)
+        self.heights_edit = QLineEdit()
+        self.heights_edit.setPlaceholderText("full page")
+        grid.addWidget(self.heights_edit, 2, 1)
+
+        grid.addWidget(QLabel("Delays before screenshot [ms]"), 3, 0)
+        self.delays_edit = QLineEdit(DEFAULT_DELAYS)
+        grid.addWidget(self.delays_edit, 3, 1)
+
+        grid.addWidget(QLabel("Parallel renders"), 4, 0)
+        self.workers_edit = QSpinBox()
+        self.workers_edit.setRange(1, 16)
+        self.workers_edit.setValue(min(4, os.cpu_count() or 1))
+        grid.addWidget(self.workers_edit, 4, 1)
+
+        buttons = QHBoxLayout()
+        self.render_button = QPushButton("Render")
+        self.render_button.clicked.connect(self.startRendering)
+        buttons.addWidget(self.render_button)
+        self.status_label = QLabel()
+        buttons.addWidget(self.status_label, 1)
+        vbox.addLayout(buttons)
+
+        # results side by side
+        self.cards_widget = QWidget()
+        self.cards_layout = QHBoxLayout(self.cards_widget)
+        self.cards_layout.setAlignment(Qt.AlignLeft)
+        scroll_area = QScrollArea()
+        scroll_area.setWidgetResizable(True)
+        scroll_area.setWidget(self.cards_widget)
+        vbox.addWidget(scroll_area, 1)
+
+        self.pool = RenderPool(self.workers_edit.value(), self)
+        self.pool.variantStarted.connect(self.onVariantStarted)
+        self.pool.variantFinished.connect(self.onVariantFinished)
+        self.pool.variantFailed.connect(self.onVariantFailed)
+        self.pool.allFinished.connect(self.onAllFinished)
+
+        self.variants = []
+        self.cards = []
+        self.results = {}  # index -> [data, render time [ms], pixel hash or None while decoding]
+        self.loaders = {}  # index -> VariantLoader that is still decoding
+        self.rendering = False
+        self.selected = None
+
+        self.resize(1100, 700)
+
+    def startRendering(self):
+        try:
+            widths = parseNumbers(self.widths_edit.text())
+            heights = parseNumbers(self.heights_edit.text()) or [None]
+            delays = sorted(parseNumbers(self.delays_edit.text()))
+        except ValueError:
+            self.status_label.setText("Widths, heights and delays must be comma separated numbers")
+            return
+        url = self.url_edit.text().strip()
+        if not url or not widths or not delays:
+            self.status_label.setText("URL, widths and delays must not be empty")
+            return
+
+        self.stopLoaders()
+        for card in self.cards:
+            card.deleteLater()
+        self.variants = [RenderVariant(url, width, height, delay)
+                         for width, height, delay in itertools.product(widths, heights, delays)]
+        self.cards = []
+        self.results = {}
+        for index, variant in enumerate(self.variants):
+            card = VariantCard(variant, self.cards_widget)
+            card.use_button.clicked.connect(lambda _, i=index: self.useVariant(i))
+            self.cards_layout.addWidget(card)
+            self.cards.append(card)
+
+        self.status_label.setText("Rendering {} variants...".format(len(self.variants)))
+        self.pool.max_workers = self.workers_edit.value()
+        self.rendering = True
+        self.pool.render(self.variants)
+
+    def onVariantStarted(self, index):
+        self.cards[index].image_label.setText("rendering...")
+
+    def onVariantFinished(self, index, data, elapsed):
+        self.results[index] = [data, elapsed, None]
+        self.cards[index].image_label.setText("decoding...")
+        loader = VariantLoader(data, self)
+        loader.thumbnailReady.connect(lambda image, size, l=loader: self.onThumbnailReady(l, index, image, size))
+        loader.pixelsReady.connect(lambda pixel_hash, l=loader: self.onPixelsReady(l, index, pixel_hash))
+        loader.failed.connect(lambda error, l=loader: self.onDecodingFailed(l, index, error))
+        loader.finished.connect(loader.deleteLater)
+        self.loaders[index] = loader
+        loader.start()
+
+    def onThumbnailReady(self, loader, index, image, size):
+        if self.loaders.get(index) is not loader:
+            return  # from a previous rendering
+        card = self.cards[index]
+        card.image_label.setPixmap(QPixmap.fromImage(image))
+        card.summary = "{:.1f} s, {}x{}".format(self.results[index][1] / 1000, size.width(), size.height())
+        card.status_label.setText(card.summary)
+        card.use_button.setDisabled(False)
+
+    def onPixelsReady(self, loader, index, pixel_hash):
+        if self.loaders.get(index) is not loader:
+            return
+        del self.loaders[index]
+        self.results[index][2] = pixel_hash
+        self.updateStability()
+        self.updateStatus()
+
+    def onDecodingFailed(self, loader, index, error):
+        if self.loaders.get(index) is not loader:
+            return
+        del self.loaders[index]
+        del self.results[index]
+        self.cards[index].use_button.setDisabled(True)
+        self.onVariantFailed(index, error)
+        self.updateStatus()
+
+    def onVariantFailed(self, index, error):
+        self.cards[index].image_label.setText("failed")
+        self.cards[index].status_label.setText(error)
+
+    def onAllFinished(self):
+        self.rendering = False
+        self.updateStatus()
+
+    def updateStatus(self):
+        """ Once every variant is rendered and decoded, show the fastest stable one """
+        if self.rendering or self.loaders:
+            return
+        stable = [index for index in self.results if self.isStable(index)]
+        if stable:
+            fastest = min(stable, key=lambda index: self.results[index][1])
+            self.status_label.setText("Done. Fastest stable variant: {}".format(self.variants[fastest].label()))
+        else:
+            self.status_label.setText("Done.")
+
+    def isStable(self, index):
+        """ Whether the pixels of a variant equal the ones of the longest delay at the same size """
+        variant = self.variants[index]
+        longest = max((i for i, v in enumerate(self.variants)
+                       if (v.width, v.height) == (variant.width, variant.height)),
+                      key=lambda i: self.variants[i].delay)
+        return index in self.results and longest in self.results and \
+            self.results[index][2] is not None and self.results[index][2] == self.results[longest][2]
+
+    def updateStability(self):
+        """ Mark every variant that is identical to the longest delay at its size """
+        for index in self.results:
+            if self.results[index][2] is None:
+                continue  # the thumbnail may not be shown yet
+            card = self.cards[index]
+            card.status_label.setText(card.summary + (", stable" if self.isStable(index) else ""))
+
+    def stopLoaders(self):
+        """ Stop decoding; waits for the threads, which must not outlive the dialog """
+        loaders, self.loaders = self.loaders, {}
+        for loader in loaders.values():
+            loader.requestInterruption()
+        for loader in loaders.values():
+            loader.wait()
+
+    def useVariant(self, index):
+        self.selected = index
+        self.pool.cancel()
+        self.stopLoaders()
+        self.accept()
+
+    def reject(self):
+        self.pool.cancel()
+        self.stopLoaders()
+        super(VariantDialog, self).reject()
+
+    @staticmethod
+    def getVariant(url="", parent=None):
+        """ Show the dialog; returns the chosen RenderVariant and its encoded screenshot, or (None, None) """
+        dialog = VariantDialog(url, parent)
+        if dialog.exec_() != QDialog.Accepted or dialog.selected is None:
+            return None, None
+        return dialog.variants[dialog.selected], dialog.results[dialog.selected][0]
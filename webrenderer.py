@@ -0,0 +1,550 @@
+"""
+Renderer that loads pages in long-lived Qt WebEngine views under the offscreen platform plugin instead of starting
+wkhtmltoimage on an Xvfb display for every check. Neither Xvfb nor wkhtmltoimage is needed.
+
+Qt must run in the main thread of its process, while batch mode and the scheduler render from a thread pool, so
+every view lives in a worker process of its own (this file run with --serve). Like the displays of an XvfbPool,
+workers are started once, keep running in the background and are leased by all checker processes of a user, so
+also the separate checker processes urlwatch starts for its jobs do not start Qt WebEngine on every check. A
+worker answers one render request after the other over a Unix socket in the state directory: a JSON line with the
+options goes in, a JSON line with the timings and the size of the image comes out, followed by the encoded image.
+A worker is replaced after max_renders renders or max_age seconds, or if it dies or hangs.
+
+Only the wkhtmltoimage parameters in OPTIONS are understood. The pixels differ slightly from the ones of
+wkhtmltoimage, so switching the renderer is reported as change once.
+"""
+import contextlib
+import fcntl
+import importlib.util
+import json
+import math
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# wkhtmltoimage parameter -> (option, type); flags have no type
+OPTIONS = {
+    "--width": ("width", int),
+    "--height": ("height", int),
+    "--javascript-delay": ("delay", int),
+    "--zoom": ("zoom", float),
+    "--crop-x": ("crop_x", int),
+    "--crop-y": ("crop_y", int),
+    "--crop-w": ("crop_w", int),
+    "--crop-h": ("crop_h", int),
+    "--format": ("format", str),
+    "-f": ("format", str),
+    "--disable-javascript": ("javascript", False),
+    "-n": ("javascript", False),
+    "--enable-javascript": ("javascript", True),
+    "--no-images": ("images", False),
+    "--images": ("images", True),
+    "--window-status": ("window_status", str),
+    "--quiet": (None, None),
+    "-q": (None, None),
+}
+# same defaults as wkhtmltoimage
+DEFAULT_OPTIONS = {"width": 1024, "height": 0, "delay": 200, "zoom": 1.0, "format": "png", "javascript": True,
+                   "images": True}
+# height of the view while the page loads if no height is given [pixels]
+LOAD_HEIGHT = 768
+# time for the view to paint after it has been resized to the full page [ms]
+PAINT_DELAY = 100
+# how often the page is checked for its readiness signal [ms], and how many checks in a row the rendering must be
+# unchanged to count as stable
+READY_INTERVAL = 100
+STABLE_FRAMES = 2
+RENDER_TIMEOUT = 120.0
+
+
+def renderOptions(arguments):
+    """ Options of a render request from wkhtmltoimage parameters; the URL is the last parameter """
+    options = dict(DEFAULT_OPTIONS)
+    i = 0
+    while i < len(arguments) - 1:
+        argument = arguments[i]
+        if argument not in OPTIONS:
+            raise ValueError("wkhtmltoimage parameter {} is not supported by the webengine renderer".format(
+                argument))
+        option, kind = OPTIONS[argument]
+        if isinstance(kind, bool):
+            options[option] = kind
+        elif kind is not None:
+            if i + 2 >= len(arguments):
+                raise ValueError("Missing value of {}".format(argument))
+            options[option] = kind(arguments[i + 1])
+            i += 1
+        i += 1
+    if not arguments:
+        raise ValueError("No URL given")
+    options["url"] = arguments[-1]
+    return options
+
+
+def defaultStateDir():
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(base, "pyvisualcompare-webengine-{}".format(os.getuid()))
+
+
+class WebRendererWorker:
+    """ Connection to a worker process (see serve()) for the renders of one lease """
+
+    def __init__(self, path, pid, process=None, timeout=5.0):
+        # process is the subprocess.Popen of the worker if this process started it
+        self.pid = pid
+        self.process = process
+        self.renders = 0
+        self._buffer = b""
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        try:
+            self.socket.connect(path)
+        except OSError:
+            self.socket.close()
+            raise
+        self.socket.settimeout(None)
+
+    def close(self):
+        self.socket.close()
+
+    def stop(self):
+        """ Kill the worker, e.g. because it timed out or broke the protocol """
+        self.close()
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(self.pid, signal.SIGKILL)
+        if self.process is not None:
+            self.process.wait()
+
+    def _fill(self, deadline):
+        """ Read what the worker has written so far, waiting until deadline (None: no limit) """
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and (remaining <= 0 or not select.select([self.socket], [], [], remaining)[0]):
+            raise TimeoutError("timed out")
+        chunk = self.socket.recv(1024 * 1024)
+        if not chunk:
+            raise EOFError("web renderer closed the connection")
+        self._buffer += chunk
+
+    def _read(self, size, deadline):
+        while len(self._buffer) < size:
+            self._fill(deadline)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _readLine(self, deadline):
+        while b"\n" not in self._buffer:
+            self._fill(deadline)
+        line, _, self._buffer = self._buffer.partition(b"\n")
+        return line.decode()
+
+    def render(self, arguments, metrics, timeout=RENDER_TIMEOUT, ready=None):
+        """ Render a page given by wkhtmltoimage parameters and return the encoded image. The time until the page
+        is loaded (including the JavaScript delay) is recorded as stage "load", the rest as stage "render".
+        ready ("stable" or "status:VALUE", see backend.Settings) captures the page as soon as it is ready, with
+        the JavaScript delay as upper bound.
+        A render that takes timeout seconds (None: no limit) longer than the JavaScript delay stops the worker
+        with its process group and raises a backend.RenderTimeout.
+        """
+        from backend import RenderError, RenderOutOfMemory, RenderTimeout
+
+        options = renderOptions(arguments)
+        if ready is not None:
+            options["ready"] = ready
+        start = time.perf_counter()
+        self.renders += 1
+        try:
+            self.socket.sendall(json.dumps(options).encode() + b"\n")
+            deadline = None if timeout is None else time.monotonic() + timeout + options["delay"] / 1000
+            reply = json.loads(self._readLine(deadline))
+            data = self._read(reply.get("size", 0), deadline)
+        except TimeoutError:
+            self.stop()
+            raise RenderTimeout(time.perf_counter() - start, "",
+                                "Web renderer did not finish within {:.1f} s".format(time.perf_counter() - start))
+        except (OSError, EOFError, ValueError) as e:
+            # a renderer that broke the protocol cannot be used any more
+            killed = self.process is not None and self.process.poll() == -signal.SIGKILL  # by the OOM killer
+            self.stop()
+            if killed:
+                raise RenderOutOfMemory(-signal.SIGKILL, "Web renderer was killed: {}\n".format(e))
+            raise RenderError(-signal.SIGKILL, "Web renderer failed: {}\n".format(e))
+
+        if "ready" in reply:
+            metrics.set(ready=reply["ready"])
+        if "load" in reply:
+            metrics.addStage("load", reply["load"])
+            metrics.addStage("render", max(time.perf_counter() - start - reply["load"], 0.0))
+        else:
+            metrics.addStage("render", time.perf_counter() - start)
+        if "error" in reply:
+            raise RenderError(1, "Error: {}\n".format(reply["error"]))
+        return data
+
+
+class WebRendererPool:
+    """ Leases web renderer workers that are shared by all checker processes of a user on one host, like the
+    displays of an XvfbPool: every worker belongs to a numbered slot in a state directory, which a process leases
+    by taking an exclusive flock on its lock file. Workers are detached, so they keep running after the process
+    that started them has exited, and the next check connects to them through their socket.
+    """
+
+    def __init__(self, size=4, state_dir=None, max_renders=500, max_age=3600, start_timeout=30.0):
+        if importlib.util.find_spec("PyQt5.QtWebEngineWidgets") is None:
+            raise ImportError("Requires PyQtWebEngine.")
+        self.size = size
+        self.state_dir = state_dir or defaultStateDir()
+        self.max_renders = max_renders
+        self.max_age = max_age
+        self.start_timeout = start_timeout
+
+        # workers started by this process; they must be reaped if they are stopped by us
+        self._children = {}
+
+        os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+
+    @classmethod
+    def fromEnvironment(cls):
+        """ Create a pool configured by the PYVISUALCOMPARE_WEBENGINE_* environment variables """
+        env = os.environ
+        return cls(size=int(env.get("PYVISUALCOMPARE_WEBENGINE_POOL", 4)),
+                   state_dir=env.get("PYVISUALCOMPARE_WEBENGINE_DIR") or None,
+                   max_renders=int(env.get("PYVISUALCOMPARE_WEBENGINE_MAX_RENDERS", 500)),
+                   max_age=float(env.get("PYVISUALCOMPARE_WEBENGINE_MAX_AGE", 3600)))
+
+    @contextlib.contextmanager
+    def lease(self, timeout=120.0):
+        """ Lease a worker for one render. Blocks until a slot is free or raises a RuntimeError after timeout
+        seconds.
+        """
+        deadline = time.monotonic() + timeout
+        # start at a process specific slot so that concurrent processes do not all fight over slot 0
+        first = os.getpid() % self.size
+        while True:
+            for i in range(self.size):
+                slot = (first + i) % self.size
+                fd = self._tryLock(slot)
+                if fd is None:
+                    continue
+                try:
+                    state, worker = self._connect(slot)
+                    try:
+                        yield worker
+                    finally:
+                        worker.close()
+                        state["renders"] += worker.renders
+                        self._writeState(slot, state)
+                    return
+                finally:
+                    os.close(fd)  # releases the flock
+
+            if time.monotonic() > deadline:
+                raise RuntimeError("No web renderer became free within {} s".format(timeout))
+            time.sleep(0.05)
+
+    def shutdown(self):
+        """ Stop all workers of the pool that are not leased at the moment """
+        for slot in range(self.size):
+            fd = self._tryLock(slot)
+            if fd is None:
+                continue
+            try:
+                self._stopWorker(self._readState(slot))
+                for path in (self._statePath(slot), self._socketPath(slot)):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(path)
+            finally:
+                os.close(fd)
+
+    def _lockPath(self, slot):
+        return os.path.join(self.state_dir, "slot{}.lock".format(slot))
+
+    def _statePath(self, slot):
+        return os.path.join(self.state_dir, "slot{}.json".format(slot))
+
+    def _socketPath(self, slot):
+        return os.path.join(self.state_dir, "slot{}.sock".format(slot))
+
+    def _tryLock(self, slot):
+        fd = os.open(self._lockPath(slot), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _readState(self, slot):
+        try:
+            with open(self._statePath(slot), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _writeState(self, slot, state):
+        path = self._statePath(slot)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    def _isWornOut(self, state):
+        return state["renders"] >= self.max_renders or time.time() - state["started"] >= self.max_age
+
+    @staticmethod
+    def _isWorkerProcess(pid):
+        try:
+            os.kill(pid, 0)
+        except (ProcessLookupError, PermissionError):
+            return False  # a pid of another user has been reused
+        try:
+            with open("/proc/{}/cmdline".format(pid), "rb") as f:
+                cmdline = f.read()
+            return os.path.basename(__file__).encode() in cmdline and b"--serve" in cmdline
+        except OSError:
+            return True  # no procfs, trust the pid
+
+    def _connect(self, slot):
+        """ Connect to the worker of a slot, which is (re)started if it died or is worn out """
+        state = self._readState(slot)
+        if state is not None and self._isWorkerProcess(state["pid"]) and not self._isWornOut(state):
+            try:
+                return state, WebRendererWorker(self._socketPath(slot), state["pid"],
+                                                self._children.get(state["pid"]))
+            except OSError:
+                pass  # hangs or lost its socket
+
+        self._stopWorker(state)
+        state = self._startWorker(slot)
+        self._writeState(slot, state)
+        try:
+            return state, WebRendererWorker(self._socketPath(slot), state["pid"], self._children[state["pid"]])
+        except OSError as e:
+            self._stopWorker(state)
+            raise RuntimeError("Cannot connect to web renderer: {}".format(e))
+
+    def _startWorker(self, slot):
+        path = self._socketPath(slot)
+        env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", path], env=env,
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   start_new_session=True)  # keep running after this process exits
+        # starting Qt WebEngine takes a while, which belongs to the lease like starting an Xvfb server does
+        output = b""
+        deadline = time.monotonic() + self.start_timeout
+        try:
+            while not output.endswith(b"\n"):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([process.stdout], [], [], remaining)[0]:
+                    os.killpg(process.pid, signal.SIGKILL)
+                    process.wait()
+                    raise RuntimeError("Web renderer did not start within {} s".format(self.start_timeout))
+                chunk = os.read(process.stdout.fileno(), 1024)
+                if not chunk:
+                    process.wait()
+                    raise RuntimeError("Web renderer exited during startup with code {}".format(
+                        process.returncode))
+                output += chunk
+        finally:
+            process.stdout.close()
+
+        ready = json.loads(output.decode())
+        if "error" in ready:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            raise RuntimeError("Web renderer did not start: {}".format(ready["error"]))
+        self._children[process.pid] = process
+        return {"pid": process.pid, "started": time.time(), "renders": 0}
+
+    def _stopWorker(self, state):
+        if state is None or not self._isWorkerProcess(state["pid"]):
+            return
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(state["pid"], signal.SIGKILL)
+        process = self._children.pop(state["pid"], None)
+        if process is not None:
+            process.wait()
+
+
+class PageRenderer:
+    """ Renders pages in one web view, runs in the worker process """
+
+    def __init__(self):
+        from PyQt5.QtCore import Qt
+        from PyQt5.QtWebEngineWidgets import QWebEnginePage, QWebEngineProfile, QWebEngineView
+
+        # off the record: cache and cookies are kept in memory only, nothing is written to disk
+        self.profile = QWebEngineProfile()
+        self.view = QWebEngineView()
+        self.view.setPage(QWebEnginePage(self.profile, self.view))
+        self.view.setAttribute(Qt.WA_DontShowOnScreen)
+        self.view.show()
+
+    def _wait(self, milliseconds):
+        from PyQt5.QtCore import QEventLoop, QTimer
+
+        loop = QEventLoop()
+        QTimer.singleShot(milliseconds, loop.quit)
+        loop.exec_()
+
+    def _evaluate(self, script):
+        """ Result of a JavaScript expression in the page, None if it cannot be evaluated """
+        from PyQt5.QtCore import QEventLoop, QTimer
+
+        loop = QEventLoop()
+        result = []
+
+        def onResult(value):
+            result.append(value)
+            loop.quit()
+
+        self.view.page().runJavaScript(script, onResult)
+        QTimer.singleShot(1000, loop.quit)
+        loop.exec_()
+        return result[0] if result else None
+
+    def _fitHeight(self, options):
+        if not options["height"]:
+            # like wkhtmltoimage without --height, the screenshot contains the whole page
+            height = max(int(math.ceil(self.view.page().contentsSize().height())), 1)
+            if height != self.view.height():
+                self.view.resize(options["width"], height)
+
+    def _grab(self, options):
+        from PyQt5.QtCore import QRect
+
+        if all(key in options for key in ("crop_x", "crop_y", "crop_w", "crop_h")):
+            return self.view.grab(QRect(options["crop_x"], options["crop_y"], options["crop_w"],
+                                        options["crop_h"])).toImage()
+        return self.view.grab().toImage()
+
+    def _waitUntilReady(self, ready, options, deadline):
+        """ Wait until the page is ready or deadline (perf_counter) has passed. Returns what ended the wait:
+        "status", "stable" or "timeout".
+        """
+        previous = None
+        unchanged = 0
+        while time.perf_counter() < deadline:
+            self._wait(READY_INTERVAL)
+            if ready.startswith("status:"):
+                if self._evaluate("window.status") == ready[len("status:"):]:
+                    return "status"
+                continue
+            self._fitHeight(options)
+            frame = self._grab(options)
+            unchanged = unchanged + 1 if frame == previous else 0
+            if unchanged >= STABLE_FRAMES:
+                return "stable"
+            previous = frame
+        return "timeout"
+
+    def render(self, options):
+        """ Returns (time until loaded [s], what ended the wait or None, encoded image) """
+        from PyQt5.QtCore import QBuffer, QEventLoop, QUrl
+        from PyQt5.QtWebEngineWidgets import QWebEngineSettings
+
+        page = self.view.page()
+        page.settings().setAttribute(QWebEngineSettings.JavascriptEnabled, options["javascript"])
+        page.settings().setAttribute(QWebEngineSettings.AutoLoadImages, options.get("images", True))
+        self.view.setZoomFactor(options["zoom"])
+        self.view.resize(options["width"], options["height"] or LOAD_HEIGHT)
+
+        start = time.perf_counter()
+        loop = QEventLoop()
+        result = {}
+
+        def onLoadFinished(ok):
+            if "ok" not in result:
+                result["ok"] = ok
+                loop.quit()
+
+        page.loadFinished.connect(onLoadFinished)
+        page.load(QUrl.fromUserInput(options["url"]))
+        loop.exec_()
+        page.loadFinished.disconnect(onLoadFinished)
+        if not result["ok"]:
+            raise ValueError("Failed to load {}".format(options["url"]))
+
+        ready = options.get("ready")
+        if ready is None and "window_status" in options:
+            ready = "status:" + options["window_status"]
+        if ready is None:
+            self._wait(options["delay"])
+        else:
+            ready = self._waitUntilReady(ready, options, time.perf_counter() + options["delay"] / 1000)
+        loaded = time.perf_counter() - start
+
+        self._fitHeight(options)
+        self._wait(PAINT_DELAY)
+        image = self._grab(options)
+        buffer = QBuffer()
+        buffer.open(QBuffer.WriteOnly)
+        if not image.save(buffer, options["format"].upper()):
+            raise ValueError("Cannot write image format {}".format(options["format"]))
+        return loaded, ready, bytes(buffer.data())
+
+
+def _reply(out, header, data=b""):
+    out.write(json.dumps(dict(header, size=len(data))).encode() + b"\n" + data)
+    out.flush()
+
+
+def serve(path):
+    """ Worker loop: accept one connection after the other on a Unix socket at path, read render requests from it
+    and write the results back. Once the socket is listening, {"ready": true} is written to the standard output,
+    which is closed afterwards.
+    """
+    # anything else that is printed (e.g. by Chromium) must not end up in the startup reply
+    out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    # there is no GPU on a server, render in software
+    os.environ.setdefault("QTWEBENGINE_CHROMIUM_FLAGS", "--disable-gpu")
+
+    try:
+        from PyQt5.QtCore import Qt, QCoreApplication
+        from PyQt5.QtWidgets import QApplication
+        import PyQt5.QtWebEngineWidgets  # noqa: F401, must be imported before the application is created
+    except ImportError as e:
+        _reply(out, {"error": "Requires PyQtWebEngine: {}".format(e)})
+        return 1
+    QCoreApplication.setAttribute(Qt.AA_UseSoftwareOpenGL)
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
+    app = QApplication([sys.argv[0]])
+    renderer = PageRenderer()
+
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)  # left behind by a worker of the slot that was killed
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    _reply(out, {"ready": True})
+    out.close()
+
+    while True:
+        connection, _ = server.accept()
+        with connection, connection.makefile("rwb") as f:
+            try:
+                for line in f:
+                    try:
+                        loaded, ready, data = renderer.render(json.loads(line))
+                    except (ValueError, KeyError) as e:
+                        _reply(f, {"error": str(e)})
+                    else:
+                        header = {"load": loaded}
+                        if ready is not None:
+                            header["ready"] = ready
+                        _reply(f, header, data)
+            except OSError:
+                pass  # the checker went away, e.g. because it was stopped; wait for the next one
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != "--serve":
+        sys.stderr.write("Usage: {} --serve SOCKET (started by WebRendererPool)\n".format(
+            os.path.basename(sys.argv[0])))
+        sys.exit(2)
+    sys.exit(serve(sys.argv[2]))
@@ -0,0 +1,228 @@
+"""
+Pool of long-lived Xvfb displays that is shared by all checker processes of a user on one host.
+
+Starting a complete X server for every check (as xvfb-run does) is expensive, so displays are started once
+and kept alive in the background. Each display belongs to a numbered slot in a state directory. A process
+leases a slot by taking an exclusive flock on its lock file, so concurrent urlwatch jobs never share a display,
+and a lease is released automatically by the kernel if the leasing process dies.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import select
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+
+from tools import requireTool
+
+XVFB_SERVER = "Xvfb"
+DEFAULT_SCREEN = "640x480x16"
+X11_SOCKET_DIR = "/tmp/.X11-unix"
+
+
+def defaultStateDir():
+    base = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(base, "pyvisualcompare-xvfb-{}".format(os.getuid()))
+
+
+class XvfbPool:
+    """ Leases displays from a pool of persistent Xvfb servers.
+
+    Displays are health-checked on every lease and recycled after max_renders renders or max_age seconds
+    so that leaks in the X server cannot accumulate forever.
+    """
+
+    def __init__(self, size=4, state_dir=None, screen=DEFAULT_SCREEN, max_renders=500, max_age=3600,
+                 start_timeout=10.0):
+        self.size = size
+        self.state_dir = state_dir or defaultStateDir()
+        self.screen = screen
+        self.max_renders = max_renders
+        self.max_age = max_age
+        self.start_timeout = start_timeout
+
+        # Xvfb processes started by this process; they must be reaped if they are stopped by us
+        self._children = {}
+
+        os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+
+    @classmethod
+    def fromEnvironment(cls):
+        """ Create a pool configured by the PYVISUALCOMPARE_XVFB_* environment variables """
+        env = os.environ
+        return cls(size=int(env.get("PYVISUALCOMPARE_XVFB_POOL", 4)),
+                   state_dir=env.get("PYVISUALCOMPARE_XVFB_DIR") or None,
+                   screen=env.get("PYVISUALCOMPARE_XVFB_SCREEN", DEFAULT_SCREEN),
+                   max_renders=int(env.get("PYVISUALCOMPARE_XVFB_MAX_RENDERS", 500)),
+                   max_age=float(env.get("PYVISUALCOMPARE_XVFB_MAX_AGE", 3600)))
+
+    @contextlib.contextmanager
+    def lease(self, timeout=120.0):
+        """ Lease a healthy display for one render. Yields the value for the DISPLAY variable, e.g. ":99".
+        Blocks until a slot is free or raises a RuntimeError after timeout seconds. If the render fails with an
+        exception whose restart_display is true (see backend.RenderTimeout), the display is stopped.
+        """
+        deadline = time.monotonic() + timeout
+        # start at a process specific slot so that concurrent processes do not all fight over slot 0
+        first = os.getpid() % self.size
+        while True:
+            for i in range(self.size):
+                slot = (first + i) % self.size
+                fd = self._tryLock(slot)
+                if fd is None:
+                    continue
+                try:
+                    state = self._ensureDisplay(slot)
+                    try:
+                        yield ":{}".format(state["display"])
+                    except Exception as e:
+                        if getattr(e, "restart_display", False):
+                            # a render that hung may have left the server stuck, the next lease starts a new one
+                            self._stopDisplay(state)
+                        raise
+                    finally:
+                        state["renders"] += 1
+                        self._writeState(slot, state)
+                    return
+                finally:
+                    os.close(fd)  # releases the flock
+
+            if time.monotonic() > deadline:
+                raise RuntimeError("No Xvfb display became free within {} s".format(timeout))
+            time.sleep(0.05)
+
+    def shutdown(self):
+        """ Stop all displays of the pool that are not leased at the moment """
+        for slot in range(self.size):
+            fd = self._tryLock(slot)
+            if fd is None:
+                continue
+            try:
+                self._stopDisplay(self._readState(slot))
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(self._statePath(slot))
+            finally:
+                os.close(fd)
+
+    def _lockPath(self, slot):
+        return os.path.join(self.state_dir, "slot{}.lock".format(slot))
+
+    def _statePath(self, slot):
+        return os.path.join(self.state_dir, "slot{}.json".format(slot))
+
+    def _tryLock(self, slot):
+        fd = os.open(self._lockPath(slot), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _readState(self, slot):
+        try:
+            with open(self._statePath(slot), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _writeState(self, slot, state):
+        path = self._statePath(slot)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    def _ensureDisplay(self, slot):
+        state = self._readState(slot)
+        if state is not None and self._isHealthy(state) and not self._isWornOut(state):
+            return state
+
+        self._stopDisplay(state)
+        state = self._startDisplay()
+        self._writeState(slot, state)
+        return state
+
+    def _isWornOut(self, state):
+        return state["renders"] >= self.max_renders or time.time() - state["started"] >= self.max_age
+
+    @staticmethod
+    def _isXvfbProcess(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return False  # belongs to another user, so the pid has been reused
+        try:
+            with open("/proc/{}/cmdline".format(pid), "rb") as f:
+                return XVFB_SERVER.encode() in f.read()
+        except OSError:
+            return True  # no procfs, trust the pid
+
+    @classmethod
+    def _isHealthy(cls, state):
+        """ A display is healthy if its server is still running and accepts connections """
+        if not cls._isXvfbProcess(state["pid"]):
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(1.0)
+        try:
+            sock.connect(os.path.join(X11_SOCKET_DIR, "X{}".format(state["display"])))
+        except OSError:
+            return False
+        finally:
+            sock.close()
+        return True
+
+    def _startDisplay(self):
+        # let Xvfb choose a free display number itself instead of probing like xvfb-run -a does
+        server = requireTool(XVFB_SERVER)
+        read_fd, write_fd = os.pipe()
+        try:
+            process = subprocess.Popen([server, "-displayfd", str(write_fd), "-screen", "0", self.screen,
+                                        "-nolisten", "tcp"],
+                                       pass_fds=(write_fd,), stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                       start_new_session=True)  # keep running after this process exits
+        except OSError:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+
+        output = b""
+        deadline = time.monotonic() + self.start_timeout
+        try:
+            while not output.endswith(b"\n"):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([read_fd], [], [], remaining)[0]:
+                    process.kill()
+                    process.wait()
+                    raise RuntimeError("Xvfb did not start within {} s".format(self.start_timeout))
+                chunk = os.read(read_fd, 32)
+                if not chunk:
+                    process.wait()
+                    raise RuntimeError("Xvfb exited during startup with code {}".format(process.returncode))
+                output += chunk
+        finally:
+            os.close(read_fd)
+
+        self._children[process.pid] = process
+        return {"display": int(output), "pid": process.pid, "started": time.time(), "renders": 0}
+
+    def _stopDisplay(self, state):
+        if state is None or not self._isXvfbProcess(state["pid"]):
+            return
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(state["pid"], signal.SIGTERM)
+        process = self._children.pop(state["pid"], None)
+        if process is not None:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()